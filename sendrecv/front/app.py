@@ -1,10 +1,17 @@
 
+import os
+import urllib.error
+import urllib.request
+
 import flask
 
 
 # Create the application.
 APP = flask.Flask(__name__)
 
+# Where the GStreamer sender serves its stats (see its --stats-port)
+STATS_URL = os.environ.get('SENDRECV_STATS_URL', 'http://127.0.0.1:8081/stats')
+
 
 @APP.route('/')
 def index():
@@ -31,6 +38,18 @@ def stats():
     """Display the index page accessible at '/stats'."""
     return flask.render_template('stats.html')
 
+@APP.route('/stats.json')
+def stats_json():
+    """Relay the latest stats records of the sender, accessible at '/stats.json'."""
+    since = flask.request.args.get('since', '0')
+    try:
+        with urllib.request.urlopen('{}?since={}'.format(STATS_URL, int(since)), timeout=2) as r:
+            return flask.Response(r.read(), mimetype='application/json')
+    except ValueError:
+        flask.abort(400)
+    except (urllib.error.URLError, OSError):
+        flask.abort(502)
+
 if __name__ == '__main__':
     from pathlib import Path
     parent = Path(__file__).parent
@@ -111,6 +111,11 @@ function generateOffer() {
 
 // ICE candidate received from peer, add it to the peer connection
 function onIncomingICE(ice) {
+    // Candidates trickled in a burst may arrive batched in a list
+    if (Array.isArray(ice)) {
+        ice.forEach(onIncomingICE);
+        return;
+    }
     var candidate = new RTCIceCandidate(ice);
     peer_connection.addIceCandidate(candidate).catch(setError);
 }
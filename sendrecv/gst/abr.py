@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Encoder presets and adaptive bitrate for the GStreamer sender
+
+RateController polls the stats of one or more webrtcbins, and moves the
+target bitrate of the encoder with the loss and round-trip time reported by
+the receivers in RTCP: down quickly on loss or growing delay, up slowly while
+the network keeps up. When the bitrate crosses a rung of LADDER, the
+resolution and framerate follow, so the picture gets smaller and choppier
+under congestion instead of freezing.
+"""
+import asyncio
+import collections
+import os
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+
+from tracing import traced
+
+# vp8enc settings shared by all the presets: constant bitrate with a small
+# buffer, no lookahead, dropped frames rather than overshoots, and periodic
+# keyframes so that receivers recover from losses
+COMMON = {
+    'end-usage': 'cbr',
+    'lag-in-frames': 0,
+    'buffer-size': 1000,
+    'buffer-initial-size': 500,
+    'buffer-optimal-size': 600,
+    'dropframe-threshold': 30,
+    'undershoot': 95,
+    'max-quantizer': 56,
+    'keyframe-max-dist': 120,
+    'error-resilient': 'default',
+}
+
+# Format: {name: {vp8enc property: value}}, from cheapest to best looking.
+# cpu-used trades quality for speed (16 is the fastest with deadline=1)
+PRESETS = {
+    'low-cpu': dict(COMMON, **{'deadline': 1, 'cpu-used': 16, 'threads': 1}),
+    'realtime': dict(COMMON, **{'deadline': 1, 'cpu-used': 8, 'threads': 2}),
+    'balanced': dict(COMMON, **{'deadline': 1, 'cpu-used': 4, 'threads': 4}),
+    'quality': dict(COMMON, **{'deadline': 1, 'cpu-used': 2, 'threads': 8}),
+}
+
+Rung = collections.namedtuple('Rung', 'bitrate width height framerate')
+
+# What the test sources produce. Without caps, videotestsrc picks 320x240,
+# and the ladder would upscale it several times over before encoding.
+SOURCE_WIDTH, SOURCE_HEIGHT, SOURCE_FRAMERATE = 1280, 720, 30
+SOURCE_CAPS = 'video/x-raw,width={},height={},framerate={}/1'.format(
+    SOURCE_WIDTH, SOURCE_HEIGHT, SOURCE_FRAMERATE)
+
+# From the best to the worst, the highest rung whose bitrate (in bits/s) is
+# under the target is used
+LADDER = (
+    Rung(1200000, 1280, 720, 30),
+    Rung(600000, 960, 540, 30),
+    Rung(300000, 640, 360, 25),
+    Rung(0, 320, 180, 15),
+)
+
+
+def apply_preset(encoder, name):
+    for prop, value in PRESETS[name].items():
+        if prop == 'threads':
+            value = min(value, os.cpu_count() or 1)
+        Gst.util_set_object_arg(encoder, prop, str(value))
+
+
+def rung_caps(rung):
+    return Gst.Caps.from_string('video/x-raw,width={},height={},framerate={}/1'.format(
+        rung.width, rung.height, rung.framerate))
+
+
+class RateController:
+    '''
+    Drives the target-bitrate of @encoder, and the caps of the @capsfilter
+    in front of it, from the stats of the webrtcbins that send its output.
+    With several receivers, the one in the worst conditions decides. Rungs
+    larger than @source_size (width, height) are skipped, so the ladder only
+    ever scales down.
+    '''
+    # Loss fractions under which to increase, and over which to decrease
+    LOSS_LOW = 0.02
+    LOSS_HIGH = 0.10
+    # Round-trip time over the lowest seen that means queues are building up
+    RTT_MARGIN = 0.1
+    INCREASE = 1.08
+    DELAY_DECREASE = 0.85
+    # Intervals the target must stay above the next rung before going up
+    UP_AFTER = 3
+
+    def __init__(self, encoder, capsfilter, min_bitrate=150000, max_bitrate=2000000,
+                 interval=1.0, ladder=LADDER, source_size=(SOURCE_WIDTH, SOURCE_HEIGHT)):
+        self.encoder = encoder
+        self.capsfilter = capsfilter
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.interval = interval
+        width, height = source_size
+        self.ladder = [r for r in ladder if r.width <= width and r.height <= height] or ladder[-1:]
+        self.target = (min_bitrate + max_bitrate) // 2
+        self.rung = None
+        self.up_count = 0
+        self.rtt_min = None
+        self.task = None
+        # Stats replies arrive on GStreamer threads
+        self.lock = threading.Lock()
+        # Format: {webrtcbin: (packets_sent, packets_lost, bytes_sent)}
+        self.counters = {}
+        # Format: {webrtcbin: (loss, rtt, bitrate)}, since the last interval
+        self.reports = {}
+        self.set_bitrate(self.target)
+
+    def add(self, webrtc):
+        with self.lock:
+            self.counters[webrtc] = None
+
+    def remove(self, webrtc):
+        with self.lock:
+            self.counters.pop(webrtc, None)
+            self.reports.pop(webrtc, None)
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.adjust()
+            with self.lock:
+                webrtcs = list(self.counters)
+            for webrtc in webrtcs:
+                promise = Gst.Promise.new_with_change_func(self.on_stats, webrtc)
+                webrtc.emit('get-stats', None, promise)
+
+    @traced
+    def on_stats(self, promise, webrtc):
+        reply = promise.get_reply()
+        if reply is None:
+            return
+        sent = lost = sent_bytes = 0
+        rtt = None
+        fraction = None
+
+        def collect(_, value):
+            nonlocal sent, lost, sent_bytes, rtt, fraction
+            if not isinstance(value, Gst.Structure):
+                return True
+            kind = value.get_value('type')
+            if kind == GstWebRTC.WebRTCStatsType.OUTBOUND_RTP:
+                sent += value.get_value('packets-sent') or 0
+                sent_bytes += value.get_value('bytes-sent') or 0
+            elif kind == GstWebRTC.WebRTCStatsType.REMOTE_INBOUND_RTP:
+                lost += max(0, value.get_value('packets-lost') or 0)
+                if value.has_field('round-trip-time'):
+                    rtt = max(rtt or 0, value.get_value('round-trip-time'))
+                if value.has_field('fraction-lost'):
+                    fraction = max(fraction or 0, value.get_value('fraction-lost'))
+            return True
+        reply.foreach(collect)
+
+        with self.lock:
+            if webrtc not in self.counters:
+                # Removed meanwhile
+                return
+            previous = self.counters[webrtc]
+            self.counters[webrtc] = (sent, lost, sent_bytes)
+            if previous is None:
+                return
+            d_sent = sent - previous[0]
+            d_lost = lost - previous[1]
+            if d_sent > 0:
+                loss = max(0, d_lost) / (d_sent + max(0, d_lost))
+            else:
+                loss = fraction or 0
+            bitrate = (sent_bytes - previous[2]) * 8 / self.interval
+            self.reports[webrtc] = (loss, rtt, bitrate)
+
+    def adjust(self):
+        with self.lock:
+            reports, self.reports = list(self.reports.values()), {}
+        if not reports:
+            return
+        loss = max(r[0] for r in reports)
+        rtts = [r[1] for r in reports if r[1] is not None]
+        rtt = max(rtts) if rtts else None
+        # What the encoder actually produced, for the receiver that got it
+        sending = min(r[2] for r in reports)
+        if rtt is not None:
+            self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+
+        target = self.target
+        if loss > self.LOSS_HIGH:
+            target *= 1 - loss / 2
+        elif rtt is not None and rtt > self.rtt_min + self.RTT_MARGIN:
+            target *= self.DELAY_DECREASE
+        elif loss < self.LOSS_LOW:
+            # Don't run away from what the encoder manages to produce, eg
+            # with a still picture
+            target = min(target * self.INCREASE, max(sending * 1.5, self.min_bitrate))
+            target = max(target, self.target)
+        self.set_bitrate(int(target))
+
+    def set_bitrate(self, target):
+        self.target = max(self.min_bitrate, min(self.max_bitrate, target))
+        self.encoder.set_property('target-bitrate', self.target)
+        rung = next(r for r in self.ladder if r.bitrate <= self.target)
+        if self.rung is None or rung.bitrate < self.rung.bitrate:
+            # Step down right away
+            self.set_rung(rung)
+        elif rung.bitrate > self.rung.bitrate:
+            # Step up once it looks like it will last
+            self.up_count += 1
+            if self.up_count >= self.UP_AFTER:
+                self.set_rung(rung)
+        else:
+            self.up_count = 0
+
+    def set_rung(self, rung):
+        self.rung = rung
+        self.up_count = 0
+        print('Sending {}x{}@{} at {} kbps'.format(
+            rung.width, rung.height, rung.framerate, self.target // 1000))
+        self.capsfilter.set_property('caps', rung_caps(rung))
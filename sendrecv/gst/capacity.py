@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streams-per-core capacity of the sender, without a browser
+
+Starts a local simple_server.py, then N pairs of a WebRTCClient sending to
+a Receiver which answers its offer and decodes the video, all on localhost
+with host candidates only. N goes up level by level; at each level, once
+the calls are up, the CPU and memory of this process (both ends of every
+call) and of the server are measured, with the framerate, frame drops and
+bitrate of each stream. The highest level where every stream keeps up
+gives the number of streams per core, to track across releases and
+encoder presets. The senders run without the adaptive bitrate, so every
+stream encodes the frames of the source (abr.SOURCE_CAPS) at their size.
+
+Usage: python3 capacity.py [--streams 1,2,4,8] [--preset P] [--duration S]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+gi.require_version('GstSdp', '1.0')
+from gi.repository import GstSdp
+import websockets
+
+from abr import PRESETS, SOURCE_CAPS
+from loopback import RECEIVE_DESC
+from webrtc_sendrecv import WebRTCClient, check_plugins, run_with_retries
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'signalling', 'bench'))
+from common import cpu_seconds, rss_kb, start_server, stop_server
+
+DECODE_DESC = '''
+rtpvp8depay
+! vp8dec
+  name=decoder
+! fakesink
+  sync=false
+'''
+
+
+class Receiver:
+    '''
+    Registers as @uid on @server, answers the offer of the peer that calls
+    it and decodes the video, counting frames and bytes
+    '''
+    def __init__(self, uid, server):
+        self.uid = uid
+        self.server = server
+        self.conn = None
+        self.pipe = None
+        self.webrtc = None
+        self.loop = None
+        self.outbox = None
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.bytes = 0
+
+    async def connect(self):
+        self.conn = await websockets.connect(self.server)
+        await self.conn.send('HELLO {}'.format(self.uid))
+        reply = await self.conn.recv()
+        assert reply == 'HELLO', reply
+
+    def post(self, msg):
+        self.loop.call_soon_threadsafe(self.outbox.put_nowait, msg)
+
+    async def write_messages(self):
+        while True:
+            await self.conn.send(await self.outbox.get())
+
+    async def run(self):
+        self.loop = asyncio.get_event_loop()
+        self.outbox = asyncio.Queue()
+        writer = self.loop.create_task(self.write_messages())
+        try:
+            async for message in self.conn:
+                self.handle_sdp(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            writer.cancel()
+            self.close_pipeline()
+
+    def start_pipeline(self):
+        self.pipe = Gst.parse_launch(RECEIVE_DESC)
+        self.webrtc = self.pipe.get_by_name('recv')
+        self.webrtc.connect('on-ice-candidate', self.on_ice_candidate)
+        self.webrtc.connect('pad-added', self.on_incoming_stream)
+        self.pipe.set_state(Gst.State.PLAYING)
+
+    def close_pipeline(self):
+        if self.pipe is not None:
+            self.pipe.set_state(Gst.State.NULL)
+            self.pipe = None
+            self.webrtc = None
+
+    def handle_sdp(self, message):
+        msg = json.loads(message)
+        if 'sdp' in msg:
+            assert msg['sdp']['type'] == 'offer'
+            if self.pipe is None:
+                self.start_pipeline()
+            res, sdpmsg = GstSdp.SDPMessage.new()
+            GstSdp.sdp_message_parse_buffer(bytes(msg['sdp']['sdp'].encode()), sdpmsg)
+            offer = GstWebRTC.WebRTCSessionDescription.new(GstWebRTC.WebRTCSDPType.OFFER, sdpmsg)
+            promise = Gst.Promise.new()
+            self.webrtc.emit('set-remote-description', offer, promise)
+            promise.interrupt()
+            promise = Gst.Promise.new_with_change_func(self.on_answer_created, None)
+            self.webrtc.emit('create-answer', None, promise)
+        elif 'ice' in msg and self.webrtc is not None:
+            ices = msg['ice'] if isinstance(msg['ice'], list) else [msg['ice']]
+            for ice in ices:
+                if ice is not None:
+                    self.webrtc.emit('add-ice-candidate', ice['sdpMLineIndex'], ice['candidate'])
+
+    def on_answer_created(self, promise, _):
+        promise.wait()
+        answer = promise.get_reply().get_value('answer')
+        promise = Gst.Promise.new()
+        self.webrtc.emit('set-local-description', answer, promise)
+        promise.interrupt()
+        self.post(json.dumps({'sdp': {'type': 'answer', 'sdp': answer.sdp.as_text()}}))
+
+    def on_ice_candidate(self, _, mlineindex, candidate):
+        self.post(json.dumps({'ice': {'candidate': candidate, 'sdpMLineIndex': mlineindex}}))
+
+    def on_incoming_stream(self, _, pad):
+        if pad.direction != Gst.PadDirection.SRC:
+            return
+        bin_ = Gst.parse_bin_from_description(DECODE_DESC, True)
+        self.pipe.add(bin_)
+        bin_.sync_state_with_parent()
+        pad.link(bin_.get_static_pad('sink'))
+        pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, self.on_rtp)
+        bin_.get_by_name('decoder').get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER,
+                                                                    self.on_frame)
+
+    def on_rtp(self, pad, info):
+        buf = info.get_buffer()
+        if buf is not None:
+            size = buf.get_size()
+        else:
+            buffers = info.get_buffer_list()
+            size = sum(buffers.get(i).get_size() for i in range(buffers.length()))
+        with self.lock:
+            self.bytes += size
+        return Gst.PadProbeReturn.OK
+
+    def on_frame(self, pad, info):
+        with self.lock:
+            self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    def counters(self):
+        with self.lock:
+            return self.frames, self.bytes
+
+
+class CaptureCounter:
+    '''
+    Counts the frames out of the source of a sender pipeline
+    '''
+    def __init__(self, pipe):
+        self.lock = threading.Lock()
+        self.frames = 0
+        pipe.get_by_name('source').get_static_pad('src').add_probe(
+            Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, self.on_frame)
+
+    def on_frame(self, pad, info):
+        with self.lock:
+            self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    def take(self):
+        with self.lock:
+            frames, self.frames = self.frames, 0
+        return frames
+
+
+async def wait_streaming(receivers, timeout):
+    '''
+    Wait until every receiver decodes frames
+    '''
+    deadline = time.monotonic() + timeout
+    while any(r.counters()[0] == 0 for r in receivers):
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.2)
+    return True
+
+
+async def run_level(n, args, url, server_pid):
+    '''
+    Run @n calls, and returns what was measured
+    '''
+    receivers = [Receiver('capacity-recv-{}-{}'.format(n, i), url) for i in range(n)]
+    await asyncio.gather(*[r.connect() for r in receivers])
+    receiving = [asyncio.ensure_future(r.run()) for r in receivers]
+    senders = [WebRTCClient('capacity-send-{}-{}'.format(n, i), r.uid, url,
+                            preset=args.preset, stun_server=None)
+               for i, r in enumerate(receivers)]
+    sending = [asyncio.ensure_future(run_with_retries(s, '', max_attempts=3)) for s in senders]
+    result = {'streams': n}
+    try:
+        if not await wait_streaming(receivers, args.setup_timeout):
+            result['error'] = 'not all calls were up after {} s'.format(args.setup_timeout)
+            return result
+        await asyncio.sleep(args.warmup)
+        captures = [CaptureCounter(s.pipe) for s in senders]
+        before = [r.counters() for r in receivers]
+        pid = os.getpid()
+        # The server is a child of ours, leave it out of our numbers
+        cpu, server_cpu = cpu_seconds(pid, children=False), cpu_seconds(server_pid)
+        start = time.monotonic()
+        await asyncio.sleep(args.duration)
+        elapsed = time.monotonic() - start
+        cpu, server_cpu = (cpu_seconds(pid, children=False) - cpu,
+                           cpu_seconds(server_pid) - server_cpu)
+        streams = []
+        for capture, receiver, (frames, nbytes) in zip(captures, receivers, before):
+            captured = capture.take()
+            decoded, received = [a - b for a, b in zip(receiver.counters(), (frames, nbytes))]
+            streams.append({
+                'fps': decoded / elapsed,
+                # A source that stalled dropped everything it should have sent
+                'dropped': max(0, captured - decoded) / captured if captured else 1.0,
+                'kbps': received * 8 / elapsed / 1000,
+            })
+        result.update(
+            cores=cpu / elapsed,
+            server_cores=server_cpu / elapsed,
+            rss_kb=rss_kb(pid, children=False),
+            server_rss_kb=rss_kb(server_pid),
+            min_fps=min(s['fps'] for s in streams),
+            max_dropped=max(s['dropped'] for s in streams),
+            streams_detail=streams,
+        )
+        result['ok'] = result['max_dropped'] <= args.max_dropped
+        return result
+    finally:
+        for task in sending:
+            task.cancel()
+        await asyncio.gather(*sending, return_exceptions=True)
+        for sender in senders:
+            sender.close_pipeline()
+            await sender.stop()
+        for receiver in receivers:
+            await receiver.conn.close()
+        await asyncio.gather(*receiving, return_exceptions=True)
+
+
+async def run(args, server_pid):
+    url = 'ws://127.0.0.1:{}'.format(args.port)
+    levels = []
+    for n in args.streams:
+        result = await run_level(n, args, url, server_pid)
+        levels.append(result)
+        print(json.dumps({k: v for k, v in result.items() if k != 'streams_detail'}),
+              file=sys.stderr)
+        if not result.get('ok') and not args.keep_going:
+            break
+        # Let the pipelines of this level go before the next one
+        await asyncio.sleep(1)
+    report = {'preset': args.preset, 'source': SOURCE_CAPS, 'cpus': os.cpu_count(), 'levels': levels}
+    passed = [l for l in levels if l.get('ok')]
+    if passed:
+        best = max(passed, key=lambda l: l['streams'])
+        report['max_streams'] = best['streams']
+        # Both ends of each call run here, so a stream costs an encode and
+        # a decode
+        report['streams_per_core'] = best['streams'] / best['cores'] if best['cores'] else None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--streams', default='1,2,4,8,16',
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help='Numbers of concurrent streams to ramp through')
+    parser.add_argument('--preset', default='realtime', choices=PRESETS, help='Encoder preset of the senders')
+    parser.add_argument('--port', default=18443, type=int, help='Port for the local signalling server')
+    parser.add_argument('--server-args', dest='server_args', default='', help='Extra arguments for simple_server.py')
+    parser.add_argument('--setup-timeout', dest='setup_timeout', default=30, type=float,
+                        help='Seconds for all the calls of a level to start streaming')
+    parser.add_argument('--warmup', default=3, type=float, help='Seconds to let the calls settle before measuring')
+    parser.add_argument('--duration', default=10, type=float, help='Seconds to measure each level for')
+    parser.add_argument('--max-dropped', dest='max_dropped', default=0.05, type=float,
+                        help='Fraction of the captured frames a stream may fail to decode for its level to pass')
+    parser.add_argument('--keep-going', dest='keep_going', action='store_true',
+                        help='Keep ramping after a level fails')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the clients')
+    args = parser.parse_args()
+    Gst.init(None)
+    if not check_plugins():
+        sys.exit(1)
+    server = start_server(args.port, *args.server_args.split())
+    try:
+        out = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+        with out:
+            report = asyncio.get_event_loop().run_until_complete(run(args, server.pid))
+    finally:
+        stop_server(server)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+One source and encoder shared by many peers
+
+The video is encoded and payloaded once, then a tee hands the same RTP
+packets to one webrtcbin per peer. Each branch gets its own leaky queue, so a
+slow peer drops packets instead of stalling the others, and adding a peer
+costs a webrtcbin (ICE, DTLS, SRTP) instead of a full encode.
+"""
+import asyncio
+from functools import partial
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from abr import SOURCE_CAPS, RateController, apply_preset
+from record import finish
+from tracing import tracer
+
+STUN_SERVER = 'stun://stun.l.google.com:19302'
+
+SOURCE_DESC = '''
+videotestsrc
+  name=source
+  is-live=true
+  pattern=ball
+! {source_caps}
+! timeoverlay
+  font-desc="Sans, 36"
+  halignment=center
+  valignment=center
+! videorate
+! videoscale
+! capsfilter
+  name=abrcaps
+! videoconvert
+! queue
+! vp8enc
+  name=encoder
+  deadline=1
+! tee
+  name=encoded
+  allow-not-linked=true
+! rtpvp8pay
+  name=pay
+! queue
+! application/x-rtp,media=video,encoding-name=VP8,payload=97
+! tee
+  name=fanout
+  allow-not-linked=true
+'''.format(source_caps=SOURCE_CAPS)
+
+BRANCH_DESC = '''
+queue
+  leaky=downstream
+  max-size-buffers=0
+  max-size-bytes=0
+  max-size-time=500000000
+! webrtcbin
+  name=sendrecv
+  bundle-policy=max-bundle
+'''
+
+
+class Branch:
+    def __init__(self, bin_, teepad):
+        self.bin = bin_
+        self.teepad = teepad
+        self.webrtc = bin_.get_by_name('sendrecv')
+
+
+class Fanout:
+    '''
+    @preset is applied to the encoder (see abr.PRESETS). With @abr, the
+    RateController options, the bitrate follows the peer in the worst
+    network conditions. @stats, a stats.StatsCollector, gets the encoder
+    stats. @recorder, a record.Recorder, records the encoded video. The
+    webrtcbins of the peers use @stun_server, or host candidates only if
+    it is empty.
+    '''
+    def __init__(self, preset='realtime', abr=None, stats=None, recorder=None,
+                 stun_server=STUN_SERVER, source_desc=SOURCE_DESC, branch_desc=BRANCH_DESC):
+        self.pipe = Gst.parse_launch(source_desc)
+        tracer.watch(self.pipe)
+        self.tee = self.pipe.get_by_name('fanout')
+        self.branch_desc = branch_desc
+        self.stun_server = stun_server
+        # Format: {peer_id: Branch}
+        self.branches = {}
+        encoder = self.pipe.get_by_name('encoder')
+        apply_preset(encoder, preset)
+        self.rate_controller = None
+        if abr is not None:
+            self.rate_controller = RateController(encoder, self.pipe.get_by_name('abrcaps'), **abr)
+        if stats is not None:
+            stats.watch_encoder(encoder)
+        self.recorder = recorder
+        self.recording = None
+
+    def start(self):
+        if self.recorder:
+            self.recording = self.recorder.record_outgoing(self.pipe, 'fanout')
+        self.pipe.set_state(Gst.State.PLAYING)
+        if self.rate_controller:
+            self.rate_controller.start(asyncio.get_event_loop())
+
+    def stop(self):
+        if self.rate_controller:
+            self.rate_controller.stop()
+        if self.recording:
+            finish([self.recording], then=partial(self.pipe.set_state, Gst.State.NULL))
+            self.recording = None
+        else:
+            self.pipe.set_state(Gst.State.NULL)
+        self.branches = {}
+
+    def add(self, peer_id):
+        '''
+        Attach a webrtcbin for @peer_id to the running pipeline and return it.
+        Connect to its signals before the main loop runs again: it emits
+        on-negotiation-needed once it is playing.
+        '''
+        if peer_id in self.branches:
+            raise ValueError('{} already has a branch'.format(peer_id))
+        bin_ = Gst.parse_bin_from_description(self.branch_desc, True)
+        if self.stun_server:
+            bin_.get_by_name('sendrecv').set_property('stun-server', self.stun_server)
+        self.pipe.add(bin_)
+        teepad = self.tee.get_request_pad('src_%u')
+        teepad.link(bin_.get_static_pad('sink'))
+        branch = self.branches[peer_id] = Branch(bin_, teepad)
+        if self.rate_controller:
+            self.rate_controller.add(branch.webrtc)
+        return branch.webrtc
+
+    def play(self, peer_id):
+        self.branches[peer_id].bin.sync_state_with_parent()
+
+    def discard(self, peer_id, pad):
+        '''
+        Drop the media @peer_id sends us on @pad
+        '''
+        # In the bin of the branch, pads don't link across bins
+        sink = Gst.ElementFactory.make('fakesink')
+        sink.set_property('async', False)
+        self.branches[peer_id].bin.add(sink)
+        sink.sync_state_with_parent()
+        pad.link(sink.get_static_pad('sink'))
+
+    def remove(self, peer_id, recordings=()):
+        '''
+        Detach the branch of @peer_id, once the tee is not pushing into it,
+        and once the files of its @recordings (see record.Recording) are
+        finalized
+        '''
+        branch = self.branches.pop(peer_id, None)
+        if branch is None:
+            return
+        if self.rate_controller:
+            self.rate_controller.remove(branch.webrtc)
+
+        def drop():
+            branch.bin.set_state(Gst.State.NULL)
+            self.pipe.remove(branch.bin)
+
+        def unlink(pad, info):
+            pad.unlink(branch.bin.get_static_pad('sink'))
+            self.tee.release_request_pad(pad)
+            if recordings:
+                finish(recordings, then=drop)
+            else:
+                drop()
+            return Gst.PadProbeReturn.REMOVE
+
+        branch.teepad.add_probe(Gst.PadProbeType.IDLE, unlink)
+
+    def __len__(self):
+        return len(self.branches)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Glass-to-glass latency of the sender pipeline
+
+Runs the pipeline of webrtc_sendrecv.py against a receiving webrtcbin in
+the same process (see loopback.py), which depayloads, decodes and displays
+on a fakesink synchronized to the clock like a video sink. Each frame is
+followed through both pipelines by its PTS, and across the call by its RTP
+timestamp, which the receiver reads back from the RTP header: the one clock
+of the process timestamps it when it is captured, enters the encoder, comes
+out of it, is payloaded, comes out of the receiving webrtcbin (after the
+network and the jitterbuffer), is decoded and is displayed. The result is
+the distribution of the time spent in each stage, to compare encoder
+presets, queues and jitterbuffer latencies.
+
+Usage: python3 latency.py [--preset P] [--latency MS] [--duration S] [--json]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstRtp', '1.0')
+from gi.repository import GstRtp
+
+from abr import PRESETS, RateController
+from loopback import Loopback
+from webrtc_sendrecv import build_pipeline, check_plugins
+
+# Format: [(stage, from mark, to mark)], the marks in the order a frame
+# gets them
+STAGES = [
+    ('queue', 'captured', 'encoding'),
+    ('encode', 'encoding', 'encoded'),
+    ('packetize', 'encoded', 'sent'),
+    ('network', 'sent', 'received'),
+    ('decode', 'received', 'decoded'),
+    ('render', 'decoded', 'rendered'),
+    ('total', 'captured', 'rendered'),
+]
+
+DISPLAY_DESC = '''
+rtpvp8depay
+! vp8dec
+  name=decoder
+! fakesink
+  name=display
+  sync=true
+  signal-handoffs=true
+'''
+
+PERCENTILES = (50, 90, 99)
+
+
+def first_buffer(info):
+    '''
+    The buffer of a probe, or the first one of its buffer list
+    '''
+    buf = info.get_buffer()
+    if buf is None:
+        buffers = info.get_buffer_list()
+        if buffers is not None and buffers.length():
+            buf = buffers.get(0)
+    return buf
+
+
+def rtp_timestamp(buf):
+    ok, rtp = GstRtp.RTPBuffer.map(buf, Gst.MapFlags.READ)
+    if not ok:
+        return None
+    try:
+        return rtp.get_timestamp()
+    finally:
+        rtp.unmap()
+
+
+def percentile(values, p):
+    '''
+    @p percentile of the sorted @values
+    '''
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class LatencyProbes:
+    '''
+    Timestamps the frames at each mark of STAGES, and collects the time
+    spent in each stage by the frames displayed between start() and stop()
+    '''
+    # Give up on frames dropped along the way
+    MAX_PENDING = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Frames in flight, each one a {mark: monotonic time}
+        # Format: {sender PTS: frame}
+        self.sending = collections.OrderedDict()
+        # Format: {RTP timestamp: frame}
+        self.in_flight = collections.OrderedDict()
+        # Format: {receiver PTS: frame}
+        self.receiving = collections.OrderedDict()
+        self.measuring = False
+        self.captured = 0
+        # Format: {stage: [milliseconds]}
+        self.samples = collections.defaultdict(list)
+
+    def put(self, table, key, frame):
+        table[key] = frame
+        if len(table) > self.MAX_PENDING:
+            table.popitem(last=False)
+
+    def attach_sender(self, pipe):
+        self.probe(pipe.get_by_name('source').get_static_pad('src'), self.on_captured)
+        encoder = pipe.get_by_name('encoder')
+        self.probe(encoder.get_static_pad('sink'), self.on_mark, 'encoding')
+        self.probe(encoder.get_static_pad('src'), self.on_mark, 'encoded')
+        self.probe(pipe.get_by_name('pay').get_static_pad('src'), self.on_sent)
+
+    def attach_receiver(self, pad):
+        '''
+        Display the stream on @pad, from the receiving webrtcbin
+        '''
+        bin_ = Gst.parse_bin_from_description(DISPLAY_DESC, True)
+        pad.get_parent_element().get_parent().add(bin_)
+        bin_.sync_state_with_parent()
+        pad.link(bin_.get_static_pad('sink'))
+        self.probe(pad, self.on_received)
+        self.probe(bin_.get_by_name('decoder').get_static_pad('src'), self.on_decoded)
+        bin_.get_by_name('display').connect('handoff', self.on_rendered)
+
+    @staticmethod
+    def probe(pad, callback, *args):
+        pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, callback, *args)
+
+    def on_captured(self, pad, info):
+        now = time.monotonic()
+        with self.lock:
+            self.put(self.sending, first_buffer(info).pts, {'captured': now})
+            if self.measuring:
+                self.captured += 1
+        return Gst.PadProbeReturn.OK
+
+    def on_mark(self, pad, info, mark):
+        now = time.monotonic()
+        with self.lock:
+            frame = self.sending.get(first_buffer(info).pts)
+            if frame is not None:
+                frame[mark] = now
+        return Gst.PadProbeReturn.OK
+
+    def on_sent(self, pad, info):
+        now = time.monotonic()
+        buf = first_buffer(info)
+        with self.lock:
+            frame = self.sending.pop(buf.pts, None)
+        if frame is None:
+            # Another packet of a frame already sent
+            return Gst.PadProbeReturn.OK
+        frame['sent'] = now
+        ts = rtp_timestamp(buf)
+        with self.lock:
+            self.put(self.in_flight, ts, frame)
+        return Gst.PadProbeReturn.OK
+
+    def on_received(self, pad, info):
+        now = time.monotonic()
+        buf = first_buffer(info)
+        ts = rtp_timestamp(buf)
+        with self.lock:
+            frame = self.in_flight.pop(ts, None)
+            if frame is not None:
+                frame['received'] = now
+                self.put(self.receiving, buf.pts, frame)
+        return Gst.PadProbeReturn.OK
+
+    def on_decoded(self, pad, info):
+        now = time.monotonic()
+        with self.lock:
+            frame = self.receiving.get(first_buffer(info).pts)
+            if frame is not None:
+                frame['decoded'] = now
+        return Gst.PadProbeReturn.OK
+
+    def on_rendered(self, sink, buf, pad):
+        now = time.monotonic()
+        with self.lock:
+            frame = self.receiving.pop(buf.pts, None)
+            if frame is None or not self.measuring:
+                return
+            frame['rendered'] = now
+            for stage, start, end in STAGES:
+                if start in frame and end in frame:
+                    self.samples[stage].append((frame[end] - frame[start]) * 1000)
+
+    def start(self):
+        with self.lock:
+            self.measuring = True
+
+    def stop(self):
+        with self.lock:
+            self.measuring = False
+
+    def report(self):
+        '''
+        Returns {stage: {count, p50, p90, p99, max}} in milliseconds, and
+        the frames captured and displayed
+        '''
+        with self.lock:
+            stages = {}
+            for stage, _, _ in STAGES:
+                values = sorted(self.samples[stage])
+                if not values:
+                    continue
+                stages[stage] = dict(count=len(values), max=values[-1],
+                                     **{'p{}'.format(p): percentile(values, p) for p in PERCENTILES})
+            return {'captured': self.captured, 'displayed': len(self.samples['total']),
+                    'stages': stages}
+
+
+def print_report(report, args):
+    print('Preset {}, jitterbuffer {} ms: {} frames captured, {} displayed'.format(
+        args.preset, args.latency, report['captured'], report['displayed']))
+    print('{:<10} {:>6} {:>8} {:>8} {:>8} {:>8}'.format('stage (ms)', 'frames', 'p50', 'p90',
+                                                      'p99', 'max'))
+    for stage, _, _ in STAGES:
+        s = report['stages'].get(stage)
+        if s:
+            print('{:<10} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                stage, s['count'], s['p50'], s['p90'], s['p99'], s['max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the glass-to-glass latency of the sender pipeline')
+    parser.add_argument('--preset', default='realtime', choices=PRESETS,
+                        help='Encoder settings of the sender')
+    parser.add_argument('--latency', default=200, type=int,
+                        help='Jitterbuffer latency of the receiver (in milliseconds)')
+    parser.add_argument('--abr', action='store_true',
+                        help='Run the adaptive bitrate, instead of keeping the preset bitrate')
+    parser.add_argument('--warmup', default=3, type=float,
+                        help='Seconds to let the call settle before measuring')
+    parser.add_argument('--duration', default=20, type=float,
+                        help='Seconds to measure for')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args()
+    Gst.init(None)
+    if not check_plugins():
+        sys.exit(1)
+    loop = asyncio.get_event_loop()
+    # Host candidates are enough on loopback
+    pipe = build_pipeline(args.preset, stun_server=None)
+    probes = LatencyProbes()
+    probes.attach_sender(pipe)
+    loopback = Loopback(pipe, probes.attach_receiver, args.latency)
+    if args.abr:
+        rate_controller = RateController(pipe.get_by_name('encoder'), pipe.get_by_name('abrcaps'))
+        rate_controller.add(loopback.sender)
+        rate_controller.start(loop)
+    loopback.start()
+    loop.run_until_complete(asyncio.sleep(args.warmup))
+    probes.start()
+    loop.run_until_complete(asyncio.sleep(args.duration))
+    probes.stop()
+    loopback.stop()
+    report = probes.report()
+    if args.json:
+        print(json.dumps(dict(report, preset=args.preset, latency=args.latency)))
+    else:
+        print_report(report, args)
+    if not report['displayed']:
+        print('No frame was displayed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A sender pipeline and a receiving webrtcbin in the same process
+
+The offer, the answer and the candidates are handed from one webrtcbin to
+the other directly instead of through the signalling server, so a call can
+be measured with nothing else running, and with a single clock on both
+ends.
+"""
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+RECEIVE_DESC = '''
+webrtcbin
+  name=recv
+  bundle-policy=max-bundle
+'''
+
+
+class Loopback:
+    '''
+    Calls the webrtcbin named "sendrecv" in @send_pipe from a receiving
+    webrtcbin with a jitterbuffer of @latency milliseconds. @on_stream(pad)
+    gets the RTP streams it receives.
+    '''
+    def __init__(self, send_pipe, on_stream, latency=200):
+        self.send_pipe = send_pipe
+        self.sender = send_pipe.get_by_name('sendrecv')
+        self.recv_pipe = Gst.parse_launch(RECEIVE_DESC)
+        self.receiver = self.recv_pipe.get_by_name('recv')
+        self.receiver.set_property('latency', latency)
+        self.on_stream = on_stream
+        self.sender.connect('on-negotiation-needed', self.on_negotiation_needed)
+        self.sender.connect('on-ice-candidate', self.on_ice_candidate, self.receiver)
+        self.receiver.connect('on-ice-candidate', self.on_ice_candidate, self.sender)
+        self.receiver.connect('pad-added', self.on_pad_added)
+
+    def start(self):
+        self.recv_pipe.set_state(Gst.State.PLAYING)
+        self.send_pipe.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        self.send_pipe.set_state(Gst.State.NULL)
+        self.recv_pipe.set_state(Gst.State.NULL)
+
+    def on_negotiation_needed(self, element):
+        promise = Gst.Promise.new_with_change_func(self.on_offer_created, None)
+        element.emit('create-offer', None, promise)
+
+    def on_offer_created(self, promise, _):
+        promise.wait()
+        offer = promise.get_reply().get_value('offer')
+        self.set_description(self.sender, 'set-local-description', offer)
+        self.set_description(self.receiver, 'set-remote-description', offer)
+        promise = Gst.Promise.new_with_change_func(self.on_answer_created, None)
+        self.receiver.emit('create-answer', None, promise)
+
+    def on_answer_created(self, promise, _):
+        promise.wait()
+        answer = promise.get_reply().get_value('answer')
+        self.set_description(self.receiver, 'set-local-description', answer)
+        self.set_description(self.sender, 'set-remote-description', answer)
+
+    @staticmethod
+    def set_description(element, signal, desc):
+        promise = Gst.Promise.new()
+        element.emit(signal, desc, promise)
+        promise.interrupt()
+
+    @staticmethod
+    def on_ice_candidate(_, mlineindex, candidate, other):
+        other.emit('add-ice-candidate', mlineindex, candidate)
+
+    def on_pad_added(self, _, pad):
+        if pad.direction == Gst.PadDirection.SRC:
+            self.on_stream(pad)
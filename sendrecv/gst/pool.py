@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pre-warmed pipelines for the GStreamer sender
+
+Building a pipeline, loading its plugins, starting the encoder and gathering
+ICE candidates takes a while, and used to happen after SESSION_OK. The pool
+does all of it ahead of time: its pipelines are already PLAYING, with an
+offer created and set as local description, and their candidates gathered.
+A session claims one, sends the offer and the candidates right away, and the
+pool builds a replacement in the background.
+"""
+import asyncio
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from tracing import traced
+
+
+class PooledPipeline:
+    '''
+    A running pipeline, with the offer of its webrtcbin, and the candidates
+    gathered for it until a session claims it
+    '''
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.webrtc = pipe.get_by_name('sendrecv')
+        self.created = time.monotonic()
+        self.offer = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        # Format: [(mlineindex, candidate)], until claim() sets self.on_candidate
+        self.candidates = []
+        self.on_candidate = None
+        self.on_negotiation = None
+        self.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
+        self.webrtc.connect('on-ice-candidate', self.on_ice_candidate)
+
+    def on_negotiation_needed(self, element):
+        with self.lock:
+            if self.on_negotiation is not None:
+                # Claimed, renegotiation is up to the session
+                on_negotiation = self.on_negotiation
+            elif self.offer is None:
+                on_negotiation = None
+            else:
+                return
+        if on_negotiation is not None:
+            on_negotiation(element)
+            return
+        promise = Gst.Promise.new_with_change_func(self.on_offer_created, element, None)
+        element.emit('create-offer', None, promise)
+
+    @traced
+    def on_offer_created(self, promise, element, _):
+        promise.wait()
+        offer = promise.get_reply().get_value('offer')
+        promise = Gst.Promise.new()
+        element.emit('set-local-description', offer, promise)
+        promise.interrupt()
+        self.offer = offer
+        self.ready.set()
+
+    def on_ice_candidate(self, element, mlineindex, candidate):
+        with self.lock:
+            if self.on_candidate is None:
+                self.candidates.append((mlineindex, candidate))
+                return
+            on_candidate = self.on_candidate
+        on_candidate(element, mlineindex, candidate)
+
+    def claim(self, on_negotiation, on_candidate):
+        '''
+        Hand the webrtcbin over to a session: @on_candidate gets the
+        candidates gathered so far right away, and all the later ones, and
+        @on_negotiation gets the later on-negotiation-needed. The offer is
+        not sent, see self.offer.
+        '''
+        with self.lock:
+            candidates, self.candidates = self.candidates, []
+            self.on_negotiation = on_negotiation
+            self.on_candidate = on_candidate
+        for mlineindex, candidate in candidates:
+            on_candidate(self.webrtc, mlineindex, candidate)
+
+    def close(self):
+        self.pipe.set_state(Gst.State.NULL)
+
+
+class PipelinePool:
+    '''
+    Keeps @size pipelines made by @build() running with their offer ready.
+    Pipelines older than @max_age seconds are replaced, so that the
+    server-reflexive candidates and the encoder state don't go stale.
+    '''
+    # How long to wait for a new pipeline to create its offer
+    READY_TIMEOUT = 10
+
+    def __init__(self, size, build, max_age=60):
+        self.size = size
+        self.build = build
+        self.max_age = max_age
+        self.loop = None
+        # Ready pipelines, the oldest first
+        self.ready = []
+        self.building = 0
+        self.task = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.refill()
+        if self.task is None:
+            self.task = loop.create_task(self.expire())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for pooled in self.ready:
+            pooled.close()
+        self.ready = []
+
+    def refill(self):
+        while len(self.ready) + self.building < self.size:
+            self.building += 1
+            self.loop.create_task(self.add())
+
+    async def add(self):
+        try:
+            # parse_launch and the state change block, keep them off the loop
+            pooled = await self.loop.run_in_executor(None, self.prewarm)
+        except Exception as e:
+            # expire() refills the pool again later
+            print('Could not build a pipeline for the pool: {!r}'.format(e))
+            return
+        finally:
+            self.building -= 1
+        if pooled is None:
+            return
+        if self.task is None:
+            # Stopped meanwhile
+            pooled.close()
+        else:
+            self.ready.append(pooled)
+
+    def prewarm(self):
+        pooled = PooledPipeline(self.build())
+        pooled.pipe.set_state(Gst.State.PLAYING)
+        if not pooled.ready.wait(self.READY_TIMEOUT):
+            print('Pipeline for the pool did not create an offer, dropping it')
+            pooled.close()
+            return None
+        return pooled
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(self.max_age / 4)
+            deadline = time.monotonic() - self.max_age
+            old = [p for p in self.ready if p.created < deadline]
+            self.ready = [p for p in self.ready if p.created >= deadline]
+            for pooled in old:
+                pooled.close()
+            self.refill()
+
+    def claim(self):
+        '''
+        Returns a ready PooledPipeline, or None if there is none
+        '''
+        deadline = time.monotonic() - self.max_age
+        while self.ready:
+            pooled = self.ready.pop(0)
+            if pooled.created >= deadline:
+                self.refill()
+                return pooled
+            pooled.close()
+        self.refill()
+        return None
+
+    def __len__(self):
+        return len(self.ready)
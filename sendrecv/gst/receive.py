@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless receive path: decoded frames as NumPy arrays
+
+Incoming video is decoded, converted once to the requested format, and
+pulled from an appsink by a thread of our own, which hands each frame to a
+callback as a NumPy array over the memory of the Gst.Buffer, without
+copying it. The appsink keeps at most a few frames and drops the oldest, so
+a slow callback skips frames instead of delaying the stream or growing a
+queue.
+"""
+import threading
+import time
+
+import numpy as np
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
+
+# Packed formats the frames can be converted to, with their channels
+CHANNELS = {
+    'GRAY8': 1,
+    'RGB': 3,
+    'BGR': 3,
+    'RGBx': 4,
+    'BGRx': 4,
+    'RGBA': 4,
+    'BGRA': 4,
+}
+
+
+def frame_array(mapinfo, info, channels):
+    '''
+    A read-only (height, width, @channels) array over the mapped memory of a
+    buffer, following the stride and offset of @info. With the gst-python
+    overrides, mapinfo.data is a memoryview of the buffer, not a copy.
+    '''
+    return np.ndarray(
+        shape=(info.height, info.width, channels),
+        dtype=np.uint8,
+        buffer=mapinfo.data,
+        offset=info.offset[0],
+        strides=(info.stride[0], channels, 1))
+
+
+class FrameReceiver:
+    '''
+    Sends the decoded video of each peer to @callback(peer_id, array, pts)
+    in @fmt (see CHANNELS). The array is only valid during the call: copy
+    it to keep it. At most @max_frames frames wait for the callback.
+    '''
+    def __init__(self, callback, fmt='BGR', max_frames=2):
+        if fmt not in CHANNELS:
+            raise ValueError('Unsupported format {}, use one of {}'.format(fmt, ', '.join(CHANNELS)))
+        self.callback = callback
+        self.fmt = fmt
+        self.channels = CHANNELS[fmt]
+        self.max_frames = max_frames
+        # Format: {appsink: threading.Event to stop its thread}
+        self.running = {}
+
+    def attach(self, pipe, pad, peer_id):
+        '''
+        Link the decoded video @pad to a new appsink in @pipe
+        '''
+        bin_ = Gst.parse_bin_from_description(
+            'queue leaky=downstream max-size-buffers={n} max-size-bytes=0 max-size-time=0 '
+            '! videoconvert ! video/x-raw,format={fmt} '
+            '! appsink name=frames sync=false max-buffers={n} drop=true'.format(
+                n=self.max_frames, fmt=self.fmt), True)
+        pipe.add(bin_)
+        bin_.sync_state_with_parent()
+        pad.link(bin_.get_static_pad('sink'))
+        appsink = bin_.get_by_name('frames')
+        stop = self.running[appsink] = threading.Event()
+        thread = threading.Thread(target=self.pull, args=(appsink, peer_id, stop),
+                                  name='frames-{}'.format(peer_id), daemon=True)
+        thread.start()
+
+    def pull(self, appsink, peer_id, stop):
+        info = None
+        caps = None
+        while not stop.is_set():
+            sample = appsink.emit('try-pull-sample', 100 * Gst.MSECOND)
+            if sample is None:
+                # Once the pipeline is stopped, it returns None right away
+                if caps is not None and (appsink.get_property('eos') or
+                                         appsink.get_state(0)[1] < Gst.State.PAUSED):
+                    break
+                continue
+            # PyGObject gives a new wrapper each time, compare the caps
+            # themselves to parse them only when they change
+            sample_caps = sample.get_caps()
+            if caps is None or not caps.is_equal(sample_caps):
+                caps = sample_caps
+                info = GstVideo.VideoInfo()
+                info.from_caps(caps)
+            buf = sample.get_buffer()
+            ok, mapinfo = buf.map(Gst.MapFlags.READ)
+            if not ok:
+                continue
+            frame = frame_array(mapinfo, info, self.channels)
+            try:
+                self.callback(peer_id, frame, buf.pts)
+            finally:
+                # The view must go before the memory it points to
+                del frame
+                buf.unmap(mapinfo)
+        self.running.pop(appsink, None)
+
+    def stop(self):
+        for stop in list(self.running.values()):
+            stop.set()
+
+
+class FrameRate:
+    '''
+    Example callback: prints how many frames each peer sent every @period
+    seconds, without touching the pixels
+    '''
+    def __init__(self, period=5):
+        self.period = period
+        self.lock = threading.Lock()
+        # Format: {peer_id: (frames, since)}
+        self.counts = {}
+
+    def __call__(self, peer_id, frame, pts):
+        now = time.monotonic()
+        with self.lock:
+            frames, since = self.counts.get(peer_id, (0, now))
+            frames += 1
+            if now - since >= self.period:
+                height, width, channels = frame.shape
+                print('Received {:.1f} fps of {}x{}x{} from {}'.format(
+                    frames / (now - since), width, height, channels, peer_id))
+                frames, since = 0, now
+            self.counts[peer_id] = (frames, since)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pass-through recording of the calls
+
+The RTP coming out of webrtcbin, and the encoded video going into the
+payloader, are depayloaded and muxed straight into WebM (or Matroska)
+files, one per stream, without decoding: recording a call costs a muxer,
+not a transcode. splitmuxsink rotates the files by size and time, and each
+recording sits behind a leaky queue of its own, so a slow disk drops
+recorded data instead of blocking the streaming threads.
+"""
+import os
+import re
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
+
+# Format: {caps name or RTP encoding-name: (depayloader, muxer, extension)}
+FORMATS = {
+    'VP8': ('rtpvp8depay', 'webmmux', 'webm'),
+    'VP9': ('rtpvp9depay', 'webmmux', 'webm'),
+    'H264': ('rtph264depay ! h264parse', 'matroskamux', 'mkv'),
+    'OPUS': ('rtpopusdepay ! opusparse', 'webmmux', 'webm'),
+    'video/x-vp8': (None, 'webmmux', 'webm'),
+    'video/x-vp9': (None, 'webmmux', 'webm'),
+}
+
+# Recorded data waiting for the disk, dropped beyond that
+QUEUE_BYTES = 16 * 1024 * 1024
+
+
+def stream_format(caps):
+    '''
+    Returns the FORMATS key and the kind ('video' or 'audio') of @caps, or
+    (None, None) if we can't record them
+    '''
+    s = caps[0]
+    name = s.get_name()
+    if name == 'application/x-rtp':
+        encoding = (s.get_string('encoding-name') or '').upper()
+        kind = s.get_string('media') or 'video'
+        return (encoding, kind) if encoding in FORMATS else (None, None)
+    if name in FORMATS:
+        return name, 'video'
+    return None, None
+
+
+class Recording:
+    '''
+    A queue, a depayloader and a splitmuxsink, linked to @srcpad in @parent,
+    writing @caps to @location (a splitmuxsink pattern, with %05d)
+    '''
+    # How long to wait for the last file to be finalized
+    EOS_TIMEOUT = 5
+
+    def __init__(self, parent, srcpad, caps, location, max_bytes, max_time):
+        fmt, kind = stream_format(caps)
+        depay, muxer, _ = FORMATS[fmt]
+        desc = 'queue leaky=downstream max-size-buffers=0 max-size-time=0 max-size-bytes={}'.format(QUEUE_BYTES)
+        if depay:
+            desc += ' ! ' + depay
+        desc += ' ! splitmuxsink name=split'
+        self.parent = parent
+        self.srcpad = srcpad
+        self.done = threading.Event()
+        self.bin = Gst.parse_bin_from_description(desc, True)
+        split = self.bin.get_by_name('split')
+        split.set_property('location', location)
+        split.set_property('max-size-bytes', max_bytes)
+        split.set_property('max-size-time', int(max_time * Gst.SECOND))
+        if kind == 'video' and max_time and not max_bytes:
+            # Ask for a keyframe where the file should end, instead of
+            # waiting for the next one
+            split.set_property('send-keyframe-requests', True)
+        split.set_property('muxer', Gst.ElementFactory.make(muxer))
+        sink = Gst.ElementFactory.make('filesink')
+        sink.set_property('async', False)
+        sink.set_property('sync', False)
+        sink.get_static_pad('sink').add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_event)
+        split.set_property('sink', sink)
+        parent.add(self.bin)
+        self.bin.sync_state_with_parent()
+        srcpad.link(self.bin.get_static_pad('sink'))
+        if kind == 'video':
+            # Files start on a keyframe, ask for one rather than waiting
+            event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+            self.bin.get_static_pad('sink').send_event(event)
+
+    def on_event(self, pad, info):
+        if info.get_event().type == Gst.EventType.EOS:
+            self.done.set()
+        return Gst.PadProbeReturn.OK
+
+    def send_eos(self):
+        self.bin.get_static_pad('sink').send_event(Gst.Event.new_eos())
+
+    def remove(self):
+        self.srcpad.unlink(self.bin.get_static_pad('sink'))
+        tee = self.srcpad.get_parent_element()
+        self.bin.set_state(Gst.State.NULL)
+        self.parent.remove(self.bin)
+        if tee is not None and tee.get_factory().get_name() == 'tee':
+            tee.release_request_pad(self.srcpad)
+
+
+def finish(recordings, then=None):
+    '''
+    Finalize the files of @recordings, then call @then(), in a thread of its
+    own: the muxers may have a lot of data queued to write. The thread keeps
+    the process alive until it is done.
+    '''
+    def run():
+        for recording in recordings:
+            recording.send_eos()
+        for recording in recordings:
+            if not recording.done.wait(Recording.EOS_TIMEOUT):
+                print('Recording {} was not finalized in time'.format(
+                    recording.bin.get_by_name('split').get_property('location')))
+            recording.remove()
+        if then is not None:
+            then()
+    thread = threading.Thread(target=run, name='finish-recordings')
+    thread.start()
+    return thread
+
+
+class Recorder:
+    '''
+    Records streams to @directory, in files rotated at @max_bytes or
+    @max_time seconds, 0 for no limit
+    '''
+    def __init__(self, directory, max_bytes=0, max_time=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        os.makedirs(directory, exist_ok=True)
+
+    def location(self, peer_id, direction, kind, fmt):
+        name = '{}-{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                    re.sub(r'[^\w.-]', '_', peer_id), direction, kind)
+        return os.path.join(self.directory, '{}-%05d.{}'.format(name, FORMATS[fmt][2]))
+
+    def record(self, parent, srcpad, caps, peer_id, direction):
+        '''
+        Returns a Recording of @srcpad, a free pad with @caps in @parent, or
+        None if the format can't be recorded
+        '''
+        fmt, kind = stream_format(caps)
+        if fmt is None:
+            print('Not recording {} {}: {}'.format(direction, peer_id, caps.to_string()))
+            return None
+        location = self.location(peer_id, direction, kind, fmt)
+        print('Recording {} {} to {}'.format(direction, peer_id, location))
+        return Recording(parent, srcpad, caps, location, self.max_bytes, self.max_time)
+
+    def record_outgoing(self, pipe, name):
+        '''
+        Record the encoded video of @pipe, from its tee named "encoded"
+        '''
+        tee = pipe.get_by_name('encoded')
+        caps = Gst.Caps.from_string('video/x-vp8')
+        return self.record(tee.get_parent(), tee.get_request_pad('src_%u'), caps, name, 'out')
+
+    def record_incoming(self, pad, peer_id):
+        '''
+        Record the RTP webrtcbin gives on @pad. Returns the Recording, or
+        None, and a pad with the same stream, for the rest of the pipeline.
+        '''
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        parent = pad.get_parent_element().get_parent()
+        if stream_format(caps)[0] is None:
+            return None, pad
+        tee = Gst.ElementFactory.make('tee')
+        tee.set_property('allow-not-linked', True)
+        parent.add(tee)
+        tee.sync_state_with_parent()
+        pad.link(tee.get_static_pad('sink'))
+        recording = self.record(parent, tee.get_request_pad('src_%u'), caps, peer_id, 'in')
+        return recording, tee.get_request_pad('src_%u')
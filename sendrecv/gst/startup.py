@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup and reconnection helpers for the GStreamer sender
+
+Instead of sleeping a fixed time before connecting, the sender polls the
+/health route of the signalling server until it answers, reconnects with
+exponential backoff and jitter, and records how long each startup phase
+took, which is what decides how fast a new container is useful.
+"""
+import asyncio
+import random
+import ssl
+import time
+import urllib.error
+import urllib.request
+
+from websockets.uri import parse_uri
+
+
+class Backoff:
+    '''
+    Exponential backoff from @initial to @maximum seconds, with full jitter
+    so that many senders restarted together don't reconnect in lockstep
+    '''
+    def __init__(self, initial=0.5, maximum=30, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempt = 0
+
+    def delay(self):
+        ceiling = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class Timings:
+    '''
+    Durations of the startup phases, each one since the previous
+    '''
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        # Format: [(phase, milliseconds)]
+        self.phases = []
+        self.reported = False
+
+    def mark(self, phase):
+        if self.reported:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+
+    def report(self):
+        if self.reported:
+            return None
+        self.reported = True
+        total = (self.last - self.start) * 1000
+        print('Startup: {}, total {:.0f} ms'.format(
+            ', '.join('{} {:.0f} ms'.format(p, ms) for p, ms in self.phases), total))
+        return dict(self.phases, total=total)
+
+
+def health_url(server, path):
+    '''
+    The health check route of the signalling server at the websocket URL
+    @server
+    '''
+    wsuri = parse_uri(server)
+    host = '[{}]'.format(wsuri.host) if ':' in wsuri.host else wsuri.host
+    return '{}://{}:{}{}'.format('https' if wsuri.secure else 'http', host, wsuri.port, path)
+
+
+def _get_status(url, timeout):
+    # The demo server uses a self-signed certificate, and the websocket
+    # connection does not verify it either
+    ctx = ssl._create_unverified_context() if url.startswith('https') else None
+    with urllib.request.urlopen(url, timeout=timeout, context=ctx) as r:
+        return r.status
+
+
+async def wait_ready(url, backoff=None, timeout=2):
+    '''
+    Poll @url until it answers 200
+    '''
+    backoff = backoff or Backoff(initial=0.1, maximum=2)
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            if await loop.run_in_executor(None, _get_status, url, timeout) == 200:
+                return
+        except (OSError, urllib.error.URLError):
+            pass
+        await asyncio.sleep(backoff.delay())
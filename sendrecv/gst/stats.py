@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Periodic WebRTC stats for the GStreamer sender
+
+StatsCollector calls get-stats on every webrtcbin it watches, flattens the
+reply into one flat record per RTP stream, and adds a record for the encoder
+from pad probes. Records go to a ring buffer, served as JSON over HTTP by
+StatsServer for the /stats page of the front, and optionally to a rotating
+JSON-lines file. The replies are handled on GStreamer threads, so neither
+the file nor the HTTP server ever block the signalling loop.
+"""
+import asyncio
+import collections
+import http.server
+import json
+import logging
+import logging.handlers
+import threading
+import time
+import urllib.parse
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+
+from tracing import traced
+
+# Format: {stats type: [(GstStructure field, record key, type)]}
+FIELDS = {
+    GstWebRTC.WebRTCStatsType.OUTBOUND_RTP: [
+        ('ssrc', 'ssrc', int),
+        ('packets-sent', 'packets_sent', int),
+        ('bytes-sent', 'bytes_sent', int),
+        ('nack-count', 'nacks', int),
+        ('pli-count', 'plis', int),
+    ],
+    GstWebRTC.WebRTCStatsType.REMOTE_INBOUND_RTP: [
+        ('ssrc', 'ssrc', int),
+        ('packets-lost', 'packets_lost', int),
+        ('fraction-lost', 'fraction_lost', float),
+        ('jitter', 'jitter', float),
+        ('round-trip-time', 'rtt', float),
+    ],
+    GstWebRTC.WebRTCStatsType.INBOUND_RTP: [
+        ('ssrc', 'ssrc', int),
+        ('packets-received', 'packets_received', int),
+        ('bytes-received', 'bytes_received', int),
+        ('packets-lost', 'packets_lost', int),
+        ('jitter', 'jitter', float),
+    ],
+}
+
+# Byte counters to compute a bitrate from
+BYTES_FIELDS = ('bytes_sent', 'bytes_received')
+
+
+def flatten(reply):
+    '''
+    Returns the records of the get-stats @reply: [{type, id, ...}]
+    with the fields of FIELDS that are present
+    '''
+    records = []
+
+    def collect(_, value):
+        if not isinstance(value, Gst.Structure):
+            return True
+        kind = value.get_value('type')
+        fields = FIELDS.get(kind)
+        if fields is None:
+            return True
+        record = {'type': kind.value_nick, 'id': value.get_value('id')}
+        for field, key, cast in fields:
+            if value.has_field(field):
+                record[key] = cast(value.get_value(field))
+        records.append(record)
+        return True
+    reply.foreach(collect)
+    return records
+
+
+class EncoderProbe:
+    '''
+    Counts the frames out of @encoder and how long they spent in it
+    '''
+    # Give up on frames the encoder dropped
+    MAX_PENDING = 64
+
+    def __init__(self, encoder):
+        self.lock = threading.Lock()
+        # Format: {pts: monotonic time in}
+        self.pending = collections.OrderedDict()
+        self.frames = 0
+        self.encode_time = 0.0
+        encoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_input)
+        encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.on_output)
+
+    def on_input(self, pad, info):
+        with self.lock:
+            self.pending[info.get_buffer().pts] = time.monotonic()
+            if len(self.pending) > self.MAX_PENDING:
+                self.pending.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def on_output(self, pad, info):
+        now = time.monotonic()
+        with self.lock:
+            start = self.pending.pop(info.get_buffer().pts, None)
+            self.frames += 1
+            if start is not None:
+                self.encode_time += now - start
+        return Gst.PadProbeReturn.OK
+
+    def take(self):
+        '''
+        Returns (frames, seconds spent encoding them) since the last call
+        '''
+        with self.lock:
+            frames, encode_time = self.frames, self.encode_time
+            self.frames, self.encode_time = 0, 0.0
+        return frames, encode_time
+
+
+class StatsCollector:
+    '''
+    Every @interval seconds, collects the stats of the webrtcbins added with
+    add() and of the encoder given to watch_encoder(). The last @ring_size
+    records are kept in memory, and if @path is given, all of them are
+    appended to it as JSON lines, rotated at @max_bytes with @backups old
+    files kept.
+    '''
+    def __init__(self, interval=1.0, ring_size=600, path=None, max_bytes=10 * 1024 * 1024,
+                 backups=5):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.ring = collections.deque(maxlen=ring_size)
+        self.seq = 0
+        # Format: {peer_id: webrtcbin}
+        self.webrtcs = {}
+        # Format: {(peer_id, stats id): (monotonic time, bytes)}
+        self.previous = {}
+        self.encoder = None
+        self.encoder_stamp = None
+        self.task = None
+        self.log = None
+        if path:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                           backupCount=backups)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.log = logging.getLogger('webrtc-stats')
+            self.log.propagate = False
+            self.log.setLevel(logging.INFO)
+            self.log.addHandler(handler)
+
+    def add(self, peer_id, webrtc):
+        with self.lock:
+            self.webrtcs[peer_id] = webrtc
+
+    def remove(self, peer_id):
+        with self.lock:
+            self.webrtcs.pop(peer_id, None)
+            for key in [k for k in self.previous if k[0] == peer_id]:
+                del self.previous[key]
+
+    def watch_encoder(self, encoder):
+        self.encoder = EncoderProbe(encoder)
+        self.encoder_stamp = time.monotonic()
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.poll()
+
+    def poll(self):
+        with self.lock:
+            webrtcs = list(self.webrtcs.items())
+        for peer_id, webrtc in webrtcs:
+            promise = Gst.Promise.new_with_change_func(self.on_stats, peer_id)
+            webrtc.emit('get-stats', None, promise)
+        if self.encoder is not None:
+            now = time.monotonic()
+            frames, encode_time = self.encoder.take()
+            elapsed, self.encoder_stamp = now - self.encoder_stamp, now
+            self.add_records([{
+                'type': 'encoder',
+                'frames_encoded': frames,
+                'fps': frames / elapsed if elapsed else 0,
+                'encode_time_ms': encode_time / frames * 1000 if frames else None,
+            }])
+
+    @traced
+    def on_stats(self, promise, peer_id):
+        reply = promise.get_reply()
+        if reply is None:
+            return
+        records = flatten(reply)
+        now = time.monotonic()
+        with self.lock:
+            if peer_id not in self.webrtcs:
+                return
+            for record in records:
+                record['peer'] = peer_id
+                for field in BYTES_FIELDS:
+                    if field not in record:
+                        continue
+                    key = (peer_id, record['id'])
+                    previous = self.previous.get(key)
+                    self.previous[key] = (now, record[field])
+                    if previous and now > previous[0]:
+                        record['bitrate'] = int((record[field] - previous[1]) * 8 /
+                                                (now - previous[0]))
+        self.add_records(records)
+
+    def add_records(self, records):
+        now = time.time()
+        with self.lock:
+            for record in records:
+                self.seq += 1
+                record['seq'] = self.seq
+                record['time'] = now
+                self.ring.append(record)
+        if self.log:
+            for record in records:
+                self.log.info(json.dumps(record))
+
+    def since(self, seq=0):
+        '''
+        Returns the records in the ring buffer after @seq
+        '''
+        with self.lock:
+            return [r for r in self.ring if r['seq'] > seq]
+
+
+class StatsServer(http.server.ThreadingHTTPServer):
+    '''
+    Serves GET /stats?since=<seq> from the ring buffer of @collector, in a
+    thread of its own
+    '''
+    daemon_threads = True
+
+    def __init__(self, collector, port, addr=''):
+        super().__init__((addr, port), StatsHandler)
+        self.collector = collector
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/stats':
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            since = int(query.get('since', ['0'])[0])
+        except ValueError:
+            self.send_error(400, 'since must be an integer')
+            return
+        body = json.dumps({'records': self.server.collector.since(since)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Polled every second by the front, don't flood the console
+        pass
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Low-overhead tracing for the GStreamer sender
+
+Spans of the signalling messages, promise callbacks and decorated calls,
+and the state changes of the pipelines, go to a ring buffer with monotonic
+timestamps, and are saved in the Chrome trace format, which Perfetto and
+chrome://tracing open. The latency and proctime tracers of GStreamer can be
+merged in. Tracing is switched on and off at runtime; while it is off, a
+traced call costs one attribute check.
+"""
+import collections
+import contextlib
+from functools import wraps
+import json
+import os
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+# What GST_TRACERS is set to by enable_gst_tracers()
+GST_TRACERS = 'latency(flags=pipeline+element);proctime'
+
+# Returned by span() while tracing is off
+NO_SPAN = contextlib.nullcontext()
+
+
+def now_us():
+    return time.monotonic_ns() / 1000
+
+
+class Tracer:
+    '''
+    Keeps the last @size events, and saves them to @path
+    '''
+    def __init__(self, size=100000, path='webrtc-trace.json'):
+        self.enabled = False
+        self.path = path
+        # Format: (phase, name, category, ts, dur, tid, args), times in us
+        self.events = collections.deque(maxlen=size)
+
+    def enable(self):
+        self.enabled = True
+        print('Tracing on')
+
+    def disable(self):
+        self.enabled = False
+        print('Tracing off')
+
+    def toggle(self):
+        '''
+        Switch tracing on, or off and save what was traced
+        '''
+        if self.enabled:
+            self.disable()
+            self.save()
+        else:
+            self.enable()
+
+    def add(self, phase, name, cat, ts, dur=0, args=None):
+        # deque.append is atomic, no lock needed across threads
+        self.events.append((phase, name, cat, ts, dur, threading.get_ident(), args))
+
+    def instant(self, name, cat, **args):
+        if self.enabled:
+            self.add('i', name, cat, now_us(), args=args or None)
+
+    def span(self, name, cat, **args):
+        '''
+        Context manager timing its block as @name
+        '''
+        if not self.enabled:
+            return NO_SPAN
+        return self._span(name, cat, args or None)
+
+    @contextlib.contextmanager
+    def _span(self, name, cat, args):
+        start = now_us()
+        try:
+            yield
+        finally:
+            self.add('X', name, cat, start, now_us() - start, args)
+
+    def watch(self, pipe):
+        '''
+        Trace the state changes of @pipe and of its elements
+        '''
+        bus = pipe.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect('sync-message::state-changed', self.on_state_changed)
+
+    def on_state_changed(self, bus, message):
+        if not self.enabled:
+            return
+        old, new, pending = message.parse_state_changed()
+        self.add('i', '{} {} -> {}'.format(message.src.get_name(), old.value_nick, new.value_nick),
+                 'state', now_us())
+
+    def on_gst_log(self, category, level, file, function, line, obj, message, *user_data):
+        if not self.enabled or category.get_name() != 'GST_TRACER':
+            return
+        end = now_us()
+        s = Gst.Structure.new_from_string(message.get())
+        if s is None or not s.has_field('time'):
+            return
+        kind = s.get_name()
+        if kind == 'latency':
+            name = '{}.{} -> {}.{}'.format(s.get_string('src-element'), s.get_string('src'),
+                                          s.get_string('sink-element'), s.get_string('sink'))
+        else:
+            # element-latency, proctime
+            name = s.get_string('element')
+        dur = s.get_value('time') / 1000
+        self.add('X', name, 'gst.' + kind, end - dur, dur)
+
+    def to_chrome(self):
+        '''
+        The events in the Chrome trace format
+        '''
+        pid = os.getpid()
+        events = []
+        for phase, name, cat, ts, dur, tid, args in list(self.events):
+            event = {'ph': phase, 'name': name, 'cat': cat, 'ts': ts, 'pid': pid, 'tid': tid}
+            if phase == 'X':
+                event['dur'] = dur
+            elif phase == 'i':
+                event['s'] = 't'
+            if args:
+                event['args'] = args
+            events.append(event)
+        for thread in threading.enumerate():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': thread.ident,
+                           'args': {'name': thread.name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path=None):
+        if not self.events:
+            return
+        path = path or self.path
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome(), f)
+        print('Saved {} trace events to {}'.format(len(self.events), path))
+
+
+tracer = Tracer()
+
+
+def traced(func):
+    '''
+    Trace the calls to @func as spans
+    '''
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*a, **kw):
+        if not tracer.enabled:
+            return func(*a, **kw)
+        start = now_us()
+        try:
+            return func(*a, **kw)
+        finally:
+            tracer.add('X', name, 'call', start, now_us() - start)
+    return wrapper
+
+
+def traced_async(func):
+    '''
+    Same as traced() for a coroutine function
+    '''
+    name = func.__qualname__
+
+    @wraps(func)
+    async def wrapper(*a, **kw):
+        if not tracer.enabled:
+            return await func(*a, **kw)
+        start = now_us()
+        try:
+            return await func(*a, **kw)
+        finally:
+            tracer.add('X', name, 'call', start, now_us() - start)
+    return wrapper
+
+
+def enable_gst_tracers():
+    '''
+    Turn on the GStreamer latency and proctime tracers, before Gst.init()
+    '''
+    os.environ.setdefault('GST_TRACERS', GST_TRACERS)
+    debug = os.environ.get('GST_DEBUG')
+    os.environ['GST_DEBUG'] = debug + ',GST_TRACER:7' if debug else 'GST_TRACER:7'
+    return debug is None
+
+
+def merge_gst_tracers(quiet):
+    '''
+    Record what the GStreamer tracers log, after Gst.init(). With @quiet,
+    stop printing the debug log.
+    '''
+    if quiet:
+        Gst.debug_remove_log_function(None)
+    Gst.debug_add_log_function(tracer.on_gst_log, None)
@@ -3,12 +3,16 @@
 """"""
 import argparse
 import asyncio
-from functools import wraps
+import atexit
+import collections
+from functools import partial
 import json
 import os
 import random
+import signal
 import ssl
 import sys
+import threading
 import time
 
 import gi
@@ -18,14 +22,26 @@ gi.require_version('GstWebRTC', '1.0')
 from gi.repository import GstWebRTC
 gi.require_version('GstSdp', '1.0')
 from gi.repository import GstSdp
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
 import websockets
 from websockets.version import version as wsv
 from websockets.uri import parse_uri
 
+from abr import PRESETS, SOURCE_CAPS, RateController, apply_preset
+from fanout import STUN_SERVER, Fanout
+from pool import PipelinePool
+from record import Recorder, finish
+from startup import Backoff, Timings, health_url, wait_ready
+from stats import StatsCollector, StatsServer
+from tracing import enable_gst_tracers, merge_gst_tracers, traced, traced_async, tracer
+
 PIPELINE_DESC = '''
 videotestsrc
+  name=source
   is-live=true
   pattern=ball
+! {source_caps}
 ! timeoverlay
   font-desc="Sans, 36"
   halignment=center
@@ -34,18 +50,26 @@ videotestsrc
   name=t
 
 t.
+! videorate
+! videoscale
+! capsfilter
+  name=abrcaps
 ! videoconvert
 ! queue
 ! vp8enc
+  name=encoder
   deadline=1
+! tee
+  name=encoded
+  allow-not-linked=true
 ! rtpvp8pay
+  name=pay
 ! queue 
 ! application/x-rtp,media=video,encoding-name=VP8,payload=97
 ! webrtcbin
   name=sendrecv
   bundle-policy=max-bundle
-  stun-server=stun://stun.l.google.com:19302
-'''
+'''.format(source_caps=SOURCE_CAPS)
 # t.
 # ! queue
 # ! videoconvert
@@ -53,29 +77,11 @@ t.
 # '''
 
 
-def traced(func):
-
-    @wraps(func)
-    def wrapper(*a, **kw):
-        print(f'CALL: {func.__qualname__}(*{a},**{kw})')
-        ret = func(*a, **kw)
-        print(f'EXIT: {func.__qualname__} -> {ret}')
-        return ret
-    return wrapper
-
-def traced_async(func):
-
-    @wraps(func)
-    async def wrapper(*a, **kw):
-        print(f'CALL: {func.__qualname__}(*{a},**{kw})')
-        ret = await func(*a, **kw)
-        print(f'EXIT: {func.__qualname__} -> {ret}')
-        return ret
-    return wrapper
-
 class WebRTCClient:
     @traced
-    def __init__(self, id_, peer_id, server):
+    def __init__(self, id_, peer_id, server, ice_coalesce_ms=0, fanout=None, room=False,
+                 preset='realtime', abr=None, stats=None, pool=None, timings=None,
+                 receiver=None, recorder=None, stun_server=STUN_SERVER):
         self.id_ = id_
         self.conn = None
         self.pipe = None
@@ -84,48 +90,167 @@ class WebRTCClient:
         if not server:
             raise ValueError
         self.server = server or 'wss://webrtc.nirbheek.in:8443'
+        # Candidates queued within this window of the previous ones sent are
+        # sent together as {"ice": [...]}, the first one of a burst is not
+        # delayed
+        self.ice_window = ice_coalesce_ms / 1000
+        # Messages from the GStreamer threads, sent in order by the writer
+        # task on the event loop that owns self.conn
+        # Format: [(kind, msg)], kind is 'ice' for a candidate dict
+        self.event_loop = None
+        self.outbox = collections.deque()
+        self.outbox_ready = None
+        self.writer = None
+        # For the offer to first candidate latency
+        self.offer_time = None
+        # Shared source and encoder (fanout.Fanout), instead of a pipeline of
+        # our own
+        self.fanout = fanout
+        # Messages go through ROOM_PEER_MSG, on a connection shared with the
+        # other peers of the room (see RoomFanout)
+        self.room = room
+        # Encoder preset (see abr.PRESETS), and RateController options or
+        # None to keep a fixed bitrate. Both only apply to our own pipeline,
+        # the Fanout has its own.
+        self.preset = preset
+        self.abr = abr
+        self.rate_controller = None
+        # stats.StatsCollector shared by all the peers, or None
+        self.stats = stats
+        # pool.PipelinePool to take a running pipeline from, or None
+        self.pool = pool
+        self.pooled = False
+        # For the SESSION_OK to first RTP packet latency
+        self.session_ok_time = None
+        self.first_rtp_lock = threading.Lock()
+        self.first_rtp_watched = False
+        # Resume token from the server, to keep the call across reconnections
+        self.token = None
+        # Whether the last connection got as far as a call: SESSION_OK, or
+        # a resumed session
+        self.established = False
+        # startup.Timings to mark, or None
+        self.timings = timings
+        # receive.FrameReceiver to hand the video of the peer to, instead of
+        # displaying it, or None
+        self.receiver = receiver
+        # record.Recorder for the media of the call, or None
+        self.recorder = recorder
+        self.recordings = []
+        # For our own pipeline, None for host candidates only
+        self.stun_server = stun_server
         # self.server = 'wss://webrtc.nirbheek.in:8443'
 
 
     @traced_async
     async def connect(self):
-        wsuri = traced(parse_uri)(self.server)
+        wsuri = parse_uri(self.server)
         if wsuri.secure:
             sslctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
         else:
             sslctx = None
+        self.established = False
         self.conn = await websockets.connect(self.server, ssl=sslctx)
-        await self.conn.send('HELLO %d' % self.id_)
+        if self.timings:
+            self.timings.mark('connect')
+        await self.conn.send(hello_message(self.id_, self.token))
+
+    def start_writer(self, conn):
+        '''
+        Start sending the queued messages on @conn, replacing the writer of a
+        previous connection
+        '''
+        if self.writer:
+            self.writer.cancel()
+        self.conn = conn
+        self.event_loop = asyncio.get_event_loop()
+        self.outbox_ready = asyncio.Event()
+        if self.outbox:
+            self.outbox_ready.set()
+        self.writer = self.event_loop.create_task(self.write_messages())
 
     async def setup_call(self):
         await self.conn.send('SESSION {}'.format(self.peer_id))
 
+    def post(self, kind, msg):
+        '''
+        Queue @msg for the writer task, from any thread
+        '''
+        self.event_loop.call_soon_threadsafe(self.enqueue, kind, msg)
+
+    def enqueue(self, kind, msg):
+        self.outbox.append((kind, msg))
+        self.outbox_ready.set()
+
+    async def write_messages(self):
+        try:
+            await self._write_messages()
+        except websockets.ConnectionClosed:
+            # self.loop() notices it too
+            pass
+
+    async def _write_messages(self):
+        # When the last candidates were sent
+        ice_sent = None
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            while self.outbox:
+                kind, msg = self.outbox[0]
+                if kind != 'ice':
+                    self.outbox.popleft()
+                    await self.send(msg)
+                    continue
+                if self.ice_window and ice_sent is not None:
+                    # In a burst, let more candidates queue until the end of
+                    # the window
+                    delay = ice_sent + self.ice_window - self.event_loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                candidates = []
+                while self.outbox and self.outbox[0][0] == 'ice':
+                    candidates.append(self.outbox.popleft()[1])
+                    if not self.ice_window:
+                        break
+                if self.offer_time is not None:
+                    print('Offer to first ICE candidate sent: {:.1f} ms'.format(
+                        (time.perf_counter() - self.offer_time) * 1000))
+                    self.offer_time = None
+                await self.send(json.dumps(
+                    {'ice': candidates if len(candidates) > 1 else candidates[0]}))
+                ice_sent = self.event_loop.time()
+
+    async def send(self, msg):
+        if self.room:
+            msg = 'ROOM_PEER_MSG {} {}'.format(self.peer_id, msg)
+        with tracer.span('send', 'signalling', head=msg[:24]):
+            await self.conn.send(msg)
+
     def send_sdp_offer(self, offer):
         text = offer.sdp.as_text()
         print ('Sending offer:\n%s' % text)
         msg = json.dumps({'sdp': {'type': 'offer', 'sdp': text}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(msg))
-        loop.close()
+        self.post('sdp', msg)
 
+    @traced
     def on_offer_created(self, promise, _, __):
         promise.wait()
         reply = promise.get_reply()
         offer = reply.get_value('offer')
+        self.offer_time = time.perf_counter()
+        # Queue the offer before gathering starts, so that it goes out before
+        # the candidates
+        self.send_sdp_offer(offer)
         promise = Gst.Promise.new()
         self.webrtc.emit('set-local-description', offer, promise)
         promise.interrupt()
-        self.send_sdp_offer(offer)
 
     def on_negotiation_needed(self, element):
         promise = Gst.Promise.new_with_change_func(self.on_offer_created, element, None)
         element.emit('create-offer', None, promise)
 
     def send_ice_candidate_message(self, _, mlineindex, candidate):
-        icemsg = json.dumps({'ice': {'candidate': candidate, 'sdpMLineIndex': mlineindex}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(icemsg))
-        loop.close()
+        self.post('ice', {'candidate': candidate, 'sdpMLineIndex': mlineindex})
 
     def on_incoming_decodebin_stream(self, _, pad):
         if not pad.has_current_caps():
@@ -136,7 +261,17 @@ class WebRTCClient:
         assert (len(caps))
         s = caps[0]
         name = s.get_name()
-        if name.startswith('video'):
+        if self.receiver is not None:
+            if name.startswith('video'):
+                self.receiver.attach(self.pipe, pad, self.peer_id)
+            else:
+                # Headless, nothing to play the audio on
+                sink = Gst.ElementFactory.make('fakesink')
+                sink.set_property('async', False)
+                self.pipe.add(sink)
+                sink.sync_state_with_parent()
+                pad.link(sink.get_static_pad('sink'))
+        elif name.startswith('video'):
             q = Gst.ElementFactory.make('queue')
             conv = Gst.ElementFactory.make('videoconvert')
             sink = Gst.ElementFactory.make('autovideosink')
@@ -160,21 +295,108 @@ class WebRTCClient:
     def on_incoming_stream(self, _, pad):
         if pad.direction != Gst.PadDirection.SRC:
             return
+        if self.recorder:
+            recording, pad = self.recorder.record_incoming(pad, self.peer_id)
+            if recording:
+                self.recordings.append(recording)
+        if self.fanout:
+            self.fanout.discard(self.peer_id, pad)
+            return
 
         decodebin = Gst.ElementFactory.make('decodebin')
         decodebin.connect('pad-added', self.on_incoming_decodebin_stream)
         self.pipe.add(decodebin)
         decodebin.sync_state_with_parent()
-        self.webrtc.link(decodebin)
+        pad.link(decodebin.get_static_pad('sink'))
 
     def start_pipeline(self):
-        self.pipe = Gst.parse_launch(PIPELINE_DESC)
-        self.webrtc = self.pipe.get_by_name('sendrecv')
+        pooled = None
+        if self.fanout:
+            self.pipe = self.fanout.pipe
+            self.webrtc = self.fanout.add(self.peer_id)
+        else:
+            pooled = self.pool.claim() if self.pool else None
+            if pooled:
+                self.pipe = pooled.pipe
+            else:
+                self.pipe = build_pipeline(self.preset, self.stun_server)
+            self.webrtc = self.pipe.get_by_name('sendrecv')
+            encoder = self.pipe.get_by_name('encoder')
+            if self.abr is not None:
+                self.rate_controller = RateController(
+                    encoder, self.pipe.get_by_name('abrcaps'), **self.abr)
+                self.rate_controller.add(self.webrtc)
+                self.rate_controller.start(asyncio.get_event_loop())
+            if self.stats:
+                self.stats.watch_encoder(encoder)
+            if self.recorder:
+                self.recordings.append(self.recorder.record_outgoing(self.pipe, self.peer_id))
+        self.pooled = pooled is not None
+        self.webrtc.connect('pad-added', self.on_incoming_stream)
+        self.webrtc.connect('notify::ice-connection-state', self.on_ice_connection_state)
+        if self.stats:
+            self.stats.add(self.peer_id, self.webrtc)
+        if pooled:
+            # Already playing, with an offer and candidates
+            self.offer_time = time.perf_counter()
+            self.send_sdp_offer(pooled.offer)
+            pooled.claim(self.on_negotiation_needed, self.send_ice_candidate_message)
+            return
         self.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
         self.webrtc.connect('on-ice-candidate', self.send_ice_candidate_message)
-        self.webrtc.connect('pad-added', self.on_incoming_stream)
-        self.pipe.set_state(Gst.State.PLAYING)
+        if self.fanout:
+            self.fanout.play(self.peer_id)
+        else:
+            self.pipe.set_state(Gst.State.PLAYING)
+
+    def on_ice_connection_state(self, webrtc, _):
+        state = webrtc.get_property('ice-connection-state')
+        if state not in (GstWebRTC.WebRTCICEConnectionState.CONNECTED,
+                         GstWebRTC.WebRTCICEConnectionState.COMPLETED):
+            return
+        with self.first_rtp_lock:
+            if self.first_rtp_watched:
+                return
+            self.first_rtp_watched = True
+        if self.pooled:
+            # The encoder has been running without anyone to send to, don't
+            # wait for the receiver to ask for a keyframe
+            event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+            self.pipe.get_by_name('encoder').get_static_pad('src').send_event(event)
+        if self.session_ok_time is None:
+            return
+        for element in webrtc.iterate_recurse():
+            factory = element.get_factory()
+            if factory and factory.get_name() == 'nicesink':
+                element.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER,
+                                                         self.on_first_packet)
+
+    def on_first_packet(self, pad, info):
+        '''
+        Reports the time from SESSION_OK until the first RTP packet leaves,
+        after the STUN and DTLS packets
+        '''
+        ok, mapinfo = info.get_buffer().map(Gst.MapFlags.READ)
+        if not ok:
+            return Gst.PadProbeReturn.OK
+        header = bytes(mapinfo.data[:2])
+        info.get_buffer().unmap(mapinfo)
+        # RTP version 2, and not an RTCP packet type (RFC 5761)
+        if len(header) < 2 or header[0] >> 6 != 2 or 192 <= header[1] <= 223:
+            return Gst.PadProbeReturn.OK
+        with self.first_rtp_lock:
+            if self.session_ok_time is None:
+                return Gst.PadProbeReturn.REMOVE
+            elapsed = (time.perf_counter() - self.session_ok_time) * 1000
+            self.session_ok_time = None
+        kind = 'pooled' if self.pooled else 'fresh'
+        print('SESSION_OK to first RTP packet: {:.1f} ms ({} pipeline)'.format(elapsed, kind))
+        if self.stats:
+            self.stats.add_records([{'type': 'session', 'peer': self.peer_id,
+                                     'first_rtp_ms': elapsed, 'pipeline': kind}])
+        return Gst.PadProbeReturn.REMOVE
 
+    @traced
     def handle_sdp(self, message):
         assert (self.webrtc)
         msg = json.loads(message)
@@ -190,38 +412,252 @@ class WebRTCClient:
             self.webrtc.emit('set-remote-description', answer, promise)
             promise.interrupt()
         elif 'ice' in msg:
-            ice = msg['ice']
-            candidate = ice['candidate']
-            sdpmlineindex = ice['sdpMLineIndex']
-            self.webrtc.emit('add-ice-candidate', sdpmlineindex, candidate)
+            # Candidates may be coalesced into a list, by the server or the peer
+            ices = msg['ice'] if isinstance(msg['ice'], list) else [msg['ice']]
+            for ice in ices:
+                if ice is None:
+                    # End of candidates
+                    continue
+                candidate = ice['candidate']
+                sdpmlineindex = ice['sdpMLineIndex']
+                self.webrtc.emit('add-ice-candidate', sdpmlineindex, candidate)
 
     def close_pipeline(self):
-        self.pipe.set_state(Gst.State.NULL)
+        self.outbox.clear()
+        if self.pipe is None:
+            return
+        if self.rate_controller:
+            self.rate_controller.stop()
+            self.rate_controller = None
+        if self.stats:
+            self.stats.remove(self.peer_id)
+        if self.receiver:
+            self.receiver.stop()
+        # Their files are finalized before the pipeline goes
+        recordings, self.recordings = self.recordings, []
+        if self.fanout:
+            self.fanout.remove(self.peer_id, recordings)
+        elif recordings:
+            finish(recordings, then=partial(self.pipe.set_state, Gst.State.NULL))
+        else:
+            self.pipe.set_state(Gst.State.NULL)
         self.pipe = None
         self.webrtc = None
 
+    async def on_hello(self, words):
+        if self.timings:
+            self.timings.mark('hello')
+        if words[:1] == ['RESUMED']:
+            self.token = words[1]
+            if 'SESSION' in words[2:] and self.pipe is not None:
+                # The call went on without us, send what we queued meanwhile
+                print('Resumed the session with {}'.format(self.peer_id))
+                self.established = True
+                self.start_writer(self.conn)
+                return
+        else:
+            self.token = words[0] if words else None
+        self.outbox.clear()
+        self.start_writer(self.conn)
+        if self.pipe is not None:
+            # The server forgot about our call, start over
+            self.close_pipeline()
+        await self.setup_call()
+
     async def loop(self):
+        '''
+        Returns 0 once the call is over, 1 on ERROR, or None if the
+        connection was lost and the call can be resumed
+        '''
         assert self.conn
         async for message in self.conn:
-            if message == 'HELLO':
-                await self.setup_call()
+            tracer.instant('recv', 'signalling', head=message[:24])
+            if message.startswith('HELLO'):
+                await self.on_hello(message.split()[1:])
             elif message == 'SESSION_OK':
+                self.established = True
+                self.session_ok_time = time.perf_counter()
+                if self.timings:
+                    self.timings.mark('session_ok')
+                    timings = self.timings.report()
+                    if timings and self.stats:
+                        self.stats.add_records([dict(timings, type='startup')])
                 self.start_pipeline()
             elif message.startswith('ERROR'):
                 print (message)
                 self.close_pipeline()
+                # Don't leave a registration behind for the next attempt
+                await self.conn.close()
                 return 1
             else:
                 self.handle_sdp(message)
+        if self.conn.close_code != 1000:
+            return None
         self.close_pipeline()
         return 0
 
     async def stop(self):
-        if self.conn:
+        if self.writer:
+            self.writer.cancel()
+            self.writer = None
+        if self.conn and not self.room:
             await self.conn.close()
         self.conn = None
 
 
+class RoomFanout:
+    '''
+    Joins @room_id and sends the video of @fanout to every other member, each
+    with a WebRTCClient of its own on our single connection
+    '''
+    def __init__(self, id_, room_id, server, fanout, ice_coalesce_ms=0, stats=None,
+                 recorder=None):
+        self.id_ = id_
+        self.room_id = room_id
+        self.server = server
+        self.fanout = fanout
+        self.ice_coalesce_ms = ice_coalesce_ms
+        self.stats = stats
+        self.recorder = recorder
+        self.conn = None
+        # Format: {peer_id: WebRTCClient}
+        self.clients = {}
+        self.token = None
+        # Whether the last connection got as far as ROOM_OK, or a resumed
+        # room
+        self.established = False
+
+    async def connect(self):
+        wsuri = parse_uri(self.server)
+        if wsuri.secure:
+            sslctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+        else:
+            sslctx = None
+        self.established = False
+        self.conn = await websockets.connect(self.server, ssl=sslctx)
+        await self.conn.send(hello_message(self.id_, self.token))
+
+    def add_peer(self, peer_id):
+        if peer_id in self.clients:
+            return
+        print('Sending to {} ({} peers)'.format(peer_id, len(self.clients) + 1))
+        client = WebRTCClient(self.id_, peer_id, self.server, self.ice_coalesce_ms,
+                              fanout=self.fanout, room=True, stats=self.stats,
+                              recorder=self.recorder)
+        client.start_writer(self.conn)
+        client.start_pipeline()
+        self.clients[peer_id] = client
+
+    async def remove_peer(self, peer_id):
+        client = self.clients.pop(peer_id, None)
+        if client is None:
+            return
+        print('{} left ({} peers)'.format(peer_id, len(self.clients)))
+        client.close_pipeline()
+        await client.stop()
+
+    async def loop(self):
+        '''
+        Same as WebRTCClient.loop()
+        '''
+        assert self.conn
+        error = False
+        async for message in self.conn:
+            tracer.instant('recv', 'signalling', head=message[:24])
+            if message.startswith('HELLO'):
+                words = message.split()[1:]
+                if words[:1] == ['RESUMED'] and 'ROOM' in words[2:]:
+                    self.token = words[1]
+                    print('Resumed room {} with {} peers'.format(self.room_id, len(self.clients)))
+                    self.established = True
+                    for client in self.clients.values():
+                        client.start_writer(self.conn)
+                    continue
+                self.token = words[0] if words else None
+                for peer_id in list(self.clients):
+                    await self.remove_peer(peer_id)
+                await self.conn.send('ROOM {}'.format(self.room_id))
+            elif message.startswith('ROOM_OK'):
+                self.established = True
+                for peer_id in message.split()[1:]:
+                    self.add_peer(peer_id)
+            elif message.startswith('ROOM_PEER_JOINED'):
+                self.add_peer(message.split()[1])
+            elif message.startswith('ROOM_PEER_LEFT'):
+                await self.remove_peer(message.split()[1])
+            elif message.startswith('ROOM_PEER_MSG'):
+                _, peer_id, msg = message.split(maxsplit=2)
+                if peer_id in self.clients:
+                    self.clients[peer_id].handle_sdp(msg)
+            elif message.startswith('ERROR'):
+                print (message)
+                await self.conn.close()
+                error = True
+                break
+            else:
+                print ('Unknown message', message)
+        else:
+            if self.conn.close_code != 1000:
+                # Lost, keep the peers for when we resume
+                return None
+        for peer_id in list(self.clients):
+            await self.remove_peer(peer_id)
+        return 1 if error else 0
+
+
+def hello_message(uid, token):
+    '''
+    Register as @uid, resuming the registration of @token if given
+    '''
+    if token:
+        return 'HELLO {} RESUME {}'.format(uid, token)
+    return 'HELLO {} RESUME'.format(uid)
+
+
+async def run_with_retries(client, health_path, max_attempts=0):
+    '''
+    Connect @client (a WebRTCClient or RoomFanout) and run it until it is
+    done, reconnecting with backoff when the connection fails or is lost, or
+    the server answers with an ERROR. Gives up after @max_attempts
+    consecutive failures, if not 0.
+    '''
+    backoff = Backoff()
+    failures = 0
+    while True:
+        try:
+            if health_path:
+                await wait_ready(health_url(client.server, health_path))
+                if getattr(client, 'timings', None):
+                    client.timings.mark('ready')
+            await client.connect()
+            res = await client.loop()
+            if res == 0:
+                return 0
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+            print('Signalling connection failed: {!r}'.format(e))
+            res = 1
+        if client.established:
+            # The call was up, start over from a short delay. Being
+            # registered is not enough: SESSION may keep failing with ERROR.
+            backoff.reset()
+            failures = 0
+        failures += 1
+        if max_attempts and failures >= max_attempts:
+            return res or 1
+        delay = backoff.delay()
+        print('Reconnecting in {:.1f} s'.format(delay))
+        await asyncio.sleep(delay)
+
+
+def build_pipeline(preset, stun_server=STUN_SERVER):
+    pipe = Gst.parse_launch(PIPELINE_DESC)
+    if stun_server:
+        pipe.get_by_name('sendrecv').set_property('stun-server', stun_server)
+    tracer.watch(pipe)
+    apply_preset(pipe.get_by_name('encoder'), preset)
+    return pipe
+
+
 def check_plugins():
     needed = ["opus", "vpx", "nice", "webrtc", "dtls", "srtp", "rtp",
               "rtpmanager", "videotestsrc", "audiotestsrc"]
@@ -232,28 +668,147 @@ def check_plugins():
     return True
 
 
-def main(args):
-
-    our_id = 42  # random.randrange(10, 10000)
-    c = WebRTCClient(our_id, args.peerid, args.server)
+def main(args, timings):
 
+    our_id = args.our_id
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(c.connect())
-    res = loop.run_until_complete(c.loop())
+    # kill -USR1 switches tracing on, and off again saving the trace
+    loop.add_signal_handler(signal.SIGUSR1, tracer.toggle)
+    run = partial(run_with_retries, health_path=args.health_path,
+                  max_attempts=args.max_attempts)
+    abr = None
+    if not args.no_abr:
+        abr = dict(min_bitrate=args.min_bitrate * 1000, max_bitrate=args.max_bitrate * 1000)
+    stats = None
+    if args.stats_interval > 0:
+        stats = StatsCollector(args.stats_interval, path=args.stats_file,
+                               max_bytes=args.stats_file_max_bytes, backups=args.stats_file_backups)
+        stats.start(loop)
+        if args.stats_port:
+            StatsServer(stats, args.stats_port).start()
+    recorder = None
+    if args.record_dir:
+        recorder = Recorder(args.record_dir, args.record_max_bytes, args.record_max_time)
+
+    if args.room:
+        # One connection, one peer per member of the room
+        fanout = Fanout(args.preset, abr, stats, recorder, args.stun_server)
+        fanout.start()
+        c = RoomFanout(our_id, args.room, args.server, fanout, args.ice_coalesce_ms, stats,
+                       recorder)
+        res = loop.run_until_complete(run(c))
+        fanout.stop()
+        sys.exit(res)
+
+    if len(args.peerid) > 1:
+        # One SESSION, hence one connection, per peer
+        fanout = Fanout(args.preset, abr, stats, recorder, args.stun_server)
+        fanout.start()
+        clients = [WebRTCClient('{}-{}'.format(our_id, n), peer_id, args.server,
+                                args.ice_coalesce_ms, fanout=fanout, stats=stats,
+                                recorder=recorder)
+                   for n, peer_id in enumerate(args.peerid)]
+        res = loop.run_until_complete(asyncio.gather(*[run(c) for c in clients]))
+        fanout.stop()
+        sys.exit(max(res))
+
+    receiver = None
+    if args.receive == 'frames':
+        # Only needs NumPy when asked for
+        from receive import FrameRate, FrameReceiver
+        receiver = FrameReceiver(FrameRate(), args.receive_format, args.receive_queue)
+    pool = None
+    if args.pool_size > 0:
+        pool = PipelinePool(args.pool_size, partial(build_pipeline, args.preset, args.stun_server),
+                            args.pool_max_age)
+        pool.start(loop)
+    c = WebRTCClient(our_id, args.peerid[0], args.server, args.ice_coalesce_ms,
+                     preset=args.preset, abr=abr, stats=stats, pool=pool, timings=timings,
+                     receiver=receiver, recorder=recorder, stun_server=args.stun_server)
+    res = loop.run_until_complete(run(c))
 
     sys.exit(res)
 
 def main_retry():
-    Gst.init(None)
-    if not check_plugins():
-        sys.exit(1)
+    timings = Timings()
     parser = argparse.ArgumentParser()
-    parser.add_argument('peerid', help='String ID of the peer to connect to')
+    parser.add_argument('peerid', nargs='*', help='String ID of the peer to connect to. With several, they share one encoder')
+    parser.add_argument('--room', help='Join this room and send to all of its members from one encoder, instead of calling peers')
+    parser.add_argument('--our-id', dest='our_id', default='42', help='Our uid on the signalling server, suffixed with -N when calling several peers')
     parser.add_argument('--server', help='Signalling server to connect to, eg "wss://127.0.0.1:8443"')
+    parser.add_argument('--ice-coalesce-ms', dest='ice_coalesce_ms', default=0, type=float,
+                        help='Send the ICE candidates gathered within this window (in milliseconds) of the previous one as a single message')
+    parser.add_argument('--preset', default='realtime', choices=PRESETS,
+                        help='Encoder settings, from the cheapest to the best looking')
+    parser.add_argument('--stun-server', dest='stun_server', default=STUN_SERVER,
+                        help='STUN server of our webrtcbins, empty to only use host candidates')
+    parser.add_argument('--no-abr', dest='no_abr', action='store_true',
+                        help='Keep the bitrate, resolution and framerate fixed instead of following the network')
+    parser.add_argument('--min-bitrate', dest='min_bitrate', default=150, type=int,
+                        help='Lowest target bitrate (in kbps) of the adaptive bitrate')
+    parser.add_argument('--max-bitrate', dest='max_bitrate', default=2000, type=int,
+                        help='Highest target bitrate (in kbps) of the adaptive bitrate')
+    parser.add_argument('--stats-interval', dest='stats_interval', default=1.0, type=float,
+                        help='How often to collect the WebRTC stats (in seconds), 0 to disable')
+    parser.add_argument('--stats-file', dest='stats_file',
+                        help='Append the stats to this file as JSON lines')
+    parser.add_argument('--stats-file-max-bytes', dest='stats_file_max_bytes', default=10 * 1024 * 1024, type=int,
+                        help='Rotate the stats file at this size')
+    parser.add_argument('--stats-file-backups', dest='stats_file_backups', default=5, type=int,
+                        help='Number of rotated stats files to keep')
+    parser.add_argument('--stats-port', dest='stats_port', type=int,
+                        help='Serve the latest stats as JSON on http://0.0.0.0:PORT/stats, for the /stats page of the front')
+    parser.add_argument('--pool-size', dest='pool_size', default=0, type=int,
+                        help='Keep this many pipelines running with their offer ready, to start calls faster')
+    parser.add_argument('--pool-max-age', dest='pool_max_age', default=60, type=float,
+                        help='Replace pooled pipelines after this long (in seconds)')
+    parser.add_argument('--health-path', dest='health_path', default='/health',
+                        help='Wait until the signalling server answers on this route before connecting, empty to connect right away')
+    parser.add_argument('--max-attempts', dest='max_attempts', default=0, type=int,
+                        help='Give up after this many failed connections or calls in a row, 0 to keep trying')
+    parser.add_argument('--receive', default='display', choices=['display', 'frames'],
+                        help='Display the media of the peer, or hand its decoded video to a callback as NumPy arrays, for headless servers')
+    parser.add_argument('--receive-format', dest='receive_format', default='BGR',
+                        choices=['GRAY8', 'RGB', 'BGR', 'RGBx', 'BGRx', 'RGBA', 'BGRA'],
+                        help='Pixel format of the received frames')
+    parser.add_argument('--receive-queue', dest='receive_queue', default=2, type=int,
+                        help='Received frames waiting for the callback, the oldest are dropped beyond that')
+    parser.add_argument('--record-dir', dest='record_dir',
+                        help='Record the media of the calls to WebM files in this directory, without re-encoding')
+    parser.add_argument('--record-max-bytes', dest='record_max_bytes', default=0, type=int,
+                        help='Start a new recording file at this size, 0 for no limit')
+    parser.add_argument('--record-max-time', dest='record_max_time', default=600, type=float,
+                        help='Start a new recording file after this long (in seconds), 0 for no limit')
+    parser.add_argument('--trace', action='store_true',
+                        help='Trace from the start, instead of when receiving SIGUSR1')
+    parser.add_argument('--trace-file', dest='trace_file', default='webrtc-trace.json',
+                        help='Save the trace to this file, in the Chrome trace format, when tracing stops and on exit')
+    parser.add_argument('--trace-buffer', dest='trace_buffer', default=100000, type=int,
+                        help='Number of trace events to keep')
+    parser.add_argument('--trace-gst', dest='trace_gst', action='store_true',
+                        help='Merge the GStreamer latency and proctime tracers into the trace')
     args = parser.parse_args()
-    print("Waiting a few seconds for you to open the browser at localhost:8080")
-    time.sleep(10)
-    main(args)
+    if bool(args.peerid) == bool(args.room):
+        parser.error('give either peer ids or --room')
+    if not args.server:
+        parser.error('--server is required')
+    tracer.events = collections.deque(maxlen=args.trace_buffer)
+    tracer.path = args.trace_file
+    if args.trace:
+        tracer.enable()
+    atexit.register(tracer.save)
+    # The tracers are set up by Gst.init()
+    quiet = enable_gst_tracers() if args.trace_gst else False
+    Gst.init(None)
+    if args.trace_gst:
+        merge_gst_tracers(quiet)
+    timings.mark('gst_init')
+    if not check_plugins():
+        sys.exit(1)
+    timings.mark('plugins')
+    # Until the browser has registered, SESSION fails with an ERROR, and we
+    # retry
+    main(args, timings)
 
 if __name__=='__main__':
     main_retry()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# Helpers shared by the signalling server benchmarks
+#
+
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import websockets
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'simple_server.py')
+
+
+def wait_healthy(port, timeout=10, proc=None):
+    '''
+    Poll the server's health route until it answers. With @proc, fail if
+    that process exits first: another server may be answering on @port.
+    '''
+    url = 'http://127.0.0.1:{}/health'.format(port)
+    deadline = time.monotonic() + timeout
+    while True:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError('Server on port {} exited with status {}'.format(port, proc.returncode))
+        try:
+            with urllib.request.urlopen(url, timeout=1) as r:
+                if r.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError('Server on port {} did not become healthy'.format(port))
+        time.sleep(0.1)
+
+
+def start_server(port, *args, quiet=True, stdout=None, server=SERVER):
+    '''
+    Start a local simple_server.py (or another version of it at @server)
+    without TLS, and wait until it is ready. Its output goes to @stdout if
+    given, else nowhere if @quiet.
+    '''
+    # Don't measure a server left over on the port instead of ours
+    with socket.socket() as sock:
+        # Still fails on a listening socket, but not on TIME_WAIT ones
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('', port))
+        except OSError:
+            raise RuntimeError('Port {} is already in use'.format(port))
+    cmd = [sys.executable, '-u', server, '--disable-ssl', '--port', str(port)]
+    cmd += list(args)
+    out = stdout or (subprocess.DEVNULL if quiet else None)
+    proc = subprocess.Popen(cmd, stdout=out, stderr=out)
+    try:
+        wait_healthy(port, proc=proc)
+    except TimeoutError:
+        proc.kill()
+        raise
+    return proc
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def children_of(pid):
+    '''
+    pids of the children of process @pid (Linux only)
+    '''
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def cpu_seconds(pid, children=True):
+    '''
+    User + system CPU time used so far by process @pid and, with @children,
+    its children (the server workers) (Linux only)
+    '''
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    total = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    if children:
+        for child in children_of(pid):
+            try:
+                total += cpu_seconds(child)
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def rss_kb(pid, children=True):
+    '''
+    Resident set size of process @pid and, with @children, its children
+    (the server workers) in KiB (Linux only)
+    '''
+    total = 0
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                total += int(line.split()[1])
+    if children:
+        for child in children_of(pid):
+            try:
+                total += rss_kb(child)
+            except FileNotFoundError:
+                pass
+    return total
+
+
+async def hello(url, uid, **kwargs):
+    '''
+    Connect and register as @uid
+    '''
+    ws = await websockets.connect(url, **kwargs)
+    await ws.send('HELLO ' + uid)
+    reply = await ws.recv()
+    assert reply == 'HELLO', reply
+    return ws
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round((len(values) - 1) * pct / 100)))
+    return values[k]
+
+
+def summary(values, scale=1000):
+    '''
+    p50/p99/max of @values (in seconds), in milliseconds by default
+    '''
+    if not values:
+        return dict(count=0)
+    return dict(
+        count=len(values),
+        p50=percentile(values, 50) * scale,
+        p99=percentile(values, 99) * scale,
+        max=max(values) * scale,
+    )
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+# Compare permessage-deflate settings: bytes on the wire, server CPU time per
+# relayed message and server memory per connection, for sessions that relay
+# an SDP offer and answer followed by trickled ICE candidates.
+#
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import websockets
+
+from common import cpu_seconds, rss_kb, start_server, stop_server
+
+CONFIGS = {
+    'none': '--compression none',
+    'deflate-all': '--deflate-threshold 0',
+    'default': '',
+    'level-1': '--deflate-level 1',
+    'no-context-takeover': '--deflate-no-context-takeover',
+    'no-context-takeover-all': '--deflate-no-context-takeover --deflate-threshold 0',
+    'window-15': '--deflate-window-bits 15 --deflate-mem-level 8',
+}
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', default=18443, type=int, help='Port for the local server')
+parser.add_argument('--configs', default=','.join(CONFIGS), help='Comma-separated configurations to compare: ' + ', '.join(CONFIGS))
+parser.add_argument('--pairs', default=100, type=int, help='Number of concurrent sessions')
+parser.add_argument('--rounds', default=5, type=int, help='Offer/answer exchanges per session, as with renegotiations')
+parser.add_argument('--candidates', default=8, type=int, help='ICE candidates trickled by each peer after each offer/answer')
+parser.add_argument('--tracks', default=4, type=int, help='Media sections in each SDP, which sets its size')
+
+options = parser.parse_args(sys.argv[1:])
+
+# Bytes written and read by all the clients, frame headers included
+WIRE = dict(up=0, down=0)
+
+
+class CountingProtocol(websockets.WebSocketClientProtocol):
+    def connection_made(self, transport):
+        write = transport.write
+
+        def counted(data):
+            WIRE['up'] += len(data)
+            write(data)
+        transport.write = counted
+        super().connection_made(transport)
+
+    def data_received(self, data):
+        WIRE['down'] += len(data)
+        super().data_received(data)
+
+
+def token(n):
+    return ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789+/') for _ in range(n))
+
+
+MEDIA = '''m={kind} 9 UDP/TLS/RTP/SAVPF 96 97 98 99 100 101
+c=IN IP4 0.0.0.0
+a=rtcp:9 IN IP4 0.0.0.0
+a=ice-ufrag:{ufrag}
+a=ice-pwd:{pwd}
+a=ice-options:trickle
+a=fingerprint:sha-256 {fingerprint}
+a=setup:actpass
+a=mid:{mid}
+a=sendrecv
+a=rtcp-mux
+a=rtcp-rsize
+a=rtpmap:96 VP8/90000
+a=rtcp-fb:96 goog-remb
+a=rtcp-fb:96 transport-cc
+a=rtcp-fb:96 ccm fir
+a=rtcp-fb:96 nack
+a=rtcp-fb:96 nack pli
+a=rtpmap:97 rtx/90000
+a=fmtp:97 apt=96
+a=rtpmap:98 VP9/90000
+a=rtcp-fb:98 goog-remb
+a=rtcp-fb:98 transport-cc
+a=rtcp-fb:98 ccm fir
+a=rtcp-fb:98 nack
+a=rtcp-fb:98 nack pli
+a=fmtp:98 profile-id=0
+a=rtpmap:99 rtx/90000
+a=fmtp:99 apt=98
+a=rtpmap:100 H264/90000
+a=rtcp-fb:100 goog-remb
+a=rtcp-fb:100 transport-cc
+a=rtcp-fb:100 nack pli
+a=fmtp:100 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42e01f
+a=rtpmap:101 rtx/90000
+a=fmtp:101 apt=100
+a=ssrc-group:FID {ssrc} {rtx_ssrc}
+a=ssrc:{ssrc} cname:{cname}
+a=ssrc:{rtx_ssrc} cname:{cname}
+'''
+
+
+def sdp(kind):
+    ufrag, pwd, cname = token(4), token(24), token(16)
+    fingerprint = ':'.join('{:02X}'.format(random.randrange(256)) for _ in range(32))
+    lines = ['v=0\r\no=- {} 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n'.format(random.getrandbits(62))]
+    for mid in range(options.tracks):
+        lines.append(MEDIA.format(
+            kind='video' if mid % 2 else 'audio', ufrag=ufrag, pwd=pwd, mid=mid,
+            fingerprint=fingerprint, cname=cname, ssrc=random.getrandbits(32),
+            rtx_ssrc=random.getrandbits(32)).replace('\n', '\r\n'))
+    return json.dumps({'sdp': {'type': kind, 'sdp': ''.join(lines)}})
+
+
+def candidate(i):
+    return json.dumps({'ice': {
+        'candidate': 'candidate:{} 1 udp {} 192.168.{}.{} {} typ host generation 0 ufrag {} network-id 1'.format(
+            random.getrandbits(32), 2122260223 - i, random.randrange(256),
+            random.randrange(256), random.randrange(1024, 65536), token(4)),
+        'sdpMLineIndex': i % options.tracks,
+    }})
+
+
+async def hello(url, uid):
+    ws = await websockets.connect(url, create_protocol=CountingProtocol, max_size=None)
+    await ws.send('HELLO ' + uid)
+    assert await ws.recv() == 'HELLO'
+    return ws
+
+
+async def session(url, n, ready, start):
+    caller = await hello(url, 'bench-caller-{}'.format(n))
+    callee = await hello(url, 'bench-callee-{}'.format(n))
+    await caller.send('SESSION bench-callee-{}'.format(n))
+    assert await caller.recv() == 'SESSION_OK'
+    rounds = []
+    for _ in range(options.rounds):
+        for src, dst, kind in ((caller, callee, 'offer'), (callee, caller, 'answer')):
+            rounds.append((src, dst, [sdp(kind)] + [candidate(i) for i in range(options.candidates)]))
+    ready.release()
+    await start.wait()
+    relayed = 0
+    for src, dst, msgs in rounds:
+        for msg in msgs:
+            await src.send(msg)
+        for msg in msgs:
+            assert await dst.recv() == msg
+        relayed += len(msgs)
+    return caller, callee, relayed
+
+
+async def run(url, pid):
+    ready = asyncio.Semaphore(0)
+    start = asyncio.Event()
+    rss = rss_kb(pid)
+    tasks = [asyncio.ensure_future(session(url, n, ready, start)) for n in range(options.pairs)]
+    for _ in tasks:
+        await ready.acquire()
+    # Compressors are allocated with the connection
+    rss = rss_kb(pid) - rss
+    WIRE.update(up=0, down=0)
+    cpu = cpu_seconds(pid)
+    t = time.perf_counter()
+    start.set()
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t
+    cpu = cpu_seconds(pid) - cpu
+    for caller, callee, _ in results:
+        await caller.close()
+        await callee.close()
+    return sum(r[2] for r in results), elapsed, cpu, rss
+
+
+def main():
+    for name in options.configs.split(','):
+        # Same messages for every configuration
+        random.seed(0)
+        server = start_server(options.port, *CONFIGS[name].split())
+        try:
+            url = 'ws://127.0.0.1:{}'.format(options.port)
+            relayed, elapsed, cpu, rss = asyncio.get_event_loop().run_until_complete(run(url, server.pid))
+        finally:
+            stop_server(server)
+        print(json.dumps(dict(
+            config=name,
+            messages=relayed,
+            wire_bytes_per_msg=(WIRE['up'] + WIRE['down']) / relayed,
+            wire_bytes_up=WIRE['up'],
+            wire_bytes_down=WIRE['down'],
+            server_cpu_us_per_msg=cpu / relayed * 1e6,
+            msgs_per_sec=relayed / elapsed,
+            server_kb_per_conn=rss / (2 * options.pairs),
+        )), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Measure the server memory used by each idle connection: RSS after
+# registering --peers idle peers, minus RSS before, divided by --peers.
+# Use --server to measure another version of simple_server.py, eg. from a
+# `git worktree` of an older commit.
+#
+
+import argparse
+import asyncio
+import json
+import resource
+import sys
+
+from common import SERVER, hello, rss_kb, start_server, stop_server
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', default=18443, type=int, help='Port for the local server')
+parser.add_argument('--server', default=SERVER, help='simple_server.py to measure')
+parser.add_argument('--server-args', default='', help='Extra arguments for simple_server.py')
+parser.add_argument('--peers', default=5000, type=int, help='Number of idle peers')
+parser.add_argument('--settle', default=2, type=float, help='Seconds to wait before measuring')
+
+options = parser.parse_args(sys.argv[1:])
+
+
+async def run(pid):
+    before = rss_kb(pid)
+    sem = asyncio.Semaphore(200)
+
+    async def connect(n):
+        async with sem:
+            # No client pings, the server is the one keeping connections alive
+            return await hello('ws://127.0.0.1:{}'.format(options.port),
+                               'idle-{}'.format(n), ping_interval=None)
+
+    conns = await asyncio.gather(*[connect(n) for n in range(options.peers)])
+    await asyncio.sleep(options.settle)
+    after = rss_kb(pid)
+    for ws in conns:
+        await ws.close()
+    return dict(
+        server=options.server,
+        server_args=options.server_args,
+        peers=options.peers,
+        rss_before_kb=before,
+        rss_after_kb=after,
+        bytes_per_connection=(after - before) * 1024 / options.peers,
+    )
+
+
+def main():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    server = start_server(options.port, *options.server_args.split(), server=options.server)
+    try:
+        report = asyncio.get_event_loop().run_until_complete(run(server.pid))
+    finally:
+        stop_server(server)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
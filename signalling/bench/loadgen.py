@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+#
+# Headless load generator for the signalling server
+#
+# Drives thousands of simulated peers, speaking the same protocol as
+# session-client.py and room-client.py, through scripted scenarios:
+#
+# * sessions: 1-1 calls with an offer, trickled ICE candidates and an answer
+# * room-churn: peers repeatedly joining and leaving a set of rooms
+# * large-room: a single room filled with many peers
+#
+# Prints a JSON report, which can be compared against a previous one with
+# --compare to catch regressions between server versions.
+#
+
+import argparse
+import asyncio
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import websockets
+
+from common import SERVER, hello, rss_kb, start_server, stop_server, summary
+
+SCENARIOS = ('sessions', 'room-churn', 'large-room')
+
+# Set by main(), so that importing this module does not parse the caller's argv
+options = None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('scenario', choices=SCENARIOS)
+    parser.add_argument('--port', default=18443, type=int, help='Port for the local server')
+    parser.add_argument('--url', default=None, help='Use an already running server instead of starting one')
+    parser.add_argument('--server-pid', dest='server_pid', default=None, type=int, help='Pid of the server given by --url, to report its RSS')
+    parser.add_argument('--server-args', default='', help='Extra arguments for simple_server.py')
+    parser.add_argument('--peers', default=1000, type=int, help='Number of simulated peers')
+    parser.add_argument('--connect-concurrency', dest='connect_concurrency', default=200, type=int, help='Maximum connections being opened at once')
+    parser.add_argument('--candidates', default=10, type=int, help='ICE candidates trickled by each side of a session')
+    parser.add_argument('--sdp-size', dest='sdp_size', default=3000, type=int, help='Size of the offer and answer')
+    parser.add_argument('--rooms', default=10, type=int, help='Number of rooms for room-churn')
+    parser.add_argument('--duration', default=10, type=float, help='Duration of room-churn (in seconds)')
+    parser.add_argument('--output', default=None, help='Write the report to this file as well')
+    parser.add_argument('--compare', default=None, help='Previous report to compare against')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Relative regression allowed by --compare')
+
+    return parser.parse_args(argv)
+
+
+class Stats:
+    def __init__(self):
+        self.connect = []
+        self.hello_to_session_ok = []
+        self.join = []
+        self.relay = []
+        self.frames = 0
+        self.errors = 0
+
+
+def stamp(kind, data):
+    '''
+    Embed the send time, so the receiving simulated peer can compute the
+    relay latency. It goes inside @data, so that the message keeps the shape
+    the server's ICE coalescing (--ice-coalesce-ms) looks for.
+    '''
+    return json.dumps({kind: dict(data, t=time.perf_counter())})
+
+
+def relay_latency(stats, msg):
+    '''
+    Record the relay latency of @msg. Returns the number of SDP or ICE
+    messages it carried, as the server may have coalesced candidates.
+    '''
+    if msg.startswith('ROOM_PEER_MSG'):
+        msg = msg.split(maxsplit=2)[2]
+    now = time.perf_counter()
+    (data,) = json.loads(msg).values()
+    items = data if isinstance(data, list) else [data]
+    stats.relay.extend(now - item['t'] for item in items)
+    stats.frames += 1
+    return len(items)
+
+
+async def connect(url, uid, stats, sem):
+    async with sem:
+        start = time.perf_counter()
+        ws = await hello(url, uid, max_size=None)
+        stats.connect.append(time.perf_counter() - start)
+        return ws, start
+
+
+############### sessions ###############
+
+async def callee(ws, stats):
+    sdp = 'x' * options.sdp_size
+    # Offer, then the caller's candidates
+    received = 0
+    while received < options.candidates + 1:
+        received += relay_latency(stats, await ws.recv())
+    await ws.send(stamp('sdp', {'type': 'answer', 'sdp': sdp}))
+    for i in range(options.candidates):
+        await ws.send(stamp('ice', {'candidate': 'candidate:{}'.format(i), 'sdpMLineIndex': 0}))
+
+
+async def caller(ws, hello_start, callee_id, stats):
+    sdp = 'x' * options.sdp_size
+    await ws.send('SESSION {}'.format(callee_id))
+    reply = await ws.recv()
+    if reply != 'SESSION_OK':
+        raise Exception(reply)
+    stats.hello_to_session_ok.append(time.perf_counter() - hello_start)
+    await ws.send(stamp('sdp', {'type': 'offer', 'sdp': sdp}))
+    for i in range(options.candidates):
+        await ws.send(stamp('ice', {'candidate': 'candidate:{}'.format(i), 'sdpMLineIndex': 0}))
+    # Answer, then the callee's candidates
+    received = 0
+    while received < options.candidates + 1:
+        received += relay_latency(stats, await ws.recv())
+
+
+async def session_pair(url, n, stats, sem):
+    try:
+        wsc, _ = await connect(url, 'load-callee-{}'.format(n), stats, sem)
+        wsr, start = await connect(url, 'load-caller-{}'.format(n), stats, sem)
+        await asyncio.gather(callee(wsc, stats), caller(wsr, start, 'load-callee-{}'.format(n), stats))
+        return (wsc, None), (wsr, None)
+    except Exception:
+        stats.errors += 1
+        return ()
+
+
+async def run_sessions(url, stats):
+    sem = asyncio.Semaphore(options.connect_concurrency)
+    pairs = await asyncio.gather(*[session_pair(url, n, stats, sem)
+                                   for n in range(options.peers // 2)])
+    return [ws for pair in pairs for ws in pair]
+
+
+############### rooms ###############
+
+async def join_room(url, uid, room_id, stats, sem):
+    '''
+    Join @room_id, and read the room notices in the background. Returns the
+    connection and the reading task.
+    '''
+    ws, _ = await connect(url, uid, stats, sem)
+    start = time.perf_counter()
+    await ws.send('ROOM {}'.format(room_id))
+    while True:
+        reply = await ws.recv()
+        if reply.startswith('ROOM_OK'):
+            break
+        if reply.startswith('ERROR'):
+            raise Exception(reply)
+    stats.join.append(time.perf_counter() - start)
+    return ws, asyncio.ensure_future(drain(ws, stats))
+
+
+async def drain(ws, stats):
+    try:
+        async for msg in ws:
+            if msg.startswith('ROOM_PEER_MSG'):
+                relay_latency(stats, msg)
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def run_large_room(url, stats):
+    sem = asyncio.Semaphore(options.connect_concurrency)
+    conns = []
+    for n in range(options.peers):
+        try:
+            conns.append(await join_room(url, 'load-room-{}'.format(n), 'large', stats, sem))
+        except Exception:
+            stats.errors += 1
+    # Every newcomer sends an offer to a few members, like room-client.py
+    members = ['load-room-{}'.format(n) for n in range(len(conns))]
+    for ws, _ in conns[-min(len(conns), 50):]:
+        for pid in random.sample(members, min(3, len(members))):
+            await ws.send('ROOM_PEER_MSG {} {}'.format(pid, stamp('sdp', {'type': 'offer', 'sdp': 'x'})))
+    await asyncio.sleep(1)
+    return conns
+
+
+async def churn_peer(url, n, stats, sem, deadline):
+    i = 0
+    while time.monotonic() < deadline:
+        # A fresh uid each time, the server may not have noticed that the
+        # previous connection went away yet
+        uid = 'load-churn-{}-{}'.format(n, i)
+        i += 1
+        try:
+            ws, task = await join_room(url, uid, 'churn-{}'.format(random.randrange(options.rooms)), stats, sem)
+            await asyncio.sleep(random.uniform(0.1, 1))
+            task.cancel()
+            await ws.close()
+        except Exception:
+            stats.errors += 1
+            await asyncio.sleep(0.1)
+    return ()
+
+
+async def run_room_churn(url, stats):
+    sem = asyncio.Semaphore(options.connect_concurrency)
+    deadline = time.monotonic() + options.duration
+    await asyncio.gather(*[churn_peer(url, n, stats, sem, deadline) for n in range(options.peers)])
+    return []
+
+
+############### report ###############
+
+def server_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=SERVER.rsplit('/', 1)[0], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(url, server_pid):
+    stats = Stats()
+    start = time.perf_counter()
+    conns = await {
+        'sessions': run_sessions,
+        'room-churn': run_room_churn,
+        'large-room': run_large_room,
+    }[options.scenario](url, stats)
+    elapsed = time.perf_counter() - start
+    rss = rss_kb(server_pid) if server_pid else None
+    for ws, task in conns:
+        if task:
+            task.cancel()
+        await ws.close()
+    return dict(
+        scenario=options.scenario,
+        server_version=server_version(),
+        server_args=options.server_args,
+        peers=options.peers,
+        elapsed_s=elapsed,
+        errors=stats.errors,
+        connections=len(stats.connect),
+        connections_per_sec=len(stats.connect) / elapsed,
+        connect_ms=summary(stats.connect),
+        hello_to_session_ok_ms=summary(stats.hello_to_session_ok),
+        room_join_ms=summary(stats.join),
+        relay_ms=summary(stats.relay),
+        relayed_frames=stats.frames,
+        server_rss_kb=rss,
+    )
+
+
+# Report fields checked by --compare, and whether higher is better
+COMPARED = (
+    ('connections_per_sec', True),
+    ('connect_ms.p99', False),
+    ('hello_to_session_ok_ms.p99', False),
+    ('room_join_ms.p99', False),
+    ('relay_ms.p50', False),
+    ('relay_ms.p99', False),
+    ('server_rss_kb', False),
+)
+
+
+def lookup(report, path):
+    for key in path.split('.'):
+        if not isinstance(report, dict):
+            return None
+        report = report.get(key)
+    return report
+
+
+def compare(old, new):
+    '''
+    Print the regressions of @new against @old, returns whether there were any
+    '''
+    regressed = False
+    for path, higher_is_better in COMPARED:
+        a, b = lookup(old, path), lookup(new, path)
+        if not a or b is None:
+            continue
+        change = (b - a) / a
+        worse = change < -options.tolerance if higher_is_better else change > options.tolerance
+        print('{}{}: {:.3f} -> {:.3f} ({:+.0%})'.format('REGRESSION ' if worse else '', path, a, b, change),
+              file=sys.stderr)
+        regressed = regressed or worse
+    return regressed
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    global options
+    options = parse_args(sys.argv[1:])
+    raise_fd_limit()
+    loop = asyncio.get_event_loop()
+    if options.url:
+        report = loop.run_until_complete(run(options.url, options.server_pid))
+    else:
+        server = start_server(options.port, *options.server_args.split())
+        try:
+            url = 'ws://127.0.0.1:{}'.format(options.port)
+            report = loop.run_until_complete(run(url, server.pid))
+        finally:
+            stop_server(server)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    if options.compare:
+        with open(options.compare) as f:
+            if compare(json.load(f), report):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
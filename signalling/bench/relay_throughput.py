@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Measure how many session messages per second the server relays, and the
+# server CPU time per message, for several server configurations. By default
+# it compares logging every relayed body synchronously (what the server used
+# to do with print()) against the default sampled, queue-backed logging.
+#
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+from common import cpu_seconds, hello, start_server, stop_server
+
+CONFIGS = {
+    'sync-full-bodies': '--log-level debug --log-bodies full --log-sync',
+    'async-debug': '--log-level debug',
+    'default': '',
+}
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', default=18443, type=int, help='Port for the local server')
+parser.add_argument('--configs', default=','.join(CONFIGS), help='Comma-separated configurations to compare: ' + ', '.join(CONFIGS))
+parser.add_argument('--pairs', default=20, type=int, help='Number of concurrent sessions')
+parser.add_argument('--messages', default=500, type=int, help='Messages sent by each caller')
+parser.add_argument('--size', default=3000, type=int, help='Size of each message, about the size of an SDP offer')
+
+options = parser.parse_args(sys.argv[1:])
+
+SDP_LINE = 'a=candidate:1 1 UDP 2122252543 192.168.1.{} 5{:04d} typ host\r\n'
+
+
+def payload(i):
+    lines = []
+    while sum(map(len, lines)) < options.size:
+        lines.append(SDP_LINE.format(len(lines) % 255, i % 10000))
+    return json.dumps({'sdp': {'type': 'offer', 'sdp': ''.join(lines)}})
+
+
+async def pair(url, n):
+    caller = await hello(url, 'bench-caller-{}'.format(n))
+    callee = await hello(url, 'bench-callee-{}'.format(n))
+    await caller.send('SESSION bench-callee-{}'.format(n))
+    assert await caller.recv() == 'SESSION_OK'
+    return caller, callee
+
+
+async def run(url):
+    pairs = [await pair(url, n) for n in range(options.pairs)]
+    msgs = [payload(i) for i in range(options.messages)]
+
+    async def send(ws):
+        for msg in msgs:
+            await ws.send(msg)
+
+    async def receive(ws):
+        for _ in msgs:
+            await ws.recv()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[send(caller) for caller, _ in pairs],
+                         *[receive(callee) for _, callee in pairs])
+    elapsed = time.perf_counter() - start
+    for caller, callee in pairs:
+        await caller.close()
+        await callee.close()
+    return elapsed
+
+
+def main():
+    total = options.pairs * options.messages
+    for name in options.configs.split(','):
+        # Logs go to a real file, like they would to a journal or a pipe
+        with tempfile.TemporaryFile() as out:
+            server = start_server(options.port, *CONFIGS[name].split(), stdout=out)
+            try:
+                cpu = cpu_seconds(server.pid)
+                url = 'ws://127.0.0.1:{}'.format(options.port)
+                elapsed = asyncio.get_event_loop().run_until_complete(run(url))
+                cpu = cpu_seconds(server.pid) - cpu
+            finally:
+                stop_server(server)
+            log_bytes = out.seek(0, 2)
+        print(json.dumps(dict(
+            config=name,
+            messages=total,
+            msgs_per_sec=total / elapsed,
+            server_cpu_us_per_msg=cpu / total * 1e6,
+            log_bytes=log_bytes,
+        )), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# Measure how long it takes for ROOM_PEER_JOINED to reach every member of a
+# room, as the room grows, and what it costs to fill the room. Prints one JSON
+# object per room size.
+#
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from common import hello, start_server, stop_server, summary
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', default=18443, type=int, help='Port for the local server')
+parser.add_argument('--url', default=None, help='Use an already running server instead of starting one')
+parser.add_argument('--sizes', default='10,50,100,200', help='Comma-separated room sizes')
+parser.add_argument('--joins', default=10, type=int, help='Joins measured per room size')
+parser.add_argument('--server-args', default='', help='Extra arguments for simple_server.py')
+parser.add_argument('--member-flags', dest='member_flags', default='', help='Options of the members\' ROOM command, eg "QUIET LIMIT=50" for viewers')
+
+options = parser.parse_args(sys.argv[1:])
+
+
+class Member:
+    def __init__(self, ws, received):
+        self.ws = ws
+        # Bytes received since joining
+        self.received = received
+        # Format: {msg: asyncio.Future}, resolved with the arrival time
+        self.waiting = dict()
+        self.task = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        async for msg in self.ws:
+            self.received += len(msg)
+            fut = self.waiting.pop(msg, None)
+            if fut and not fut.done():
+                fut.set_result(time.perf_counter())
+
+    def expect(self, msg):
+        fut = asyncio.get_event_loop().create_future()
+        self.waiting[msg] = fut
+        return fut
+
+    async def close(self):
+        self.task.cancel()
+        await self.ws.close()
+
+
+async def join(url, room_id, uid, flags=''):
+    '''
+    Returns the connection, and the number of bytes of the replies
+    '''
+    ws = await hello(url, uid)
+    await ws.send('ROOM {} {}'.format(room_id, flags).strip())
+    reply = await ws.recv()
+    assert reply.startswith('ROOM_OK'), reply
+    received = len(reply)
+    if 'LIMIT=' in flags:
+        received += len(await ws.recv())
+    return ws, received
+
+
+async def bench_size(url, size):
+    room_id = 'bench-{}'.format(size)
+    members = []
+    start = time.perf_counter()
+    for i in range(size):
+        members.append(Member(*await join(url, room_id, '{}-m{}'.format(room_id, i),
+                                          options.member_flags)))
+    fill = time.perf_counter() - start
+    # Let the last notices arrive
+    await asyncio.sleep(0.5)
+    received = sum(m.received for m in members)
+    latencies = []
+    # Quiet members are not notified of joins
+    joins = 0 if 'QUIET' in options.member_flags.split() else options.joins
+    for i in range(joins):
+        uid = '{}-j{}'.format(room_id, i)
+        ws = await hello(url, uid)
+        futs = [m.expect('ROOM_PEER_JOINED {}'.format(uid)) for m in members]
+        start = time.perf_counter()
+        await ws.send('ROOM {}'.format(room_id))
+        arrivals = await asyncio.wait_for(asyncio.gather(*futs), 30)
+        # Latency until the last member of the room was notified
+        latencies.append(max(arrivals) - start)
+        await ws.close()
+    for m in members:
+        await m.close()
+    return dict(room_size=size, fill_ms=fill * 1000, fill_received_bytes=received,
+                join_to_last_notified_ms=summary(latencies))
+
+
+async def run(url):
+    for size in [int(s) for s in options.sizes.split(',')]:
+        print(json.dumps(await bench_size(url, size)), flush=True)
+
+
+def main():
+    if options.url:
+        asyncio.get_event_loop().run_until_complete(run(options.url))
+        return
+    server = start_server(options.port, *options.server_args.split())
+    try:
+        url = 'ws://127.0.0.1:{}'.format(options.port)
+        asyncio.get_event_loop().run_until_complete(run(url))
+    finally:
+        stop_server(server)
+
+
+if __name__ == '__main__':
+    main()
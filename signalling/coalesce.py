@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# Trickle ICE coalescing for the signalling server
+#
+# During call setup webrtcbin and browsers emit a burst of ICE candidates, each
+# in its own {"ice": candidate} message. With a coalescing window, the first
+# candidate from a peer to another is still relayed right away, but the ones
+# that follow within the window are relayed together at the end of it as a
+# single {"ice": [candidate, ...]} message, saving frames, syscalls and TLS
+# records. Receivers must accept both forms.
+#
+
+import asyncio
+import json
+
+import slog
+from metrics import ICE_COALESCED
+
+log = slog.get('relay')
+
+# Returned by ice_candidate() for anything that is not an ICE message
+NOT_ICE = object()
+
+
+def ice_candidate(payload):
+    '''
+    Returns the candidate (or list of candidates) of an {"ice": ...} message,
+    or NOT_ICE. Only messages that look like ICE are parsed.
+    '''
+    if not payload.startswith('{"ice"'):
+        return NOT_ICE
+    try:
+        msg = json.loads(payload)
+    except ValueError:
+        return NOT_ICE
+    if not isinstance(msg, dict) or msg.keys() != {'ice'}:
+        return NOT_ICE
+    return msg['ice']
+
+
+class Batch:
+    __slots__ = ('peer', 'prefix', 'pending', 'timer')
+
+    def __init__(self, peer, prefix):
+        self.peer = peer
+        self.prefix = prefix
+        # Format: [(payload, candidate)]
+        self.pending = []
+        self.timer = None
+
+
+class IceCoalescer:
+    '''
+    Relays messages between peers, coalescing ICE candidates sent within
+    @window seconds of each other
+    '''
+    def __init__(self, window, loop):
+        self.window = window
+        self.loop = loop
+        # Format: {(src_uid, dst_uid): Batch}, only while a window is open
+        self.batches = dict()
+
+    async def relay(self, src, dst, peer, payload, prefix=''):
+        '''
+        Send @prefix + @payload from @src to @dst, whose Peer is @peer
+        '''
+        key = (src, dst)
+        batch = self.batches.get(key)
+        candidate = ice_candidate(payload)
+        if candidate is NOT_ICE:
+            # Keep the order: the candidates held back go first
+            if batch is not None:
+                await self.flush(batch)
+            await peer.ws.send(prefix + payload)
+            return
+        if batch is None:
+            batch = self.batches[key] = Batch(peer, prefix)
+            batch.timer = self.loop.call_later(self.window, self.on_timer, key)
+            await peer.ws.send(prefix + payload)
+            return
+        batch.pending.append((payload, candidate))
+
+    def on_timer(self, key):
+        batch = self.batches[key]
+        if not batch.pending:
+            # The burst is over, the next candidate is sent right away
+            del self.batches[key]
+            return
+        asyncio.ensure_future(self.flush(batch))
+        batch.timer = self.loop.call_later(self.window, self.on_timer, key)
+
+    async def flush(self, batch):
+        pending, batch.pending = batch.pending, []
+        if not pending:
+            return
+        if len(pending) == 1:
+            await batch.peer.ws.send(batch.prefix + pending[0][0])
+            return
+        candidates = []
+        for _, candidate in pending:
+            if isinstance(candidate, list):
+                candidates.extend(candidate)
+            else:
+                candidates.append(candidate)
+        ICE_COALESCED.inc(n=len(pending))
+        log.debug('Coalesced ICE candidates', count=len(candidates))
+        await batch.peer.ws.send(batch.prefix + json.dumps({'ice': candidates}))
+
+    def forget(self, uid):
+        '''
+        Drop the candidates held back from or for @uid, which went away
+        '''
+        for key in [key for key in self.batches if uid in key]:
+            self.batches.pop(key).timer.cancel()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# permessage-deflate tuned for the signalling server
+#
+# SDP offers and answers are a few KB of repetitive text and compress well,
+# but most messages are ICE candidates or short commands, where deflate costs
+# CPU to save a handful of bytes. Messages under a threshold are sent
+# uncompressed (RFC 7692 lets the sender choose per message), and the window
+# and memory level are kept small, because every connection holds its own
+# compressor and decompressor.
+#
+
+from websockets import frames
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate, ServerPerMessageDeflateFactory)
+
+from metrics import DEFLATE_BYTES, DEFLATE_SKIPPED
+
+DATA_OPCODES = (frames.Opcode.TEXT, frames.Opcode.BINARY)
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    '''
+    Only compresses messages of at least @threshold bytes
+    '''
+    def __init__(self, *args, threshold, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def encode(self, frame):
+        if frame.opcode in DATA_OPCODES and frame.fin and len(frame.data) < self.threshold:
+            DEFLATE_SKIPPED.inc()
+            return frame
+        encoded = super().encode(frame)
+        if frame.opcode not in frames.CTRL_OPCODES:
+            DEFLATE_BYTES.inc('in', len(frame.data))
+            DEFLATE_BYTES.inc('out', len(encoded.data))
+        return encoded
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, *args, threshold, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def process_request_params(self, params, accepted_extensions):
+        response, ext = super().process_request_params(params, accepted_extensions)
+        return response, ThresholdDeflate(
+            ext.remote_no_context_takeover,
+            ext.local_no_context_takeover,
+            ext.remote_max_window_bits,
+            ext.local_max_window_bits,
+            ext.compress_settings,
+            threshold=self.threshold)
+
+
+def extensions(threshold, window_bits, mem_level, level, no_context_takeover):
+    '''
+    Returns the server extensions for websockets.serve(). @window_bits (9 to
+    15) applies to both directions. Without context takeover, the compressor
+    starts from scratch for every message: less memory per idle connection,
+    but consecutive SDPs no longer compress against each other.
+    '''
+    return [ThresholdDeflateFactory(
+        server_no_context_takeover=no_context_takeover,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings=dict(memLevel=mem_level, level=level),
+        threshold=threshold)]
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+# Compact binary framing for the signalling protocol
+#
+# Clients that offer the SUBPROTOCOL websocket subprotocol exchange binary
+# frames instead of the whitespace-delimited text of Protocol.md. The server
+# keeps working with text internally and translates at the edge of each
+# binary connection, so binary and text peers can talk to each other.
+#
+# A frame is one opcode byte followed by fields. Identifiers (uids, room ids)
+# are each prefixed with their length as an unsigned 16-bit big-endian
+# integer. A payload (relayed SDP/ICE, error text) is always the last field
+# and runs until the end of the frame, so it is never copied to be escaped
+# or scanned for delimiters.
+#
+
+import struct
+
+SUBPROTOCOL = 'gst-webrtc-signalling.binary.v1'
+
+# Fields after the opcode
+IDS = 'ids'                 # any number of length-prefixed identifiers
+PAYLOAD = 'payload'         # the rest of the frame
+ID_PAYLOAD = 'id+payload'   # one length-prefixed identifier, then a payload
+
+# Format: {command: (opcode, fields)}, the relayed session messages have no
+# command in the text protocol
+RELAY = None
+OPCODES = {
+    RELAY: (0, PAYLOAD),
+    'HELLO': (1, IDS),
+    'SESSION': (2, IDS),
+    'SESSION_OK': (3, IDS),
+    'ROOM': (4, IDS),
+    'ROOM_OK': (5, IDS),
+    'ROOM_PEER_MSG': (6, ID_PAYLOAD),
+    'ROOM_PEER_LIST': (7, IDS),
+    'ROOM_PEER_JOINED': (8, IDS),
+    'ROOM_PEER_LEFT': (9, IDS),
+    'ERROR': (10, PAYLOAD),
+    'ROOM_PEERS': (11, IDS),
+    'ROOM_PEERS_SINCE': (12, IDS),
+    'ROOM_PEERS_DELTA': (13, IDS),
+    'ROOM_NOTICES': (14, IDS),
+}
+COMMANDS = {opcode: (command, fields) for command, (opcode, fields) in OPCODES.items()}
+
+_LEN = struct.Struct('!H')
+
+
+class FramingError(ValueError):
+    pass
+
+
+def _pack_id(value):
+    value = value.encode()
+    if len(value) > 0xffff:
+        raise FramingError('identifier too long')
+    return _LEN.pack(len(value)) + value
+
+
+def encode(msg):
+    '''
+    Encode the text protocol message @msg as a binary frame
+    '''
+    command, _, rest = msg.partition(' ')
+    if command not in OPCODES:
+        # Relayed session message
+        command, rest = RELAY, msg
+    opcode, fields = OPCODES[command]
+    parts = [bytes((opcode,))]
+    if fields == IDS:
+        parts += [_pack_id(v) for v in rest.split()]
+    elif fields == ID_PAYLOAD:
+        uid, _, payload = rest.partition(' ')
+        parts += [_pack_id(uid), payload.encode()]
+    else:
+        parts.append(rest.encode())
+    return b''.join(parts)
+
+
+def decode(frame):
+    '''
+    Decode the binary @frame into a text protocol message
+    '''
+    if not isinstance(frame, bytes) or not frame:
+        raise FramingError('expected a non-empty binary frame')
+    if frame[0] not in COMMANDS:
+        raise FramingError('unknown opcode {}'.format(frame[0]))
+    command, fields = COMMANDS[frame[0]]
+    view = memoryview(frame)
+    offset = 1
+    words = [command] if command else []
+    try:
+        if fields in (IDS, ID_PAYLOAD):
+            while offset < len(view):
+                (n,) = _LEN.unpack_from(view, offset)
+                offset += _LEN.size
+                if offset + n > len(view):
+                    raise FramingError('truncated field')
+                words.append(str(view[offset:offset + n], 'utf-8'))
+                offset += n
+                if fields == ID_PAYLOAD:
+                    break
+        if fields != IDS:
+            words.append(str(view[offset:], 'utf-8'))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise FramingError(str(e))
+    return ' '.join(words)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Minimal asyncio wrapper around Linux inotify, used to notice certificate
+# renewals without polling
+#
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Files written in place, replaced by rename (or symlink swap), or touched
+DIR_EVENTS = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class Watch:
+    '''
+    Watches directories, wait() returns once anything in them changed
+    '''
+    def __init__(self, fd, loop):
+        self.fd = fd
+        self.loop = loop
+        self.changed = asyncio.Event()
+        loop.add_reader(fd, self.on_readable)
+
+    @classmethod
+    def create(cls, dirs, loop=None):
+        '''
+        Returns None if inotify is not available on this platform
+        '''
+        name = ctypes.util.find_library('c')
+        if not name:
+            return None
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        for d in set(dirs):
+            if add_watch(fd, os.fsencode(d), DIR_EVENTS) < 0:
+                os.close(fd)
+                return None
+        return cls(fd, loop or asyncio.get_event_loop())
+
+    def on_readable(self):
+        # We don't need the individual events, just drain them
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.changed.set()
+
+    async def wait(self):
+        await self.changed.wait()
+        self.changed.clear()
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
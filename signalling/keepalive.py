@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Keepalive scheduler for idle peers
+#
+# A single hashed timer wheel replaces one timer per peer: receiving a message
+# only stores the current tick in the peer record, and the wheel works out
+# lazily, when the peer's slot comes up, whether it has been idle long enough
+# to need a ping.
+#
+
+import asyncio
+import math
+
+
+class KeepaliveWheel:
+    '''
+    Calls @ping(peers) with the batch of peers idle for @timeout seconds, and
+    @expire(peer) for peers that did not answer the previous ping within
+    another @timeout.
+    '''
+    def __init__(self, timeout, ping, expire, tick=1.0):
+        self.tick = tick
+        self.timeout_ticks = max(1, math.ceil(timeout / tick))
+        # One slot per tick of a timeout, so a peer is never scheduled more
+        # than one turn of the wheel ahead
+        self.slots = [set() for _ in range(self.timeout_ticks + 1)]
+        self.ping = ping
+        self.expire = expire
+        # Current tick, peers copy it into Peer.last_seen on every message
+        self.now = 0
+        self.task = None
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.run(loop))
+
+    def add(self, peer):
+        peer.last_seen = self.now
+        self.schedule(peer, self.timeout_ticks)
+
+    def remove(self, peer):
+        if peer.slot is not None:
+            self.slots[peer.slot].discard(peer)
+            peer.slot = None
+
+    def schedule(self, peer, ticks):
+        peer.slot = (self.now + ticks) % len(self.slots)
+        self.slots[peer.slot].add(peer)
+
+    def advance(self):
+        '''
+        Move to the next tick, and return the peers to ping
+        '''
+        self.now += 1
+        index = self.now % len(self.slots)
+        due = self.slots[index]
+        self.slots[index] = set()
+        batch = []
+        for peer in due:
+            peer.slot = None
+            idle = self.now - peer.last_seen
+            if idle < self.timeout_ticks:
+                # Got a message since it was scheduled
+                self.schedule(peer, self.timeout_ticks - idle)
+                continue
+            if peer.pong is not None and not peer.pong.done():
+                # The previous ping went unanswered for a whole timeout
+                self.expire(peer)
+                continue
+            batch.append(peer)
+            self.schedule(peer, self.timeout_ticks)
+        return batch
+
+    async def run(self, loop):
+        deadline = loop.time()
+        while True:
+            deadline += self.tick
+            await asyncio.sleep(max(0, deadline - loop.time()))
+            batch = self.advance()
+            if batch:
+                # Don't let a peer with a full socket buffer stall the wheel
+                asyncio.ensure_future(self.ping(batch))
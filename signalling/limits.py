@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Admission control and rate limiting for the signalling server
+#
+# Connections are admitted (or refused with 429 before the websocket
+# handshake) according to per-IP and global limits, and the messages of each
+# peer go through token buckets. A peer over its rate is not disconnected:
+# its messages are delayed until it is back within its budget, and since
+# nothing reads its socket meanwhile, TCP pushes back on the client.
+#
+
+import http
+
+import websockets
+
+from metrics import ADMISSION_REFUSED
+
+
+class TokenBucket:
+    '''
+    @rate tokens per second, up to @burst
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def allow(self, now, n=1):
+        '''
+        Take @n tokens if there are enough
+        '''
+        self.refill(now)
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def take(self, now, n=1):
+        '''
+        Take @n tokens, going into debt if there are not enough. Returns how
+        long to wait (in seconds) until the debt is paid back.
+        '''
+        self.refill(now)
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Admission:
+    '''
+    Limits new connections: at most @max_per_ip connections and @rate_per_ip
+    new connections per second from the same address, and at most
+    @max_handshakes connections between being accepted and their HELLO. 0
+    disables a limit.
+    '''
+    # Forget idle addresses every so many admissions
+    SWEEP_EVERY = 1024
+
+    def __init__(self, max_per_ip, rate_per_ip, max_handshakes, clock):
+        self.max_per_ip = max_per_ip
+        self.rate_per_ip = rate_per_ip
+        self.max_handshakes = max_handshakes
+        self.clock = clock
+        # Format: {ip: [connections, TokenBucket or None]}
+        self.ips = dict()
+        self.handshakes = 0
+        self.admissions = 0
+
+    def __bool__(self):
+        return bool(self.max_per_ip or self.rate_per_ip or self.max_handshakes)
+
+    def admit(self, ip):
+        '''
+        Returns None if the connection from @ip is admitted, or why it is not
+        '''
+        now = self.clock()
+        self.admissions += 1
+        if self.admissions % self.SWEEP_EVERY == 0:
+            self.sweep(now)
+        if self.max_handshakes and self.handshakes >= self.max_handshakes:
+            reason = 'handshakes'
+        else:
+            entry = self.ips.get(ip)
+            if entry is None:
+                bucket = None
+                if self.rate_per_ip:
+                    bucket = TokenBucket(self.rate_per_ip, max(1, self.rate_per_ip), now)
+                entry = self.ips[ip] = [0, bucket]
+            if self.max_per_ip and entry[0] >= self.max_per_ip:
+                reason = 'ip_connections'
+            elif entry[1] is not None and not entry[1].allow(now):
+                reason = 'ip_rate'
+            else:
+                entry[0] += 1
+                self.handshakes += 1
+                return None
+        ADMISSION_REFUSED.inc(reason)
+        return reason
+
+    def handshake_done(self):
+        self.handshakes -= 1
+
+    def release(self, ip):
+        entry = self.ips.get(ip)
+        if entry is not None:
+            entry[0] -= 1
+
+    def sweep(self, now):
+        for ip, (count, bucket) in list(self.ips.items()):
+            if count:
+                continue
+            if bucket is not None:
+                bucket.refill(now)
+                if bucket.tokens < bucket.burst:
+                    continue
+            del self.ips[ip]
+
+
+class AdmittingProtocol(websockets.WebSocketServerProtocol):
+    '''
+    Refuses connections over the limits of @admission before the websocket
+    handshake. The server calls handshake_done() once the peer said HELLO.
+    '''
+    def __init__(self, *args, admission, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.admission = admission
+        self.admitted_ip = None
+        self.handshaking = False
+
+    async def process_request(self, path, request_headers):
+        response = await super().process_request(path, request_headers)
+        if response is not None:
+            # Health check or metrics, not subject to limits
+            return response
+        ip = self.remote_address[0] if self.remote_address else None
+        reason = self.admission.admit(ip)
+        if reason is not None:
+            return (http.HTTPStatus.TOO_MANY_REQUESTS, [('Retry-After', '1')],
+                    'Too many connections ({})\n'.format(reason).encode())
+        self.admitted_ip = ip
+        self.handshaking = True
+        return None
+
+    def handshake_done(self):
+        if self.handshaking:
+            self.handshaking = False
+            self.admission.handshake_done()
+
+    def connection_lost(self, exc):
+        self.handshake_done()
+        if self.admitted_ip is not None:
+            self.admission.release(self.admitted_ip)
+            self.admitted_ip = None
+        super().connection_lost(exc)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Minimal Prometheus-style metrics for the signalling server
+#
+# Updating a counter or histogram is a dict update or a bisect, so they can be
+# used in the relay path. Gauges are computed from a callback at scrape time.
+#
+
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        # Format: {label_value: count}
+        self.values = dict() if label else {None: 0}
+
+    def inc(self, key=None, n=1):
+        self.values[key] = self.values.get(key, 0) + n
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield '', {self.label: key} if self.label else {}, value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # One more for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            yield '_bucket', {'le': repr(float(le))}, total
+        total += self.counts[-1]
+        yield '_bucket', {'le': '+Inf'}, total
+        yield '_sum', {}, self.sum
+        yield '_count', {}, total
+
+
+class Gauge:
+    '''
+    @fn returns either a number, or a list of (labels dict, number)
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            yield '', {}, value
+            return
+        for labels, v in value:
+            yield '', labels, v
+
+
+class Registry:
+    def __init__(self):
+        # Format: [(metric, per_worker)]
+        self.metrics = []
+
+    def add(self, metric, per_worker=True):
+        '''
+        Metrics that are not @per_worker describe the state shared by all the
+        workers (peers, sessions, rooms), and are only reported once.
+        '''
+        self.metrics.append((metric, per_worker))
+        return metric
+
+    def collect(self, per_worker):
+        '''
+        Returns [(name, kind, help, [(suffix, labels, value)])], which can be
+        sent to another worker as JSON
+        '''
+        return [(m.name, m.kind, m.help, list(m.samples()))
+                for m, pw in self.metrics if pw == per_worker]
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render(families):
+    '''
+    Render families from Registry.collect() in the Prometheus text format.
+    Families with the same name (from several workers) are merged.
+    '''
+    merged = dict()
+    for name, kind, help, samples in families:
+        if name in merged:
+            merged[name][2].extend(samples)
+        else:
+            merged[name] = (kind, help, list(samples))
+    lines = []
+    for name, (kind, help, samples) in merged.items():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            if labels:
+                labels = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, labels, value))
+            else:
+                lines.append('{}{} {}'.format(name, suffix, value))
+    return '\n'.join(lines) + '\n'
+
+
+def with_label(families, key, value):
+    '''
+    Add the label @key=@value to all the samples of @families
+    '''
+    return [(name, kind, help, [(suffix, dict(labels, **{key: value}), v)
+                                for suffix, labels, v in samples])
+            for name, kind, help, samples in families]
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.add(Counter(
+    'signalling_messages_total', 'Messages received from peers, by command', 'command'))
+BYTES = REGISTRY.add(Counter(
+    'signalling_received_bytes_total', 'Bytes received from peers, by command', 'command'))
+OUTBOUND_LATENCY = REGISTRY.add(Histogram(
+    'signalling_outbound_latency_seconds',
+    'Time from queueing any message (relayed or not) for a peer until it was written to its socket'))
+KEEPALIVE_PINGS = REGISTRY.add(Counter(
+    'signalling_keepalive_pings_total', 'Keepalive pings sent to idle peers'))
+QUEUE_DROPPED = REGISTRY.add(Counter(
+    'signalling_outbound_dropped_total', 'Messages dropped from full outbound queues, by policy', 'policy'))
+ICE_COALESCED = REGISTRY.add(Counter(
+    'signalling_ice_coalesced_total', 'ICE candidate messages relayed as part of a batch, see --ice-coalesce-ms'))
+RESUMES = REGISTRY.add(Counter(
+    'signalling_resumes_total', 'Attempts to resume with a token, by result', 'result'))
+ADMISSION_REFUSED = REGISTRY.add(Counter(
+    'signalling_admission_refused_total', 'Connections refused before the handshake, by limit', 'reason'))
+RATE_LIMITED = REGISTRY.add(Counter(
+    'signalling_rate_limited_total', 'Messages delayed because their peer was over its rate, by limit', 'limit'))
+RATE_LIMITED_SECONDS = REGISTRY.add(Counter(
+    'signalling_rate_limited_seconds_total', 'Time messages were delayed by rate limits'))
+DEFLATE_BYTES = REGISTRY.add(Counter(
+    'signalling_deflate_bytes_total', 'Bytes sent with permessage-deflate, before (in) and after (out) compression', 'stage'))
+DEFLATE_SKIPPED = REGISTRY.add(Counter(
+    'signalling_deflate_skipped_total', 'Messages sent uncompressed because they were under --deflate-threshold'))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Per-peer outbound message queues for the signalling server
+#
+# Each peer gets its own writer task, so that relaying a message to a peer
+# with a full TCP buffer never blocks the handler of the peer that sent it.
+#
+
+import asyncio
+from collections import deque
+
+import websockets
+
+import slog
+from metrics import OUTBOUND_LATENCY, QUEUE_DROPPED
+
+log = slog.get('queue')
+
+POLICIES = ('drop-oldest', 'coalesce', 'disconnect')
+
+# Sentinel queued by PeerWriter.close()
+_CLOSE = object()
+
+
+def superseded(queue, msg):
+    '''
+    Remove from @queue (of (msg, queued_at) items) the messages made obsolete
+    by @msg, and return whether @msg itself is still needed:
+    * A newer ROOM_PEER_LIST replaces an older one
+    * ROOM_PEER_LEFT cancels a ROOM_PEER_JOINED for the same peer that was
+      never delivered, and neither needs to be sent
+    '''
+    if msg.startswith('ROOM_PEER_LIST'):
+        stale = [item for item in queue if item is not _CLOSE
+                 and item[0].startswith('ROOM_PEER_LIST')]
+        for item in stale:
+            queue.remove(item)
+        return True
+    if msg.startswith('ROOM_PEER_LEFT '):
+        joined = 'ROOM_PEER_JOINED ' + msg[len('ROOM_PEER_LEFT '):]
+        for item in queue:
+            if item is not _CLOSE and item[0] == joined:
+                queue.remove(item)
+                return False
+    return True
+
+
+class PeerWriter:
+    '''
+    Wraps a peer's WebSocketServerProtocol: send() only queues the message and
+    a writer task writes it out. The task only exists while there is
+    something to write, so idle peers cost no task. When the queue is full,
+    @policy decides what happens:
+    * drop-oldest: the oldest queued message is dropped
+    * coalesce: obsolete queued messages are dropped (see superseded()),
+      falling back to drop-oldest
+    * disconnect: the peer is disconnected
+    Messages are queued as text, and passed through @encode (if any) just
+    before being written.
+    '''
+    def __init__(self, ws, uid, maxsize, policy, close_timeout=5, encode=None):
+        assert policy in POLICIES
+        self.ws = ws
+        self.uid = uid
+        self.maxsize = maxsize
+        self.policy = policy
+        self.close_timeout = close_timeout
+        self.encode = encode
+        self.remote_address = ws.remote_address
+        # Format: deque([(msg, queued_at)])
+        self.queue = deque()
+        self.loop = asyncio.get_event_loop()
+        # Counters
+        self.max_depth = 0
+        self.dropped = 0
+        self.overflowed = False
+        self.closing = False
+        self.task = None
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    async def send(self, msg):
+        '''
+        Queue @msg for the peer. Never blocks.
+        '''
+        if self.closing:
+            return
+        if len(self.queue) >= self.maxsize and not self.overflow(msg):
+            return
+        if self.policy == 'coalesce' and not superseded(self.queue, msg):
+            return
+        self.queue.append((msg, self.loop.time()))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        if self.task is None or self.task.done():
+            self.task = self.loop.create_task(self.run())
+
+    def overflow(self, msg):
+        '''
+        Make room for @msg in the full queue. Returns False if the peer is
+        being disconnected instead.
+        '''
+        if not self.overflowed:
+            log.warning('Outbound queue full', uid=self.uid,
+                        depth=len(self.queue), policy=self.policy)
+        self.overflowed = True
+        if self.policy == 'disconnect':
+            # The writer is stuck sending to the peer, don't wait for it
+            self.drop(len(self.queue))
+            self.queue.clear()
+            self.closing = True
+            if self.task is not None and not self.task.done():
+                self.task.cancel()
+            else:
+                self.loop.create_task(self.ws.close(code=1008, reason='outbound queue full'))
+            return False
+        if self.policy == 'coalesce':
+            before = len(self.queue)
+            superseded(self.queue, msg)
+            self.drop(before - len(self.queue))
+            if len(self.queue) < self.maxsize:
+                return True
+        self.queue.popleft()
+        self.drop(1)
+        return True
+
+    def pending(self):
+        '''
+        Take the messages that were not written yet
+        '''
+        msgs = [item[0] for item in self.queue if item is not _CLOSE]
+        self.queue.clear()
+        return msgs
+
+    def drop(self, n):
+        self.dropped += n
+        QUEUE_DROPPED.inc(self.policy, n)
+
+    async def run(self):
+        '''
+        Write out the queue. Returns when it is empty, unless the connection
+        has to be closed.
+        '''
+        try:
+            while self.queue:
+                item = self.queue.popleft()
+                if item is _CLOSE:
+                    break
+                msg, queued_at = item
+                await self.ws.send(self.encode(msg) if self.encode else msg)
+                OUTBOUND_LATENCY.observe(self.loop.time() - queued_at)
+            else:
+                return
+        except websockets.ConnectionClosed:
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by overflow() or close(), anything else is a shutdown
+            if not self.closing:
+                raise
+        self.closing = True
+        self.queue.clear()
+        if self.overflowed and self.policy == 'disconnect':
+            await self.ws.close(code=1008, reason='outbound queue full')
+        else:
+            await self.ws.close()
+
+    async def close(self):
+        '''
+        Flush the queued messages (for up to @close_timeout seconds) and close
+        the connection
+        '''
+        self.closing = True
+        if self.task is not None and not self.task.done():
+            self.queue.append(_CLOSE)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), self.close_timeout)
+            except asyncio.TimeoutError:
+                self.task.cancel()
+        await self.ws.close()
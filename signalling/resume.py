@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#
+# Resumable peers for the signalling server
+#
+# Peers that registered with HELLO <uid> RESUME get a token. If their
+# connection drops, or the server restarts, their uid, session or room and the
+# messages sent to them are kept for a grace period, and a new connection that
+# presents the token takes over without the partner noticing.
+#
+
+import secrets
+from collections import deque
+
+
+def new_token():
+    return secrets.token_hex(16)
+
+
+class ParkedPeer:
+    '''
+    Stands in for the PeerWriter of a peer that went away, until it resumes or
+    @timer (an asyncio.TimerHandle that removes it) fires. Messages sent to it
+    are kept, up to @maxsize (the oldest are dropped), to be replayed.
+    '''
+    def __init__(self, uid, remote_address, maxsize, backlog=()):
+        self.uid = uid
+        self.remote_address = remote_address
+        self.queue = deque(backlog, maxlen=maxsize)
+        self.timer = None
+
+    async def send(self, msg):
+        self.queue.append(msg)
+
+    def take(self):
+        '''
+        Stop waiting, and return the messages to replay
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+        backlog, self.queue = list(self.queue), deque()
+        return backlog
+
+    async def close(self):
+        self.take()
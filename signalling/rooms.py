@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# Room membership index for the signalling server
+#
+# Members are kept in join order, with a version bumped on every change. The
+# space-joined member list of ROOM_OK and ROOM_PEER_LIST is extended on joins
+# instead of being rebuilt for every request, pages of ROOM_PEERS are cut from
+# a cached list, and the latest changes are kept so that clients can catch up
+# with a delta instead of listing the room again.
+#
+
+from collections import deque
+
+# Changes kept per room for ROOM_PEERS_SINCE
+DELTA_LOG = 256
+# Largest page returned by ROOM_PEERS
+MAX_PAGE = 1000
+
+
+class Room:
+    __slots__ = ('members', 'quiet', 'version', 'changes', '_list', '_text')
+
+    def __init__(self):
+        # Format: {uid: None}, a set that remembers the join order
+        self.members = dict()
+        # Members that asked not to get ROOM_PEER_JOINED/LEFT notices
+        self.quiet = set()
+        self.version = 0
+        # Format: deque([(version, '+uid' or '-uid')])
+        self.changes = deque(maxlen=DELTA_LOG)
+        # Caches of the member list, None when stale
+        self._list = None
+        self._text = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, uid):
+        return uid in self.members
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def add(self, uid, quiet=False):
+        self.set_quiet(uid, quiet)
+        if uid in self.members:
+            return
+        self.members[uid] = None
+        self.version += 1
+        self.changes.append((self.version, '+' + uid))
+        # Appending is cheaper than rebuilding the whole list
+        if self._list is not None:
+            self._list.append(uid)
+        if self._text is not None:
+            self._text = self._text + ' ' + uid if self._text else uid
+
+    def remove(self, uid):
+        del self.members[uid]
+        self.quiet.discard(uid)
+        self.version += 1
+        self.changes.append((self.version, '-' + uid))
+        self._list = self._text = None
+
+    def set_quiet(self, uid, quiet):
+        if quiet:
+            self.quiet.add(uid)
+        else:
+            self.quiet.discard(uid)
+
+    def list(self):
+        if self._list is None:
+            self._list = list(self.members)
+        return self._list
+
+    def text(self):
+        '''
+        The space-separated member list
+        '''
+        if self._text is None:
+            self._text = ' '.join(self.members)
+        return self._text
+
+    def text_without(self, uid):
+        '''
+        The space-separated member list, without @uid
+        '''
+        text = self.text()
+        if uid not in self.members:
+            return text
+        # uids have no whitespace, so @uid is in there exactly once as a word
+        padded = ' ' + text + ' '
+        i = padded.find(' ' + uid + ' ')
+        return (padded[:i] + padded[i + len(uid) + 1:])[1:-1]
+
+    def page(self, offset, limit):
+        return self.list()[offset:offset + min(limit, MAX_PAGE)]
+
+    def since(self, version):
+        '''
+        The changes after @version, or None if they are not known anymore
+        '''
+        if version == self.version:
+            return []
+        if version > self.version or not self.changes or self.changes[0][0] > version + 1:
+            return None
+        return [change for v, change in self.changes if v > version]
+
+    def notified(self, exclude=None):
+        '''
+        Members that want ROOM_PEER_JOINED/LEFT notices, except @exclude
+        '''
+        return [uid for uid in self.members if uid != exclude and uid not in self.quiet]
+
+
+class RoomIndex(dict):
+    '''
+    Format: {room_id: Room}. Rooms are created on the first join and dropped
+    when the last member leaves.
+    '''
+    def join(self, room_id, uid, quiet=False):
+        room = self.get(room_id)
+        if room is None:
+            room = self[room_id] = Room()
+        room.add(uid, quiet)
+        return room
+
+    def leave(self, room_id, uid):
+        '''
+        Returns the room @uid left, or None if it was not in it
+        '''
+        room = self.get(room_id)
+        if room is None or uid not in room:
+            return None
+        room.remove(uid)
+        if not room:
+            del self[room_id]
+        return room
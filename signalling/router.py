@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#
+# Cross-worker peer routing for the multi-process signalling server
+#
+# Every worker owns the websockets of the peers that connected to it, and
+# keeps a replica of the global peers/sessions/rooms state. State changes are
+# published to the other workers over Unix sockets as newline-delimited JSON,
+# and messages for a peer owned by another worker are forwarded to its owner.
+#
+
+import asyncio
+import json
+import os
+
+import metrics
+import slog
+from outbound import PeerWriter
+from peer import Peer
+from resume import ParkedPeer
+
+log = slog.get('worker')
+
+
+class RemotePeer:
+    '''
+    Stand-in for the websocket of a peer that is connected to another worker.
+    Sending to it or closing it is forwarded to the owning worker.
+    '''
+    def __init__(self, router, worker, uid, remote_address):
+        self.router = router
+        self.worker = worker
+        self.uid = uid
+        self.remote_address = remote_address
+
+    async def send(self, msg):
+        await self.router.send_to(self.worker, 'deliver', uid=self.uid, msg=msg)
+
+    async def close(self):
+        await self.router.send_to(self.worker, 'close', uid=self.uid)
+
+
+class WorkerRouter:
+    def __init__(self, streamer, index, count, ipc_dir):
+        self.streamer = streamer
+        self.index = index
+        self.count = count
+        self.ipc_dir = ipc_dir
+        # Format: {worker_index: asyncio.StreamWriter}
+        self.writers = dict()
+        self.server = None
+        # Format: {request_id: {worker_index: asyncio.Future}}
+        self.metrics_requests = dict()
+        self.next_request_id = 0
+
+    def sock_path(self, index):
+        return os.path.join(self.ipc_dir, 'worker-{}.sock'.format(index))
+
+    async def start(self):
+        if self.server is not None:
+            return
+        path = self.sock_path(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self.reader_handler, path=path)
+        for index in range(self.count):
+            if index != self.index:
+                asyncio.ensure_future(self.connect(index))
+
+    async def connect(self, index):
+        path = self.sock_path(index)
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        self.writers[index] = writer
+        log.info('Connected to worker', worker=self.index, other=index)
+        # Bring the other worker up to date with the peers we own
+        for op, kw in self.snapshot():
+            self.write(writer, op, kw)
+        await writer.drain()
+
+    def snapshot(self):
+        s = self.streamer
+        for uid, peer in s.peers.items():
+            if isinstance(peer.ws, RemotePeer):
+                continue
+            yield 'peer_add', dict(uid=uid, raddr=peer.remote_address, token=peer.token)
+            if peer.status == 'session' and uid in s.sessions:
+                yield 'session', dict(a=uid, b=s.sessions[uid])
+            elif peer.status:
+                quiet = uid in s.rooms[peer.status].quiet
+                yield 'room_join', dict(room_id=peer.status, uid=uid, quiet=quiet)
+
+    ############### Outgoing ###############
+
+    def write(self, writer, op, kw):
+        kw['op'] = op
+        kw['worker'] = self.index
+        writer.write(json.dumps(kw).encode() + b'\n')
+
+    async def send_to(self, index, op, **kw):
+        writer = self.writers.get(index)
+        if writer is None:
+            log.warning('Worker not connected, dropping message', worker=index, op=op)
+            return
+        self.write(writer, op, kw)
+        await writer.drain()
+
+    async def publish(self, op, **kw):
+        for writer in list(self.writers.values()):
+            self.write(writer, op, dict(kw))
+        for writer in list(self.writers.values()):
+            await writer.drain()
+
+    async def collect_metrics(self, timeout=1):
+        '''
+        Ask every other worker for its per-worker metrics. Workers that do not
+        reply in time are left out.
+        '''
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        loop = asyncio.get_event_loop()
+        futures = {index: loop.create_future() for index in self.writers}
+        self.metrics_requests[request_id] = futures
+        try:
+            for index in futures:
+                await self.send_to(index, 'metrics_request', request_id=request_id)
+            if futures:
+                await asyncio.wait(futures.values(), timeout=timeout)
+        finally:
+            del self.metrics_requests[request_id]
+        return {index: fut.result() for index, fut in futures.items() if fut.done()}
+
+    ############### Incoming ###############
+
+    async def reader_handler(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            kw = json.loads(line)
+            op = kw.pop('op')
+            try:
+                await getattr(self, 'on_' + op)(**kw)
+            except Exception as e:
+                log.error('Failed to handle message', worker=self.index, op=op,
+                          other=kw.get('worker'), error=repr(e))
+        writer.close()
+
+    async def on_peer_add(self, worker, uid, raddr, token=None):
+        raddr = tuple(raddr) if raddr else raddr
+        remote = RemotePeer(self, worker, uid, raddr)
+        s = self.streamer
+        peer = s.peers.get(uid)
+        if peer is None or (isinstance(peer.ws, RemotePeer) and peer.ws.worker == worker):
+            # New to us, or @worker telling us again (after reconnecting)
+            if peer is None:
+                s.peers[uid] = Peer(remote, raddr, token=token)
+            else:
+                peer.ws, peer.remote_address, peer.token = remote, raddr, token
+            return
+        if token and s.can_resume(uid, token):
+            # We know it already: it resumed on @worker
+            for msg in s.take_over(peer, remote):
+                await remote.send(msg)
+            return
+        # Two workers registered the same uid before hearing of each other.
+        # Every worker keeps the one of the lowest worker index, the other
+        # one is closed by its own worker.
+        owner = peer.ws.worker if isinstance(peer.ws, RemotePeer) else self.index
+        log.warning('Peer registered on two workers', uid=uid, worker=owner, other=worker)
+        if owner < worker:
+            return
+        old = peer.ws
+        s.wheel.remove(peer)
+        s.peers[uid] = Peer(remote, raddr, token=token)
+        if isinstance(old, PeerWriter):
+            old.closing = True
+            asyncio.ensure_future(old.ws.close(code=1002, reason='invalid peer uid'))
+        elif isinstance(old, ParkedPeer):
+            old.take()
+
+    async def on_peer_del(self, worker, uid):
+        peer = self.streamer.peers.get(uid)
+        if peer and isinstance(peer.ws, RemotePeer):
+            del self.streamer.peers[uid]
+
+    async def on_status(self, worker, uid, status):
+        if uid in self.streamer.peers:
+            self.streamer.peers[uid].status = status
+
+    async def on_session(self, worker, a, b):
+        self.streamer.sessions[a] = b
+        self.streamer.sessions[b] = a
+        for uid in (a, b):
+            if uid in self.streamer.peers:
+                self.streamer.peers[uid].status = 'session'
+
+    async def on_session_del(self, worker, uid):
+        self.streamer.sessions.pop(uid, None)
+
+    async def on_room_join(self, worker, room_id, uid, quiet=False):
+        self.streamer.rooms.join(room_id, uid, quiet)
+        if uid in self.streamer.peers:
+            self.streamer.peers[uid].status = room_id
+
+    async def on_room_leave(self, worker, room_id, uid):
+        self.streamer.rooms.leave(room_id, uid)
+
+    async def on_room_notices(self, worker, room_id, uid, quiet):
+        room = self.streamer.rooms.get(room_id)
+        if room is not None and uid in room:
+            room.set_quiet(uid, quiet)
+
+    async def on_deliver(self, worker, uid, msg):
+        peer = self.streamer.peers.get(uid)
+        if peer is None or isinstance(peer.ws, RemotePeer):
+            log.warning('Cannot deliver, peer not connected here', uid=uid)
+            return
+        await peer.ws.send(msg)
+
+    async def on_deliver_many(self, worker, uids, msg):
+        local = [uid for uid in uids if uid in self.streamer.peers
+                 and not isinstance(self.streamer.peers[uid].ws, RemotePeer)]
+        await self.streamer.broadcast(local, msg)
+
+    async def on_metrics_request(self, worker, request_id):
+        families = metrics.REGISTRY.collect(per_worker=True)
+        await self.send_to(worker, 'metrics_reply', request_id=request_id, families=families)
+
+    async def on_metrics_reply(self, worker, request_id, families):
+        fut = self.metrics_requests.get(request_id, {}).get(worker)
+        if fut and not fut.done():
+            fut.set_result(families)
+
+    async def on_close(self, worker, uid):
+        peer = self.streamer.peers.get(uid)
+        if peer is None or isinstance(peer.ws, RemotePeer):
+            return
+        await peer.ws.close()
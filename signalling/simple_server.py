@@ -9,15 +9,43 @@
 
 import argparse
 import asyncio
-import concurrent
+import functools
 import http
-import logging
 import os
+import secrets
+import shutil
+import signal
 import ssl
 import sys
+import tempfile
 
 import websockets
 
+import compress
+import framing
+import inotify
+import metrics
+import slog
+from coalesce import IceCoalescer
+from keepalive import KeepaliveWheel
+from limits import Admission, AdmittingProtocol, TokenBucket
+from metrics import BYTES, KEEPALIVE_PINGS, MESSAGES, RATE_LIMITED, RATE_LIMITED_SECONDS, RESUMES
+from outbound import POLICIES, PeerWriter
+from peer import Peer
+from resume import ParkedPeer, new_token
+from rooms import RoomIndex
+from router import RemotePeer, WorkerRouter
+from slog import Body
+from state import StateStore
+
+log = slog.get('server')
+peer_log = slog.get('peer')
+session_log = slog.get('session')
+room_log = slog.get('room')
+relay_log = slog.get('relay')
+keepalive_log = slog.get('keepalive')
+
+
 class Streamer:
     def __init__(
         self,
@@ -25,241 +53,732 @@ class Streamer:
         addr,
         port,
         keepalive_timeout,
+        send_timeout,
+        queue_size,
+        queue_policy,
+        ice_coalesce_ms,
+        resume_grace,
+        state_db,
+        max_conns_per_ip,
+        conn_rate_per_ip,
+        max_handshakes,
+        msg_rate,
+        byte_rate,
+        compression,
+        deflate_threshold,
+        deflate_window_bits,
+        deflate_mem_level,
+        deflate_level,
+        deflate_no_context_takeover,
         cert_path,
         disable_ssl,
         health,
+        metrics_path,
         cert_restart,
+        workers=1,
+        worker_index=0,
+        ipc_dir=None,
+        log_level='info',
+        log_format='text',
+        log_sample='',
+        log_bodies='truncate',
+        log_sync=False,
         loop=None
     ):
+        slog.setup(level=log_level, fmt=log_format, sample=log_sample,
+                   bodies=log_bodies, sync=log_sync)
+
         ############### Global data ###############
 
-        # Format: {uid: (Peer WebSocketServerProtocol,
-        #                remote_address,
-        #                <'session'|room_id|None>)}
+        # Format: {uid: Peer}
+        # Peer.ws is a PeerWriter, which queues messages for the
+        # WebSocketServerProtocol, or a RemotePeer for peers connected to
+        # other workers
         self.peers = dict()
         # Format: {caller_uid: callee_uid,
         #          callee_uid: caller_uid}
         # Bidirectional mapping between the two peers
         self.sessions = dict()
-        # Format: {room_id: {peer1_id, peer2_id, peer3_id, ...}}
-        # Room dict with a set of peers in each room
-        self.rooms = dict()
+        # Format: {room_id: rooms.Room}
+        # Members of each room, with cached member lists
+        self.rooms = RoomIndex()
 
         # Event loop
         self.loop = loop or asyncio.get_event_loop()
         # Websocket Server Instance
         self.server = None
+        # SSL context of the server, reloaded when the certificate changes
+        self.sslctx = None
+        # Pings local peers that have been idle for keepalive_timeout
+        self.wheel = KeepaliveWheel(keepalive_timeout, self.ping_peers, self.expire_peer)
+        # Commands peers can send after HELLO (see Protocol.md), and whether
+        # they are only accepted in a room, as opposed to only outside of one
+        # Format: {command: (handler, in_room)}
+        self.commands = {
+            'SESSION': (self.cmd_session, False),
+            'ROOM': (self.cmd_room, False),
+            'ROOM_PEER_MSG': (self.cmd_room_peer_msg, True),
+            'ROOM_PEER_LIST': (self.cmd_room_peer_list, True),
+            'ROOM_PEERS': (self.cmd_room_peers, True),
+            'ROOM_PEERS_SINCE': (self.cmd_room_peers_since, True),
+            'ROOM_NOTICES': (self.cmd_room_notices, True),
+        }
 
         # Options
         self.addr = addr
         self.port = port
         self.keepalive_timeout = keepalive_timeout
+        self.send_timeout = send_timeout
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.resume_grace = resume_grace
+        self.msg_rate = msg_rate
+        self.byte_rate = byte_rate
+        self.compression = compression
+        self.deflate_threshold = deflate_threshold
+        self.deflate_window_bits = deflate_window_bits
+        self.deflate_mem_level = deflate_mem_level
+        self.deflate_level = deflate_level
+        self.deflate_no_context_takeover = deflate_no_context_takeover
         self.cert_restart = cert_restart
         self.cert_path = cert_path
         self.disable_ssl = disable_ssl
         self.health_path = health
+        self.metrics_path = metrics_path
+        self.workers = workers
+        self.worker_index = worker_index
+
+        # Batches the ICE candidates relayed between peers
+        self.ice = None
+        if ice_coalesce_ms > 0:
+            self.ice = IceCoalescer(ice_coalesce_ms / 1000, self.loop)
 
-        # Certificate mtime, used to detect when to restart the server
+        # Routes messages and state changes to the other workers
+        self.router = None
+        if workers > 1:
+            self.router = WorkerRouter(self, worker_index, workers, ipc_dir)
+
+        # Certificate mtime, used to detect when to reload the certificate
         self.cert_mtime = -1
 
-    @classmethod
-    def from_argv(cls):
+        # Limits on new connections
+        self.admission = Admission(max_conns_per_ip, conn_rate_per_ip, max_handshakes,
+                                   self.loop.time)
+
+        # Snapshots of the resumable peers, restored on startup
+        self.state = None
+        if state_db:
+            self.state = StateStore(state_db, worker_index, workers, self.state_row)
+            self.restore_state()
+
+        self.register_metrics()
+
+    @staticmethod
+    def parse_args(argv):
         parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         # See: host, port in https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.create_server
         parser.add_argument('--addr', default='', help='Address to listen on (default: all interfaces, both ipv4 and ipv6)')
         parser.add_argument('--port', default=8443, type=int, help='Port to listen on')
         parser.add_argument('--keepalive-timeout', dest='keepalive_timeout', default=30, type=int, help='Timeout for keepalive (in seconds)')
+        parser.add_argument('--send-timeout', dest='send_timeout', default=5, type=float, help='How long the messages queued for a peer may take to be flushed when it is disconnected (in seconds)')
+        parser.add_argument('--queue-size', dest='queue_size', default=256, type=int, help='Maximum number of messages queued for each peer')
+        parser.add_argument('--queue-policy', dest='queue_policy', default='disconnect', choices=POLICIES, help='What to do when the queue of a peer is full')
+        parser.add_argument('--ice-coalesce-ms', dest='ice_coalesce_ms', default=0, type=float, help='Relay the ICE candidates a peer sends within this window (in milliseconds) of its previous one as a single message; 0 disables it. Clients must accept {"ice": [...]}')
+        parser.add_argument('--resume-grace', dest='resume_grace', default=30, type=float, help='How long peers that registered with HELLO <uid> RESUME are kept after they go away (in seconds), 0 to remove them right away')
+        parser.add_argument('--state-db', dest='state_db', default=None, help='SQLite database where resumable peers are saved, so that they can resume after a restart')
+        parser.add_argument('--max-conns-per-ip', dest='max_conns_per_ip', default=0, type=int, help='Maximum simultaneous connections from one IP address, 0 for no limit')
+        parser.add_argument('--conn-rate-per-ip', dest='conn_rate_per_ip', default=0, type=float, help='Maximum new connections per second from one IP address, 0 for no limit')
+        parser.add_argument('--max-handshakes', dest='max_handshakes', default=0, type=int, help='Maximum connections that did not send HELLO yet, 0 for no limit')
+        parser.add_argument('--msg-rate', dest='msg_rate', default=0, type=float, help='Messages per second each peer may send (with bursts of one second), faster peers are slowed down; 0 for no limit')
+        parser.add_argument('--byte-rate', dest='byte_rate', default=0, type=float, help='Bytes per second each peer may send (with bursts of one second), faster peers are slowed down; 0 for no limit')
+        parser.add_argument('--compression', default='deflate', choices=('deflate', 'none'), help='Compress messages with permessage-deflate, if the client supports it')
+        parser.add_argument('--deflate-threshold', dest='deflate_threshold', default=256, type=int, help='Send messages smaller than this (in bytes) uncompressed, such as ICE candidates')
+        parser.add_argument('--deflate-window-bits', dest='deflate_window_bits', default=12, type=int, choices=range(9, 16), metavar='{9..15}', help='Compression window of each connection, in both directions (2^N bytes)')
+        parser.add_argument('--deflate-mem-level', dest='deflate_mem_level', default=5, type=int, choices=range(1, 10), metavar='{1..9}', help='zlib memory level of each compressor (2^(N+9) bytes)')
+        parser.add_argument('--deflate-level', dest='deflate_level', default=6, type=int, choices=range(0, 10), metavar='{0..9}', help='zlib compression level, lower is cheaper')
+        parser.add_argument('--deflate-no-context-takeover', dest='deflate_no_context_takeover', default=False, action='store_true', help='Compress every message on its own: less memory per idle connection, but worse compression of consecutive SDPs')
         parser.add_argument('--cert-path', default=os.path.dirname(__file__))
         parser.add_argument('--disable-ssl', default=False, help='Disable ssl', action='store_true')
         parser.add_argument('--health', default='/health', help='Health check route')
-        parser.add_argument('--restart-on-cert-change', default=False, dest='cert_restart', action='store_true', help='Automatically restart if the SSL certificate changes')
+        parser.add_argument('--metrics', dest='metrics_path', default='/metrics', help='Prometheus metrics route')
+        parser.add_argument('--restart-on-cert-change', default=False, dest='cert_restart', action='store_true', help='Automatically reload the SSL certificate when it changes, without dropping connected peers')
+        parser.add_argument('--workers', default=1, type=int, help='Number of worker processes sharing the port with SO_REUSEPORT')
+        parser.add_argument('--log-level', dest='log_level', default='info', choices=('debug', 'info', 'warning', 'error'), help='Log level, relayed messages and keepalives are logged at debug')
+        parser.add_argument('--log-format', dest='log_format', default='text', choices=('text', 'json'), help='Log record format')
+        parser.add_argument('--log-sample', dest='log_sample', default='', help='Only log 1 in N records of a category, eg "relay=100,keepalive=10"')
+        parser.add_argument('--log-bodies', dest='log_bodies', default='truncate', choices=slog.BODY_MODES, help='How message bodies are logged')
+        parser.add_argument('--log-sync', dest='log_sync', default=False, action='store_true', help='Write logs from the event loop instead of a background thread')
+        parser.add_argument('--ipc-dir', dest='ipc_dir', default=None, help='Directory for the worker routing sockets (default: a temporary directory)')
+
+        options = parser.parse_args(argv)
+        if options.queue_size < 1:
+            parser.error('--queue-size must be at least 1')
+        return options
 
-        options = parser.parse_args(sys.argv[1:])
+    @classmethod
+    def from_argv(cls):
+        options = Streamer.parse_args(sys.argv[1:])
 
         streamer = cls(**vars(options))
         return streamer
 
     def run_forever(self):
-        print('Starting server...')
-        while True:
-            self.run()
-            self.loop.run_forever()
-            print('Restarting server...')
-        print("Goodbye!")
+        log.info('Starting server...')
+        self.run()
+        self.loop.run_forever()
 
     ############### Helper functions ###############
 
-    async def health_check(self, path, request_headers):
+    async def relay(self, src, dst, other, msg, prefix=''):
+        '''
+        Send @prefix + @msg from peer @src to peer @dst, whose Peer is @other
+        '''
+        if self.ice:
+            await self.ice.relay(src, dst, other, msg, prefix)
+        else:
+            await other.ws.send(prefix + msg)
+
+    async def publish(self, op, **kw):
+        '''
+        Tell the other workers about a change to the peers, sessions or rooms,
+        and note it for the next snapshot
+        '''
+        if self.state:
+            for key in ('uid', 'a', 'b'):
+                if key in kw:
+                    self.state.mark(kw[key])
+        if self.router:
+            await self.router.publish(op, **kw)
+
+    async def broadcast(self, uids, msg):
+        '''
+        Send @msg to all of @uids. Local peers only get it queued (see
+        PeerWriter), so a slow peer does not delay the others. Peers owned by
+        other workers are grouped into one forwarded message per worker.
+        '''
+        remote = dict()
+        for pid in uids:
+            if pid not in self.peers:
+                continue
+            wsp = self.peers[pid].ws
+            if isinstance(wsp, RemotePeer):
+                remote.setdefault(wsp.worker, []).append(pid)
+            else:
+                await wsp.send(msg)
+        await asyncio.gather(*[self.router.send_to(worker, 'deliver_many', uids=pids, msg=msg)
+                               for worker, pids in remote.items()])
+
+    def queue_depths(self):
+        '''
+        Number of messages waiting to be sent to each local peer
+        '''
+        return {uid: peer.ws.depth for uid, peer in self.peers.items()
+                if isinstance(peer.ws, PeerWriter)}
+
+    async def forget_peer(self, uid):
+        self.wheel.remove(self.peers.pop(uid))
+        if self.ice:
+            self.ice.forget(uid)
+        await self.publish('peer_del', uid=uid)
+
+    async def process_request(self, path, request_headers):
         if path == self.health_path:
             return http.HTTPStatus.OK, [], b"OK\n"
+        if path == self.metrics_path:
+            body = await self.render_metrics()
+            headers = [('Content-Type', 'text/plain; version=0.0.4')]
+            return http.HTTPStatus.OK, headers, body.encode()
         return None
 
-    async def recv_msg_ping(self, ws, raddr):
+    def register_metrics(self):
+        R = metrics.REGISTRY
+        # Shared state, every worker has the same view of it
+        R.add(metrics.Gauge('signalling_peers', 'Registered peers',
+                            lambda: len(self.peers)), per_worker=False)
+        R.add(metrics.Gauge('signalling_sessions', 'Active 1-1 sessions',
+                            lambda: len(self.sessions) // 2), per_worker=False)
+        R.add(metrics.Gauge('signalling_rooms', 'Non-empty rooms',
+                            lambda: sum(1 for r in self.rooms.values() if r)), per_worker=False)
+        R.add(metrics.Gauge('signalling_largest_room_peers', 'Number of peers in the largest room',
+                            lambda: max(map(len, self.rooms.values()), default=0)), per_worker=False)
+        # Owned by this worker
+        R.add(metrics.Gauge('signalling_local_peers', 'Peers connected to this worker',
+                            lambda: len(self.queue_depths())))
+        R.add(metrics.Gauge('signalling_parked_peers', 'Peers of this worker waiting to resume',
+                            lambda: sum(1 for p in self.peers.values() if isinstance(p.ws, ParkedPeer))))
+        R.add(metrics.Gauge('signalling_handshakes_in_flight', 'Connections that did not send HELLO yet',
+                            lambda: self.admission.handshakes))
+        R.add(metrics.Gauge('signalling_outbound_queue_depth',
+                            'Messages waiting to be sent, for each peer with a non-empty queue',
+                            lambda: [({'uid': uid}, depth) for uid, depth in self.queue_depths().items() if depth]))
+        R.add(metrics.Gauge('signalling_outbound_queue_depth_max', 'Deepest outbound queue',
+                            lambda: max(self.queue_depths().values(), default=0)))
+
+    async def render_metrics(self):
+        families = metrics.REGISTRY.collect(per_worker=False)
+        local = metrics.REGISTRY.collect(per_worker=True)
+        families += metrics.with_label(local, 'worker', self.worker_index)
+        if self.router:
+            for index, remote in (await self.router.collect_metrics()).items():
+                families += metrics.with_label(remote, 'worker', index)
+        return metrics.render(families)
+
+    async def ping_peers(self, peers):
         '''
-        Wait for a message forever, and send a regular ping to prevent bad routers
-        from closing the connection.
+        Send a regular ping to idle peers to prevent bad routers from closing
+        the connection.
         '''
-        msg = None
-        while msg is None:
+        async def ping(peer):
+            if not isinstance(peer.ws, PeerWriter):
+                # Went away since
+                return
             try:
-                msg = await asyncio.wait_for(ws.recv(), self.keepalive_timeout)
-            except (asyncio.TimeoutError, concurrent.futures._base.TimeoutError):
-                print('Sending keepalive ping to {!r} in recv'.format(raddr))
-                await ws.ping()
-        return msg
+                peer.pong = await peer.ws.ws.ping()
+            except websockets.ConnectionClosed:
+                return
+            # Fails if the connection is closed before the pong arrives
+            peer.pong.add_done_callback(lambda f: f.cancelled() or f.exception())
+        keepalive_log.debug('Sending keepalive pings', count=len(peers))
+        KEEPALIVE_PINGS.inc(n=len(peers))
+        await asyncio.gather(*map(ping, peers))
+
+    def expire_peer(self, peer):
+        if not isinstance(peer.ws, PeerWriter):
+            return
+        keepalive_log.info('Keepalive ping timed out', raddr=peer.remote_address)
+        asyncio.ensure_future(peer.ws.ws.close(code=1011, reason='keepalive ping timeout'))
 
     async def cleanup_session(self, uid):
         if uid in self.sessions:
             other_id = self.sessions[uid]
             del self.sessions[uid]
-            print("Cleaned up {} session".format(uid))
+            await self.publish('session_del', uid=uid)
+            session_log.info('Cleaned up session', uid=uid)
             if other_id in self.sessions:
                 del self.sessions[other_id]
-                print("Also cleaned up {} session".format(other_id))
+                await self.publish('session_del', uid=other_id)
+                session_log.info('Also cleaned up session', uid=other_id)
                 # If there was a session with this peer, also
                 # close the connection to reset its state.
                 if other_id in self.peers:
-                    print("Closing connection to {}".format(other_id))
-                    wso, oaddr, _ = self.peers[other_id]
-                    del self.peers[other_id]
+                    session_log.info('Closing connection', uid=other_id)
+                    wso = self.peers[other_id].ws
+                    await self.forget_peer(other_id)
                     await wso.close()
 
     async def cleanup_room(self, uid, room_id):
-        room_peers = self.rooms[room_id]
-        if uid not in room_peers:
+        room = self.rooms.leave(room_id, uid)
+        if room is None:
             return
-        room_peers.remove(uid)
-        for pid in room_peers:
-            wsp, paddr, _ = self.peers[pid]
-            msg = 'ROOM_PEER_LEFT {}'.format(uid)
-            print('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
-            await wsp.send(msg)
+        await self.publish('room_leave', room_id=room_id, uid=uid)
+        others = room.notified()
+        msg = 'ROOM_PEER_LEFT {}'.format(uid)
+        room_log.info('Peer left', room=room_id, uid=uid, notified=len(others))
+        await self.broadcast(others, msg)
 
     async def remove_peer(self, uid):
         await self.cleanup_session(uid)
         if uid in self.peers:
-            ws, raddr, status = self.peers[uid]
-            if status and status != 'session':
-                await self.cleanup_room(uid, status)
-            del self.peers[uid]
-            await ws.close()
-            print("Disconnected from peer {!r} at {!r}".format(uid, raddr))
+            peer = self.peers[uid]
+            if peer.status and peer.status != 'session':
+                await self.cleanup_room(uid, peer.status)
+            await self.forget_peer(uid)
+            await peer.ws.close()
+            peer_log.info('Disconnected from peer', uid=uid, raddr=peer.remote_address)
+
+    async def disconnect_peer(self, uid, ws):
+        '''
+        The connection @ws of @uid is gone: remove the peer, or keep it for a
+        while if it can resume
+        '''
+        peer = self.peers.get(uid)
+        if peer is None or not isinstance(peer.ws, PeerWriter) or peer.ws.ws is not ws:
+            # Already removed, or resumed on another connection
+            return
+        # A normal close means the peer is leaving, 1008 that it can't keep up
+        if (peer.token and self.resume_grace > 0 and ws.closed
+                and ws.close_code not in (1000, 1008)):
+            self.park_peer(uid, peer, peer.ws.pending())
+            return
+        await self.remove_peer(uid)
+
+    def park_peer(self, uid, peer, backlog):
+        '''
+        Keep @peer for --resume-grace seconds, with the messages sent to it
+        '''
+        parked = ParkedPeer(uid, peer.remote_address, self.queue_size, backlog)
+        parked.timer = self.loop.call_later(self.resume_grace, self.expire_parked, uid, parked)
+        peer.ws = parked
+        self.wheel.remove(peer)
+        peer_log.info('Waiting for peer to resume', uid=uid, raddr=peer.remote_address,
+                      grace=self.resume_grace)
+
+    def expire_parked(self, uid, parked):
+        peer = self.peers.get(uid)
+        if peer is not None and peer.ws is parked:
+            peer_log.info('Peer did not resume', uid=uid)
+            asyncio.ensure_future(self.remove_peer(uid))
+
+    def can_resume(self, uid, token):
+        peer = self.peers.get(uid)
+        return (bool(token) and peer is not None and peer.token is not None
+                and secrets.compare_digest(peer.token, token))
+
+    def take_over(self, peer, ws):
+        '''
+        @peer resumed: make @ws (a PeerWriter, or a RemotePeer if it resumed on
+        another worker) its connection. Returns the messages that were
+        waiting for it.
+        '''
+        old = peer.ws
+        backlog = []
+        if isinstance(old, ParkedPeer):
+            backlog = old.take()
+        elif isinstance(old, PeerWriter):
+            # We had not noticed that the previous connection was gone
+            backlog = old.pending()
+            old.closing = True
+            asyncio.ensure_future(old.ws.close(code=4000, reason='resumed on another connection'))
+        peer.ws = ws
+        peer.remote_address = ws.remote_address
+        self.wheel.remove(peer)
+        if isinstance(ws, PeerWriter):
+            self.wheel.add(peer)
+        return backlog
+
+    ############### Snapshots ###############
+
+    def state_row(self, uid):
+        '''
+        What StateStore saves about @uid, None if it is not ours or can't
+        resume
+        '''
+        peer = self.peers.get(uid)
+        if peer is None or peer.token is None or isinstance(peer.ws, RemotePeer):
+            return None
+        partner, quiet = None, False
+        if peer.status == 'session':
+            partner = self.sessions.get(uid)
+        elif peer.status in self.rooms:
+            quiet = uid in self.rooms[peer.status].quiet
+        return peer.token, peer.status, partner, int(quiet)
+
+    def restore_state(self):
+        '''
+        Bring back the resumable peers of the last snapshot, waiting for them
+        to resume
+        '''
+        rows = self.state.load()
+        # The partners may have been on other workers, which restore them
+        partners = self.state.sessions()
+        for uid, token, status, partner, quiet in rows:
+            if status == 'session' and partners.get(partner) != uid:
+                # The other peer can't resume, the session is over
+                status = None
+            peer = self.peers[uid] = Peer(None, None, status, token)
+            self.park_peer(uid, peer, ())
+            if status == 'session':
+                self.sessions[uid] = partner
+            elif status:
+                self.rooms.join(status, uid, bool(quiet))
+        log.info('Restored resumable peers', count=len(rows))
+
+    def terminate(self):
+        '''
+        SIGTERM: save the state before going down
+        '''
+        log.info('Saving state and exiting')
+        self.state.flush()
+        slog.flush()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
 
     ############### Handler functions ###############
 
-    
-    async def connection_handler(self, ws, uid):
+    def rate_buckets(self):
+        '''
+        Token buckets for the messages and bytes of a peer, or None
+        '''
+        now = self.loop.time()
+        msgs = bytes_ = None
+        if self.msg_rate:
+            msgs = TokenBucket(self.msg_rate, max(1, self.msg_rate), now)
+        if self.byte_rate:
+            bytes_ = TokenBucket(self.byte_rate, self.byte_rate, now)
+        return (msgs, bytes_) if msgs or bytes_ else None
+
+    async def throttle(self, uid, buckets, size):
+        '''
+        Wait until the peer is within its rates again. Meanwhile its
+        connection is not read from, which slows the client down.
+        '''
+        msgs, bytes_ = buckets
+        now = self.loop.time()
+        wait = 0
+        if msgs is not None:
+            delay = msgs.take(now)
+            if delay:
+                RATE_LIMITED.inc('messages')
+            wait = delay
+        if bytes_ is not None:
+            delay = bytes_.take(now, size)
+            if delay:
+                RATE_LIMITED.inc('bytes')
+            wait = max(wait, delay)
+        if wait:
+            peer_log.debug('Rate limited', uid=uid, delay=wait)
+            RATE_LIMITED_SECONDS.inc(n=wait)
+            await asyncio.sleep(wait)
+
+    async def recv(self, ws):
+        '''
+        Receive a message from @ws in the text protocol, translating it if the
+        peer negotiated binary framing
+        '''
+        return self.decode(ws, await ws.recv())
+
+    @staticmethod
+    def decode(ws, frame):
+        '''
+        The text protocol message in @frame, received from @ws
+        '''
+        if ws.subprotocol == framing.SUBPROTOCOL:
+            return framing.decode(frame)
+        return frame
+
+    async def cmd_session(self, uid, peer, callee_id):
+        '''
+        SESSION callee_id: requested a session with a specific peer
+        '''
+        session_log.debug('Command', uid=uid, callee=callee_id)
+        if callee_id not in self.peers:
+            await peer.ws.send('ERROR peer {!r} not found'.format(callee_id))
+            return
+        if peer.status is not None:
+            await peer.ws.send('ERROR peer {!r} busy'.format(callee_id))
+            return
+        await peer.ws.send('SESSION_OK')
+        callee = self.peers[callee_id]
+        session_log.info('Session', caller=uid, caller_raddr=peer.remote_address,
+                         callee=callee_id, callee_raddr=callee.remote_address)
+        # Register session
+        peer.status = 'session'
+        self.sessions[uid] = callee_id
+        callee.status = 'session'
+        self.sessions[callee_id] = uid
+        await self.publish('session', a=uid, b=callee_id)
+
+    async def cmd_room(self, uid, peer, args):
+        '''
+        ROOM room_id [QUIET] [LIMIT=n]: requested joining or creation of a room
+        * QUIET: don't send ROOM_PEER_JOINED/LEFT notices to this peer
+        * LIMIT=n: instead of listing all the members in ROOM_OK, reply with
+          an empty ROOM_OK followed by the first page of ROOM_PEERS
+        '''
+        room_log.debug('Command', uid=uid, body=Body(args))
+        room_id, *flags = args.split() or ['']
+        # Room name cannot be 'session' or empty
+        if not room_id or room_id == 'session':
+            await peer.ws.send('ERROR invalid room id {!r}'.format(room_id))
+            return
+        quiet, limit = False, None
+        for flag in flags:
+            if flag == 'QUIET':
+                quiet = True
+            elif flag.startswith('LIMIT=') and flag[6:].isdigit():
+                limit = int(flag[6:])
+            else:
+                await peer.ws.send('ERROR invalid room option {!r}'.format(flag))
+                return
+        if uid in self.rooms.get(room_id, ()):
+            raise AssertionError('How did we accept a ROOM command '
+                                 'despite already being in a room?')
+        if limit is None:
+            room = self.rooms.get(room_id)
+            await peer.ws.send('ROOM_OK {}'.format(room.text() if room else ''))
+        else:
+            await peer.ws.send('ROOM_OK ')
+        # Enter room, creating it if required
+        peer.status = room_id
+        room = self.rooms.join(room_id, uid, quiet)
+        await self.publish('room_join', room_id=room_id, uid=uid, quiet=quiet)
+        if limit is not None:
+            await self.send_room_page(peer, room, 0, limit)
+        others = room.notified(exclude=uid)
+        msg = 'ROOM_PEER_JOINED {}'.format(uid)
+        room_log.info('Peer joined', room=room_id, uid=uid, notified=len(others))
+        await self.broadcast(others, msg)
+
+    async def cmd_room_peer_msg(self, uid, peer, args):
+        '''
+        ROOM_PEER_MSG peer_id MSG: relay MSG to another peer of the room
+        '''
+        other_id, _, msg = args.partition(' ')
+        if other_id not in self.peers:
+            await peer.ws.send('ERROR peer {!r} not found'.format(other_id))
+            return
+        other = self.peers[other_id]
+        if other.status != peer.status:
+            await peer.ws.send('ERROR peer {!r} is not in the room'.format(other_id))
+            return
+        relay_log.debug('Room message', room=peer.status, src=uid,
+                        dst=other_id, size=len(msg), body=Body(msg))
+        await self.relay(uid, other_id, other, msg, 'ROOM_PEER_MSG {} '.format(uid))
+
+    async def cmd_room_peer_list(self, uid, peer, args):
+        '''
+        ROOM_PEER_LIST: list the other peers of the room
+        '''
+        room = self.rooms[peer.status]
+        room_log.debug('Peer list', room=peer.status, uid=uid, count=len(room) - 1)
+        await peer.ws.send('ROOM_PEER_LIST {}'.format(room.text_without(uid)))
+
+    async def send_room_page(self, peer, room, offset, limit):
+        page = room.page(offset, limit)
+        await peer.ws.send('ROOM_PEERS {} {} {} {}'.format(
+            room.version, len(room), offset, ' '.join(page)))
+
+    async def cmd_room_peers(self, uid, peer, args):
+        '''
+        ROOM_PEERS offset limit: list the members of the room (including this
+        peer) in join order, a page at a time
+        '''
+        try:
+            offset, limit = map(int, args.split())
+            if offset < 0 or limit < 0:
+                raise ValueError
+        except ValueError:
+            await peer.ws.send('ERROR invalid ROOM_PEERS {!r}'.format(args))
+            return
+        await self.send_room_page(peer, self.rooms[peer.status], offset, limit)
+
+    async def cmd_room_peers_since(self, uid, peer, args):
+        '''
+        ROOM_PEERS_SINCE version: the joins (+uid) and leaves (-uid) since
+        @version of the room, or * if they are too old to be known
+        '''
+        if not args.isdigit():
+            await peer.ws.send('ERROR invalid ROOM_PEERS_SINCE {!r}'.format(args))
+            return
+        room = self.rooms[peer.status]
+        changes = room.since(int(args))
+        await peer.ws.send('ROOM_PEERS_DELTA {} {}'.format(
+            room.version, '*' if changes is None else ' '.join(changes)))
+
+    async def cmd_room_notices(self, uid, peer, args):
+        '''
+        ROOM_NOTICES ON|OFF: subscribe to ROOM_PEER_JOINED/LEFT notices, or not
+        '''
+        if args not in ('ON', 'OFF'):
+            await peer.ws.send('ERROR invalid ROOM_NOTICES {!r}'.format(args))
+            return
+        quiet = args == 'OFF'
+        self.rooms[peer.status].set_quiet(uid, quiet)
+        await self.publish('room_notices', room_id=peer.status, uid=uid, quiet=quiet)
+
+    async def connection_handler(self, ws, uid, resume):
+        '''
+        @resume is None for peers that can't resume, '' for peers that want
+        a resume token, or the token of the peer they resume
+        '''
         raddr = ws.remote_address
-        peer_status = None
-        self.peers[uid] = [ws, raddr, peer_status]
-        print("Registered peer {!r} at {!r}".format(uid, raddr))
+        # Everything sent to this peer goes through its queue, and is
+        # translated to binary frames if the peer asked for them
+        encode = framing.encode if ws.subprotocol == framing.SUBPROTOCOL else None
+        writer = PeerWriter(ws, uid, self.queue_size, self.queue_policy,
+                            close_timeout=self.send_timeout, encode=encode)
+        if self.can_resume(uid, resume):
+            peer = self.peers[uid]
+            backlog = self.take_over(peer, writer)
+            reply = ['HELLO', 'RESUMED', peer.token]
+            if peer.status == 'session':
+                reply += ['SESSION', self.sessions[uid]]
+            elif peer.status:
+                reply += ['ROOM', peer.status]
+            # Send back a HELLO, then what it missed
+            await writer.send(' '.join(reply))
+            for msg in backlog:
+                await writer.send(msg)
+            RESUMES.inc('resumed')
+            peer_log.info('Resumed peer', uid=uid, raddr=raddr, status=peer.status,
+                          replayed=len(backlog))
+        else:
+            if resume:
+                RESUMES.inc('expired')
+            token = new_token() if resume is not None else None
+            peer = Peer(writer, raddr, token=token)
+            self.peers[uid] = peer
+            self.wheel.add(peer)
+            # Send back a HELLO
+            await writer.send('HELLO {}'.format(token) if token else 'HELLO')
+            peer_log.info('Registered peer', uid=uid, raddr=raddr, resumable=bool(token))
+        await self.publish('peer_add', uid=uid, raddr=raddr, token=peer.token)
+        buckets = self.rate_buckets()
         while True:
             # Receive command, wait forever if necessary
-            msg = await self.recv_msg_ping(ws, raddr)
-            # Update current status
-            peer_status = self.peers[uid][2]
-            # We are in a session or a room, messages must be relayed
-            if peer_status is not None:
-                # We're in a session, route message to connected peer
-                if peer_status == 'session':
-                    other_id = self.sessions[uid]
-                    wso, oaddr, status = self.peers[other_id]
-                    assert(status == 'session')
-                    print("{} -> {}: {}".format(uid, other_id, msg))
-                    await wso.send(msg)
-                # We're in a room, accept room-specific commands
-                elif peer_status:
-                    # ROOM_PEER_MSG peer_id MSG
-                    if msg.startswith('ROOM_PEER_MSG'):
-                        _, other_id, msg = msg.split(maxsplit=2)
-                        if other_id not in self.peers:
-                            await ws.send('ERROR peer {!r} not found'
-                                          ''.format(other_id))
-                            continue
-                        wso, oaddr, status = self.peers[other_id]
-                        if status != room_id:
-                            await ws.send('ERROR peer {!r} is not in the room'
-                                          ''.format(other_id))
-                            continue
-                        msg = 'ROOM_PEER_MSG {} {}'.format(uid, msg)
-                        print('room {}: {} -> {}: {}'.format(room_id, uid, other_id, msg))
-                        await wso.send(msg)
-                    elif msg == 'ROOM_PEER_LIST':
-                        room_id = self.peers[peer_id][2]
-                        room_peers = ' '.join([pid for pid in self.rooms[room_id] if pid != peer_id])
-                        msg = 'ROOM_PEER_LIST {}'.format(room_peers)
-                        print('room {}: -> {}: {}'.format(room_id, uid, msg))
-                        await ws.send(msg)
-                    else:
-                        await ws.send('ERROR invalid msg, already in room')
-                        continue
-                else:
-                    raise AssertionError('Unknown peer status {!r}'.format(peer_status))
-            # Requested a session with a specific peer
-            elif msg.startswith('SESSION'):
-                print("{!r} command {!r}".format(uid, msg))
-                _, callee_id = msg.split(maxsplit=1)
-                if callee_id not in self.peers:
-                    await ws.send('ERROR peer {!r} not found'.format(callee_id))
-                    continue
-                if peer_status is not None:
-                    await ws.send('ERROR peer {!r} busy'.format(callee_id))
-                    continue
-                await ws.send('SESSION_OK')
-                wsc = self.peers[callee_id][0]
-                print('Session from {!r} ({!r}) to {!r} ({!r})'
-                      ''.format(uid, raddr, callee_id, wsc.remote_address))
-                # Register session
-                self.peers[uid][2] = peer_status = 'session'
-                self.sessions[uid] = callee_id
-                self.peers[callee_id][2] = 'session'
-                self.sessions[callee_id] = uid
-            # Requested joining or creation of a room
-            elif msg.startswith('ROOM'):
-                print('{!r} command {!r}'.format(uid, msg))
-                _, room_id = msg.split(maxsplit=1)
-                # Room name cannot be 'session', empty, or contain whitespace
-                if room_id == 'session' or room_id.split() != [room_id]:
-                    await ws.send('ERROR invalid room id {!r}'.format(room_id))
-                    continue
-                if room_id in self.rooms:
-                    if uid in self.rooms[room_id]:
-                        raise AssertionError('How did we accept a ROOM command '
-                                             'despite already being in a room?')
-                else:
-                    # Create room if required
-                    self.rooms[room_id] = set()
-                room_peers = ' '.join([pid for pid in self.rooms[room_id]])
-                await ws.send('ROOM_OK {}'.format(room_peers))
-                # Enter room
-                self.peers[uid][2] = peer_status = room_id
-                self.rooms[room_id].add(uid)
-                for pid in self.rooms[room_id]:
-                    if pid == uid:
-                        continue
-                    wsp, paddr, _ = self.peers[pid]
-                    msg = 'ROOM_PEER_JOINED {}'.format(uid)
-                    print('room {}: {} -> {}: {}'.format(room_id, uid, pid, msg))
-                    await wsp.send(msg)
+            frame = await ws.recv()
+            peer.last_seen = self.wheel.now
+            # Invalid frames count against the rates too
+            if buckets:
+                await self.throttle(uid, buckets, len(frame))
+            try:
+                msg = self.decode(ws, frame)
+            except framing.FramingError as e:
+                MESSAGES.inc('unknown')
+                BYTES.inc('unknown', len(frame))
+                await writer.send('ERROR invalid frame: {}'.format(e))
+                continue
+            # We're in a session, route message to connected peer
+            if peer.status == 'session':
+                MESSAGES.inc('relay')
+                BYTES.inc('relay', len(msg))
+                other_id = self.sessions[uid]
+                other = self.peers[other_id]
+                assert(other.status == 'session')
+                relay_log.debug('Session message', src=uid, dst=other_id,
+                                size=len(msg), body=Body(msg))
+                await self.relay(uid, other_id, other, msg)
+                continue
+            cmd, _, args = msg.partition(' ')
+            handler, in_room = self.commands.get(cmd, (None, None))
+            MESSAGES.inc(cmd if handler else 'unknown')
+            BYTES.inc(cmd if handler else 'unknown', len(msg))
+            if handler is not None and in_room == (peer.status is not None):
+                await handler(uid, peer, args.lstrip())
+            elif peer.status is not None:
+                # We're in a room, only room-specific commands are accepted
+                await writer.send('ERROR invalid msg, already in room')
             else:
-                print('Ignoring unknown message {!r} from {!r}'.format(msg, uid))
+                peer_log.warning('Ignoring unknown message', uid=uid, body=Body(msg))
 
     async def hello_peer(self, ws):
         '''
-        Exchange hello, register peer
+        Receive hello: HELLO uid [RESUME [token]]. Returns the uid, and the
+        resume argument of connection_handler().
         '''
         raddr = ws.remote_address
-        hello = await ws.recv()
-        hello, uid = hello.split(maxsplit=1)
-        if hello != 'HELLO':
+        try:
+            hello = await self.recv(ws)
+        except framing.FramingError:
+            await ws.close(code=1002, reason='invalid frame')
+            raise
+        MESSAGES.inc('HELLO')
+        BYTES.inc('HELLO', len(hello))
+        words = hello.split()
+        if (not words or words[0] != 'HELLO' or len(words) > 4
+                or (len(words) > 2 and words[2] != 'RESUME')):
             await ws.close(code=1002, reason='invalid protocol')
             raise Exception("Invalid hello from {!r}".format(raddr))
-        if not uid or uid in self.peers or uid.split() != [uid]: # no whitespace
+        uid = words[1] if len(words) > 1 else ''
+        resume = None
+        if len(words) > 2:
+            resume = words[3] if len(words) > 3 else ''
+        if not uid or (uid in self.peers and not self.can_resume(uid, resume)):
+            if resume:
+                RESUMES.inc('rejected')
             await ws.close(code=1002, reason='invalid peer uid')
             raise Exception("Invalid uid {!r} from {!r}".format(uid, raddr))
-        # Send back a HELLO
-        await ws.send('HELLO')
-        return uid
+        return uid, resume
 
     def get_ssl_certs(self):
         if 'letsencrypt' in self.cert_path:
@@ -274,93 +793,181 @@ class Streamer:
         if self.disable_ssl:
             return None
         # Create an SSL context to be used by the websocket server
-        print('Using TLS with keys in {!r}'.format(self.cert_path))
+        log.info('Using TLS', cert_path=self.cert_path)
         chain_pem, key_pem = self.get_ssl_certs()
-        sslctx = ssl.create_default_context()
+        sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         try:
             sslctx.load_cert_chain(chain_pem, keyfile=key_pem)
         except FileNotFoundError:
-            print("Certificates not found, did you run generate_cert.sh?")
+            log.error('Certificates not found, did you run generate_cert.sh?')
+            slog.flush()
             sys.exit(1)
         # FIXME
         sslctx.check_hostname = False
         sslctx.verify_mode = ssl.CERT_NONE
         return sslctx
 
+    def extensions(self):
+        if self.compression == 'none':
+            return None
+        return compress.extensions(self.deflate_threshold, self.deflate_window_bits,
+                                   self.deflate_mem_level, self.deflate_level,
+                                   self.deflate_no_context_takeover)
+
     def run(self):
         async def handler(ws, path):
             '''
             All incoming messages are handled here. @path is unused.
             '''
             raddr = ws.remote_address
-            print("Connected to {!r}".format(raddr))
-            peer_id = await self.hello_peer(ws)
+            peer_log.debug('Connected', raddr=raddr)
             try:
-                await self.connection_handler(ws, peer_id)
+                peer_id, resume = await self.hello_peer(ws)
+            finally:
+                if self.admission:
+                    ws.handshake_done()
+            try:
+                await self.connection_handler(ws, peer_id, resume)
             except websockets.ConnectionClosed:
-                print("Connection to peer {!r} closed, exiting handler".format(raddr))
+                peer_log.debug('Connection closed, exiting handler', raddr=raddr)
             finally:
-                await self.remove_peer(peer_id)
+                await self.disconnect_peer(peer_id, ws)
+
+        if self.sslctx is None:
+            self.sslctx = self.get_ssl_ctx()
 
-        sslctx = self.get_ssl_ctx()
+        if self.router:
+            self.loop.run_until_complete(self.router.start())
 
-        print("Listening on https://{}:{}".format(self.addr, self.port))
+        log.info('Listening on https://{}:{}'.format(self.addr, self.port),
+                 worker=self.worker_index, workers=self.workers)
         # Websocket server
         wsd = websockets.serve(
             handler,
             self.addr,
             self.port,
-            ssl=sslctx,
-            process_request=self.health_check if self.health_path else None,
+            ssl=self.sslctx,
+            process_request=self.process_request,
+            create_protocol=functools.partial(AdmittingProtocol, admission=self.admission)
+                            if self.admission else None,
             max_queue=16,   # Maximum number of messages that websockets
                             # will pop off the asyncio and OS buffers per
                             # connection.
                             # See: https://websockets.readthedocs.io/en/stable/api.html#websockets.protocol.WebSocketCommonProtocol
+            ping_interval=None,     # Keepalives are sent by self.wheel
+            subprotocols=[framing.SUBPROTOCOL],     # Opt-in binary framing
+            reuse_port=self.workers > 1,
+            compression=None,
+            extensions=self.extensions(),
         )
 
-        # Setup logging
-        logger = logging.getLogger('websockets')
-        logger.setLevel(logging.INFO)
-        logger.addHandler(logging.StreamHandler())
-
         # Run the server
         self.server = self.loop.run_until_complete(wsd)
-        # Stop the server if certificate changes
-        self.loop.run_until_complete(self.check_server_needs_restart())
-
-    async def stop(self):
-        print('Stopping server... ', end='')
-        self.server.close()
-        await self.server.wait_closed()
-        self.loop.stop()
-        print('Stopped.')
+        self.wheel.start(self.loop)
+        if self.state:
+            self.state.start(self.loop)
+            self.loop.add_signal_handler(signal.SIGTERM, self.terminate)
+        # Reload the certificate when it changes
+        self.loop.create_task(self.watch_cert())
 
     def check_cert_changed(self):
         chain_pem, key_pem = self.get_ssl_certs()
-        mtime = max(os.stat(key_pem).st_mtime, os.stat(chain_pem).st_mtime)
+        try:
+            mtime = max(os.stat(key_pem).st_mtime, os.stat(chain_pem).st_mtime)
+        except FileNotFoundError:
+            # Probably in the middle of being replaced
+            return False
         if self.cert_mtime < 0:
             self.cert_mtime = mtime
             return False
-        if mtime > self.cert_mtime:
+        if mtime != self.cert_mtime:
             self.cert_mtime = mtime
             return True
         return False
 
-    async def check_server_needs_restart(self):
-        "When the certificate changes, we need to restart the server"
-        if not self.cert_restart:
+    def reload_ssl_ctx(self):
+        '''
+        Load the new certificate chain into the live SSL context: new
+        handshakes use it, established connections are not affected.
+        '''
+        chain_pem, key_pem = self.get_ssl_certs()
+        try:
+            # Check the new files in a scratch context first, so that a
+            # half-written renewal cannot break the live one
+            ssl.create_default_context(ssl.Purpose.CLIENT_AUTH).load_cert_chain(chain_pem, keyfile=key_pem)
+            self.sslctx.load_cert_chain(chain_pem, keyfile=key_pem)
+        except (OSError, ssl.SSLError) as e:
+            log.error('Could not load the new certificate, keeping the current one',
+                      error=repr(e))
+            return
+        log.info('Certificate reloaded', cert_path=self.cert_path)
+
+    async def watch_cert(self):
+        "When the certificate changes, reload it for the new connections"
+        if not self.cert_restart or self.disable_ssl:
             return
+        self.check_cert_changed()
+        chain_pem, key_pem = self.get_ssl_certs()
+        # Also watch the targets of symlinks, like letsencrypt's live/ files
+        dirs = [os.path.dirname(os.path.abspath(p)) for p in (chain_pem, key_pem)]
+        dirs += [os.path.dirname(os.path.realpath(p)) for p in (chain_pem, key_pem)]
+        watch = inotify.Watch.create(dirs, loop=self.loop)
+        if watch is None:
+            log.info('inotify not available, polling the certificate every 10 seconds')
         while True:
-            await asyncio.sleep(10)
+            if watch:
+                await watch.wait()
+                # Renewals usually write several files, wait for all of them
+                await asyncio.sleep(1)
+            else:
+                await asyncio.sleep(10)
             if self.check_cert_changed():
-                print('Certificate changed, stopping server...')
-                await self.stop()
-                return
+                self.reload_ssl_ctx()
+
+
+def run_workers(options):
+    '''
+    Fork one Streamer per worker, all listening on the same port. The kernel
+    spreads incoming connections over them thanks to SO_REUSEPORT.
+    '''
+    ipc_dir = options.ipc_dir or tempfile.mkdtemp(prefix='webrtc-signalling-')
+    options.ipc_dir = ipc_dir
+    children = []
+    for index in range(options.workers):
+        pid = os.fork()
+        if pid == 0:
+            streamer = Streamer(worker_index=index, **vars(options))
+            streamer.run_forever()
+            os._exit(0)
+        children.append(pid)
+    # The workers set up their own logging, this one is for the parent
+    slog.setup(level=options.log_level, fmt=options.log_format, sync=True)
+    log.info('Started workers', workers=options.workers, pids=children, ipc_dir=ipc_dir)
+    # Make sure the workers are stopped when we are asked to terminate
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        # If any worker dies, the routing mesh is broken: bring everything down
+        pid, status = os.wait()
+        log.error('Worker exited, stopping the others', pid=pid,
+                  status=os.waitstatus_to_exitcode(status))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(ipc_dir, ignore_errors=True)
 
 
 def main():
-    streamer = Streamer.from_argv()
-    streamer.run_forever()
+    options = Streamer.parse_args(sys.argv[1:])
+    if options.workers > 1:
+        run_workers(options)
+    else:
+        streamer = Streamer(**vars(options))
+        streamer.run_forever()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# Structured logging for the signalling server
+#
+# Records are handed to a queue and formatted/written by a background thread,
+# so the event loop never blocks on stdout. Each category can be sampled, and
+# message bodies (SDP can be several KB) are truncated or hashed by default.
+#
+
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+CATEGORIES = ('peer', 'session', 'room', 'relay', 'keepalive', 'queue', 'worker', 'server')
+BODY_MODES = ('truncate', 'hash', 'full', 'none')
+
+# How message bodies are rendered, see setup()
+_body_mode = 'truncate'
+_body_max = 64
+
+_listener = None
+
+
+class Body:
+    '''
+    A message body, only rendered if the record is actually written
+    '''
+    __slots__ = ('msg',)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        msg = self.msg
+        if _body_mode == 'full':
+            return msg
+        if _body_mode == 'none':
+            return '<{} bytes>'.format(len(msg))
+        if _body_mode == 'hash':
+            data = msg.encode() if isinstance(msg, str) else msg
+            return 'sha1:' + hashlib.sha1(data).hexdigest()[:12]
+        if len(msg) <= _body_max:
+            return msg
+        return '{}...<{} bytes>'.format(msg[:_body_max], len(msg))
+
+
+class Category:
+    '''
+    A log category with optional 1-in-N sampling. Sampled out or disabled
+    calls return before any LogRecord is created.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger('signalling.' + name)
+        self.every = 1
+        self.count = 0
+
+    def log(self, level, msg, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.every > 1:
+            self.count += 1
+            if self.count % self.every:
+                return
+        self.logger._log(level, msg, (), extra={'fields': fields})
+
+    def debug(self, msg, **fields):
+        self.log(logging.DEBUG, msg, **fields)
+
+    def info(self, msg, **fields):
+        self.log(logging.INFO, msg, **fields)
+
+    def warning(self, msg, **fields):
+        self.log(logging.WARNING, msg, **fields)
+
+    def error(self, msg, **fields):
+        self.log(logging.ERROR, msg, **fields)
+
+
+_categories = {name: Category(name) for name in CATEGORIES}
+
+
+def get(name):
+    return _categories[name]
+
+
+def _category(record):
+    if record.name.startswith('signalling.'):
+        return record.name[len('signalling.'):]
+    return record.name
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        parts = ['{:.3f}'.format(record.created), record.levelname,
+                 _category(record), record.getMessage()]
+        parts += ['{}={}'.format(k, v) for k, v in fields.items()]
+        if record.exc_info:
+            parts.append(self.formatException(record.exc_info))
+        return ' '.join(parts)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        out = dict(ts=record.created, level=record.levelname,
+                   cat=_category(record), msg=record.getMessage())
+        for k, v in (getattr(record, 'fields', None) or {}).items():
+            out[k] = v if isinstance(v, (int, float, bool, type(None))) else str(v)
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        return json.dumps(out)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Unlike QueueHandler, leave all the formatting to the listener thread
+    '''
+    def prepare(self, record):
+        return record
+
+
+def parse_sample(spec):
+    '''
+    Parse 'relay=100,keepalive=10' into {'relay': 100, 'keepalive': 10}
+    '''
+    rates = dict()
+    for item in filter(None, (spec or '').split(',')):
+        name, every = item.split('=')
+        if name not in _categories:
+            raise ValueError('Unknown log category {!r}'.format(name))
+        rates[name] = int(every)
+    return rates
+
+
+def setup(level='info', fmt='text', sample='', bodies='truncate', body_max=64, sync=False):
+    '''
+    Configure the 'signalling' and 'websockets' loggers. Must be called in
+    each worker process, since the writer thread does not survive fork().
+    '''
+    global _body_mode, _body_max, _listener
+    _body_mode = bodies
+    _body_max = body_max
+    for name, every in parse_sample(sample).items():
+        _categories[name].every = every
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JSONFormatter() if fmt == 'json' else TextFormatter())
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if sync:
+        handler = stream
+    else:
+        q = queue.SimpleQueue()
+        handler = DeferredQueueHandler(q)
+        _listener = logging.handlers.QueueListener(q, stream)
+        _listener.start()
+        atexit.register(flush)
+
+    for name in ('signalling', 'websockets'):
+        logger = logging.getLogger(name)
+        logger.handlers[:] = [handler]
+        logger.propagate = False
+    logging.getLogger('signalling').setLevel(level.upper())
+    # websockets is very chatty at DEBUG, keep it at INFO at most
+    logging.getLogger('websockets').setLevel(max(logging.INFO, logging.getLevelName(level.upper())))
+
+
+def flush():
+    '''
+    Stop the writer thread after writing out all queued records
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Snapshots of the resumable peers, so that they survive a restart
+#
+# Each worker keeps the peers it owns in a shared SQLite database. Changes are
+# only noted in the event loop, and written out in batches from a thread.
+#
+
+import asyncio
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import slog
+
+log = slog.get('server')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS peers (
+    uid TEXT PRIMARY KEY,
+    worker INTEGER NOT NULL,
+    token TEXT NOT NULL,
+    -- 'session', a room id, or NULL
+    status TEXT,
+    -- The other peer of the session
+    partner TEXT,
+    -- Does not want ROOM_PEER_JOINED/LEFT notices
+    quiet INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+
+class StateStore:
+    '''
+    @row(uid) returns (token, status, partner, quiet) for a resumable peer
+    owned by this worker, or None if the peer must not be stored
+    '''
+    def __init__(self, path, worker_index, workers, row, interval=1.0):
+        self.worker_index = worker_index
+        self.workers = workers
+        self.row = row
+        self.interval = interval
+        # uids whose row must be written or deleted
+        self.dirty = set()
+        # Only one thread writes at a time: the executor, or flush() at exit
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)
+        self.task = None
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA busy_timeout=5000')
+        with self.db:
+            self.db.execute(SCHEMA)
+        atexit.register(self.flush)
+
+    def start(self, loop):
+        if self.task is None:
+            self.task = loop.create_task(self.run(loop))
+
+    def load(self):
+        '''
+        Returns [(uid, token, status, partner, quiet)] stored by this worker.
+        The first worker also takes the peers of workers that don't exist
+        anymore.
+        '''
+        cur = self.db.execute(
+            'SELECT uid, token, status, partner, quiet FROM peers '
+            'WHERE worker = ? OR (? = 0 AND worker >= ?)',
+            (self.worker_index, self.worker_index, self.workers))
+        rows = cur.fetchall()
+        # Rewrite them as ours
+        self.dirty.update(row[0] for row in rows)
+        return rows
+
+    def sessions(self):
+        '''
+        Returns {uid: partner} for the peers stored in a session, by any
+        worker
+        '''
+        cur = self.db.execute("SELECT uid, partner FROM peers WHERE status = 'session'")
+        return dict(cur.fetchall())
+
+    def mark(self, uid):
+        self.dirty.add(uid)
+
+    def collect(self):
+        changes = [(uid, self.row(uid)) for uid in self.dirty]
+        self.dirty = set()
+        return changes
+
+    def write(self, changes):
+        with self.lock, self.db:
+            for uid, row in changes:
+                if row is None:
+                    self.db.execute('DELETE FROM peers WHERE uid = ? AND worker = ?',
+                                    (uid, self.worker_index))
+                else:
+                    self.db.execute('INSERT OR REPLACE INTO peers VALUES (?, ?, ?, ?, ?, ?)',
+                                    (uid, self.worker_index) + tuple(row))
+
+    async def run(self, loop):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.dirty:
+                continue
+            changes = self.collect()
+            try:
+                await loop.run_in_executor(self.executor, self.write, changes)
+            except sqlite3.Error as e:
+                log.error('Failed to save the state', error=repr(e))
+                # Try again next time
+                self.dirty.update(uid for uid, _ in changes)
+
+    def flush(self):
+        '''
+        Write the pending changes now, from the event loop thread
+        '''
+        if self.dirty:
+            self.write(self.collect())